@@ -64,7 +64,78 @@ direc : str
             is a string containing the directory path to the image chips - this is used to create the file path and name of the classified image chip.
 
 csv : csv file
-            name and directory path for the csv file containing the woody fpc estimates obtained from the image chips. 
+            name and directory path for the csv file containing the woody fpc estimates obtained from the image chips. The fpc and 
+            the other class fractions are the percentage of the non-null pixels in the image chip.
+
+picklefile : serilised pickle file
+            serilised random forest classifer, loaded once and kept in memory while all of the image chips are classified. 
+
+lut : numpy file .npy (optional)
+            precomputed rgb lookup table produced by build_rgb_lookup_table.py, used instead of the pickle file.
+
+forest : numpy file .npz (optional)
+            random forest exported by flat_forest.py, used instead of the pickle file so scikit-learn is not needed.
+
+subprocess : flag (optional)
+            run "rgb_digital_aerial_photo_classifier.py" as a separate process for each image chip (the original behaviour).
+
+no-raster : flag (optional)
+            the class fractions are counted as each image chip is classified and the classified image chips are not written.
+
+colour-cache : flag (optional)
+            use the colour cache instead of classifying every pixel, only the unique colours not already classified
+            are passed to the random forest. The cache is kept for all of the image chips and the hit rate is reported.
+
+daemon : str (optional)
+            Unix socket path or localhost:port of a running classifier_daemon.py, the image chips are sent to the service
+            which already has the classifier loaded instead of being classified by this script. The classifier is the one
+            loaded by the service, so --picklefile, --lut and --forest can not be given with --daemon.
+
+workers : int (optional)
+            number of processes used to classify the image chips in parallel, the classifier is loaded once per process. 
+            The results are returned in the same order as the list of imagery.
+
+log : json lines file (optional)
+            structured log with a line for each image chip recording the wall time split into predict and read/write, the 
+            pixels processed, the non-null fraction and the peak memory of the process so far (process_peak_memory_mb, the high 
+            water mark of the worker, not the memory used by the chip), followed by a line for the startup 
+            time (loading the classifier and starting the worker processes) and a summary line. The summary is also printed.
+
+profile : str (optional)
+            name of an image chip (as in the list of imagery) to run under cProfile, the statistics are written to 
+            --profile-out and the most expensive calls are printed.
+
+cache : json lines file (optional)
+            manifest of the results, keyed by the hash of the contents of each image chip and the hash of the classifier
+            (pickle file, lookup table or exported forest). Each result is appended as soon as the chip is classified, so
+            an interrupted run can be restarted and the chips whose contents and classifier have not changed return the 
+            result from the manifest without being classified again. Not used with --daemon.
+
+estimate : float (optional)
+            estimate the class fractions from a stratified random sample of the pixels rather than classifying every pixel.
+            The chip is split into --strata x --strata cells and --sample-batch pixels at a time are added to the sample, in
+            proportion to the non-null pixels in each cell, until the half width of the --confidence interval of the fpc is
+            no more than this value (percent). The estimate, the confidence interval (fpc_ci, fpc_ci_low, fpc_ci_high) and the
+            fraction of the pixels classified (sample_fraction) are written to the csv. No classified image chips are written.
+
+shard : str (optional)
+            i/N, classify only shard i (0 to N-1) of N shards of the list of imagery, so N array jobs on separate nodes
+            can share the list without a scheduler. An image chip is in shard crc32(name) % N, so the split does not depend
+            on the node or the order of the list. Each shard writes its results to <csv name>.shard-<i>-of-<N>.csv (and its
+            own --log and --cache files with the same suffix), written to a temporary file and renamed, so the shards never
+            write the same file and a partial file is always complete.
+
+store : SQLite database file (optional)
+            results store the result of each image chip is appended to in batches of --store-batch as the chips are classified,
+            with the source image, acquisition year, class fractions, non-null pixels, classifier hash and timing of each chip,
+            indexed on the site and year (see results_store.py). The source image and acquisition year are taken from the second 
+            and third columns of the list of imagery when given.
+
+merge : subcommand
+            python apply_rgb_comb_classifier_multi.py merge -s img_list.csv -c results.csv combines the shard results of
+            results.csv into results.csv in the order of the list of imagery, and reports the image chips that are missing 
+            (no shard result) or failed. The exit code is 1 if any are missing or failed. With --store the results stores of the
+            shards are copied into the store.
 
 """
 
@@ -78,8 +149,22 @@ import pdb
 import pandas as pd
 import csv
 import subprocess
+import multiprocessing
+import json
+import time
+import hashlib
+import zlib
+import glob
+import re
+import socket
+import ipaddress
+import cProfile
+import pstats
+from statistics import NormalDist
 import rasterio
 import numpy as np
+import rgb_digital_aerial_photo_classifier as classifier
+import results_store
 
 
 # command arguments 
@@ -93,6 +178,44 @@ def getCmdargs():
     
     p.add_argument("-c","--csv", help="provide the path to the directory and name of the csv file containing the results")
     
+    p.add_argument("-p","--picklefile", default="rfc_cpickle_20200615.p", help="Input pickle file (default is %(default)s)")
+    
+    p.add_argument("--lut", default=None, help="Input rgb lookup table used instead of the pickle file (default is %(default)s)")
+    
+    p.add_argument("--forest", default=None, help="Input forest exported by flat_forest.py, used instead of the pickle file (default is %(default)s)")
+    
+    p.add_argument("--subprocess", action="store_true", default=False, help="run the classifier as a separate process for each image chip")
+    
+    p.add_argument("--no-raster", dest="noraster", action="store_true", default=False, help="do not write the classified image chips, the fractions are calculated as the chips are classified")
+    
+    p.add_argument("--colour-cache", dest="colourcache", action="store_true", default=False, help="cache the class of each rgb colour so only the colours not already classified are passed to the random forest")
+    
+    p.add_argument("--daemon", default=None, help="Unix socket path or host:port of a running classifier_daemon.py to send the image chips to (default is %(default)s)")
+    
+    p.add_argument("-w","--workers", type=int, default=1, help="number of processes used to classify the image chips in parallel (default is %(default)s)")
+    
+    p.add_argument("--log", default=None, help="json lines file recording the timing and memory of each image chip (default is %(default)s)")
+    
+    p.add_argument("--profile", default=None, help="name of an image chip to run under cProfile (default is %(default)s)")
+    
+    p.add_argument("--cache", default=None, help="json lines manifest of the results used to skip unchanged image chips on a rerun (default is %(default)s)")
+    
+    p.add_argument("--profile-out", dest="profileout", default=None, help="file the cProfile statistics are written to (default is the image chip name with .prof)")
+    
+    p.add_argument("--estimate", type=float, default=None, help="estimate the fractions from a pixel sample until the fpc confidence interval half width is no more than this (percent), the classified image chips are not written (default is %(default)s)")
+    
+    p.add_argument("--confidence", type=float, default=0.95, help="confidence level of the interval used with --estimate (default is %(default)s)")
+    
+    p.add_argument("--sample-batch", dest="samplebatch", type=int, default=1000, help="pixels added to the sample of each chip at a time with --estimate (default is %(default)s)")
+    
+    p.add_argument("--strata", type=int, default=4, help="the chip is split into strata x strata cells that are sampled in proportion with --estimate (default is %(default)s)")
+    
+    p.add_argument("--shard", default=None, help="i/N, classify only shard i (0 to N-1) of N shards of the list of imagery (default is %(default)s)")
+    
+    p.add_argument("--store", default=None, help="SQLite results store the results are appended to (default is %(default)s)")
+    
+    p.add_argument("--store-batch", dest="storebatch", type=int, default=100, help="number of results written to the store in each transaction (default is %(default)s)")
+    
     cmdargs = p.parse_args()
     
     # if there is no image list the script will terminate
@@ -101,62 +224,767 @@ def getCmdargs():
         p.print_help()
 
         sys.exit()
+    
+    if cmdargs.shard is not None:
+        try:
+            cmdargs.shard = parseShard(cmdargs.shard)
+        except ValueError as err:
+            p.error(str(err))
+    
+    # the image chips are classified with the classifier loaded by the service
+    if cmdargs.daemon is not None:
+        ignored = [name for name, given in [('--picklefile', cmdargs.picklefile != p.get_default('picklefile')), 
+                                            ('--lut', cmdargs.lut is not None), ('--forest', cmdargs.forest is not None)] if given]
+        if ignored:
+            p.error(', '.join(ignored) + ' can not be used with --daemon, the classifier is the one loaded by classifier_daemon.py')
+        try:
+            parseAddress(cmdargs.daemon)
+        except ValueError as err:
+            p.error(str(err))
 
     return cmdargs
 
 
-def applyModel(imglist,directory):
+def getMergeCmdargs(argv):
+
+    """
+    command arguments of the merge subcommand
+    """
+    p = argparse.ArgumentParser(prog='apply_rgb_comb_classifier_multi.py merge', 
+                                description="combine the shard results into the final csv")
+    
+    p.add_argument("-s","--imglist", required=True, help="the csv file with the list of imagery the shards were run on")
+    
+    p.add_argument("-c","--csv", required=True, help="the csv file given to the shards, the combined results are written to it")
+    
+    p.add_argument("--store", default=None, help="the results store given to the shards, the shard stores are copied into it (default is %(default)s)")
+    
+    return p.parse_args(argv)
+
+
+def parseShard(shard):
+
+    """
+    convert i/N into the shard index and number of shards
+    """
+    match = re.match(r'^(\d+)/(\d+)$', shard.strip())
+    if match is None:
+        raise ValueError("--shard must be i/N, for example 0/8")
     
+    index, numShards = (int(match.group(1)), int(match.group(2)))
+    if numShards < 1 or index >= numShards:
+        raise ValueError("--shard i/N needs 0 <= i < N")
+    
+    return (index, numShards)
+
+
+def shardOf(fileN, numShards):
+
     """
-    produce the classified image from a image chip representing a site 
-    and extract out the total fpc value for the plot. 
-    Save the image chip and save out the fpc results as a csv file
+    the shard an image chip belongs to, crc32 gives the same shard on every 
+    node and python version, unlike the built in hash
+    """
+    return zlib.crc32(fileN.encode('utf-8')) % numShards
+
+
+def shardName(path, shard):
+
+    """
+    the name of the file written by a shard, so the shards never write the same file
+    """
+    index, numShards = shard
+    stem, ext = os.path.splitext(path)
+    
+    return '%s.shard-%d-of-%d%s' % (stem, index, numShards, ext)
+
+
+def writeCsv(results, csvfile):
+
+    """
+    write the results to a temporary file and rename it, so the csv is either
+    complete or not there at all when a job is killed
+    """
+    tmpfile = '%s.tmp%d' % (csvfile, os.getpid())
+    try:
+        results.to_csv(tmpfile)
+        os.replace(tmpfile, csvfile)
+    finally:
+        if os.path.exists(tmpfile):
+            os.remove(tmpfile)
+
+
+def runClassifierProcess(rgb_image, outfile, picklefile, lut=None, forest=None):
+    
+    """
+    run rgb_digital_aerial_photo_classifier.py as a separate process 
+    and raise an error if it does not exit cleanly
+    """
+    # the classifier is stored in the same directory as this script
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'rgb_digital_aerial_photo_classifier.py')
+    
+    cmd = [sys.executable, script, '--reffile', rgb_image, '--outfile', outfile, '--picklefile', picklefile]
+    if lut is not None:
+        cmd += ['--lut', lut]
+    if forest is not None:
+        cmd += ['--forest', forest]
+    
+    returncode = subprocess.call(cmd)
+    
+    if returncode != 0:
+        raise RuntimeError('classifier exited with code %d' % returncode)
+
+
+def rasterCounts(outfile):
+    
+    """
+    count the pixels in each class of a classified image, this is only 
+    needed when the classifier is run as a separate process
+    """
+    # read in with rasterio
+    with rasterio.open(outfile) as dataset:
+        # read in the first band as numpy array
+        band1 = dataset.read(1)
+    
+    return np.bincount(band1.ravel(), minlength=classifier.NUM_CLASSES + 1)[:classifier.NUM_CLASSES + 1]
+
+
+def sampleChip(rgb_image, model, tolerance, confidence=0.95, batch=1000, strata=4, seed=0):
+
+    """
+    estimate the class fractions of an image chip from a stratified random
+    sample of its non-null pixels. The chip is split into a grid of strata x
+    strata cells and the sample is added in batches, allocated in proportion
+    to the pixels in each cell, until the half width of the confidence
+    interval of the fpc is no more than tolerance (percent) or every pixel
+    has been classified. Returns the estimated fractions and the counts of
+    the sampled pixels in each class. The whole chip is still read, as the
+    non-null pixels of each stratum give the stratum weights, so only the
+    classification of the pixels is saved
+    """
+    model.timings = {'predict': 0.0}
+    start = time.time()
+
+    with rasterio.open(rgb_image) as dataset:
+        image = dataset.read()
+
+    nonNullmask = (image[0] != model.refnull)
+    rows, cols = np.nonzero(nonNullmask)
+    numPixels = rows.shape[0]
+    numValues = classifier.NUM_CLASSES + 1
+
+    # the pixels of each stratum in a random order, so each batch takes the next pixels of each stratum
+    stratum = (rows * strata // image.shape[1]) * strata + (cols * strata // image.shape[2])
+    order = np.random.RandomState(seed).permutation(numPixels)
+    order = order[np.argsort(stratum[order], kind='stable')]
+    stratumPixels = np.bincount(stratum, minlength=strata * strata)
+    offsets = np.concatenate([[0], np.cumsum(stratumPixels)])
+    weights = stratumPixels / max(numPixels, 1)
+
+    z = NormalDist().inv_cdf(0.5 + confidence / 2)
+
+    # the classified pixel counts of each stratum
+    counts = np.zeros((strata * strata, numValues), dtype=np.int64)
+    sampled = np.zeros(strata * strata, dtype=np.int64)
+
+    # classifyBlock only classifies here, the counts are kept per stratum
+    model.classCounts = None
+
+    halfWidth = np.nan
+    while sampled.sum() < numPixels:
+        target = np.minimum(stratumPixels, np.maximum(np.ceil((sampled.sum() + batch) * weights).astype(np.int64), 2))
+
+        # the next pixels of every stratum that grows are classified together in a single call
+        grow = np.nonzero(target > sampled)[0]
+        index = np.concatenate([order[offsets[h] + sampled[h]:offsets[h] + target[h]] for h in grow])
+
+        predictStart = time.time()
+        # the sampled pixels are classified as a block of a single row
+        hgt = classifier.classifyBlock(image[:, rows[index], cols[index]][:, np.newaxis, :], model)
+        model.timings['predict'] += time.time() - predictStart
+
+        # the classes of the batch are counted back into the strata the pixels came from
+        counts += np.bincount(stratum[index] * numValues + hgt.ravel(), minlength=strata * strata * numValues).reshape(strata * strata, numValues)
+        sampled[grow] = target[grow]
+
+        # stratified variance of the woody green fraction with the finite population correction, the
+        # proportion is shrunk towards a half so a sample of a single class does not give a zero width
+        used = sampled > 0
+        p = (counts[used, 1] + 0.5) / (sampled[used] + 1)
+        finiteCorrection = (1 - sampled[used] / stratumPixels[used])
+        variance = np.sum(weights[used] ** 2 * finiteCorrection * p * (1 - p) / np.maximum(sampled[used] - 1, 1))
+        halfWidth = z * np.sqrt(variance) * 100
+
+        if halfWidth <= tolerance:
+            break
+
+    # the estimated percentage of the non-null pixels in each class
+    result = {'nonnull': numPixels}
+    used = sampled > 0
+    for classValue, name in enumerate(classifier.CLASS_NAMES, start=1):
+        if numPixels > 0:
+            result[name] = np.sum(weights[used] * counts[used, classValue] / sampled[used]) * 100
+        else:
+            result[name] = np.nan
+
+    result['fpc_ci'] = halfWidth if numPixels > 0 else np.nan
+    result['fpc_ci_low'] = max(result['woody_green'] - result['fpc_ci'], 0.0)
+    result['fpc_ci_high'] = min(result['woody_green'] + result['fpc_ci'], 100.0)
+    result['sampled'] = int(sampled.sum())
+    result['sample_fraction'] = sampled.sum() / max(numPixels, 1)
+
+    model.timings['total'] = time.time() - start
+    model.timings['read_write'] = model.timings['total'] - model.timings['predict']
+
+    return (result, counts.sum(axis=0))
+
+
+def processChip(fileN, model, settings):
+    
     """
-    site_list = []
-    fpc_value_list = []
+    classify a single image chip and return the estimated fpc, the 
+    percentage of the non-null pixels in each of the other classes and 
+    the status of the chip, a failed chip returns nan fractions
+    """
+    directory = settings['directory']
+    rgb_image =  directory + fileN
+    
+    outfile = directory + fileN[:-4] + '_rgb_comb_class.tif'
+    
+    result = {'site': fileN, 'outfile': None}
+    
+    # the colour cache counters before the chip, used to report the cache hit rate
+    colourCache = getattr(model, 'colourCache', None)
+    if colourCache is not None:
+        hits, misses = (colourCache.hits, colourCache.misses)
+    
+    # run the chosen image chip under the profiler
+    profiler = None
+    if settings.get('profile') is not None and settings['profile'] == fileN:
+        profiler = cProfile.Profile()
+        profiler.enable()
+    
+    start = time.time()
+    estimate = None
+    try:
+        if settings.get('estimate') is not None:
+            # only a sample of the pixels is classified and no classified image is written
+            estimate, sampledCounts = sampleChip(rgb_image, model, settings['estimate'], settings['confidence'],
+                                                 settings['sampleBatch'], settings['strata'])
+            classCounts = None
+            outfile = None
+        elif settings['useSubprocess']:
+            runClassifierProcess(rgb_image, outfile, settings['picklefile'], settings['lut'], settings['forest'])
+            classCounts = rasterCounts(outfile)
+        else:
+            # the pixels in each class are counted as the chip is classified so the classified image is not read back in
+            classCounts, outfile = classifier.classify_chip(rgb_image, model, outfile, settings['writeRaster'])
+    except Exception as err:
+        print (fileN + ' failed: ' + str(err))
+        result.update(classifier.classFractions(np.zeros(classifier.NUM_CLASSES + 1)))
+        result['status'] = 'failed'
+        result['error'] = str(err)
+        result.update(chipTimings(fileN, start, None, None))
+        return result
+    finally:
+        if profiler is not None:
+            profiler.disable()
+            writeProfile(profiler, settings.get('profileOut') or os.path.basename(fileN)[:-4] + '.prof')
         
-    # open the list of imagery and read it into memory
-    df = pd.read_csv(imglist,header=None)
+    print (fileN + ' complete')
+    
+    # the split between predict and read/write is only known when the chip is classified in this process
+    result.update(chipTimings(fileN, start, classCounts, None if settings['useSubprocess'] else model.timings))
+    
+    # an estimate only processes the sampled pixels
+    if estimate is not None:
+        result['pixels'] = estimate['sampled']
+    
+    # the fractions are calculated from the non-null pixels in the image chip
+    if estimate is not None:
+        result.update(estimate)
+    else:
+        result.update(classifier.classFractions(classCounts))
+    result['status'] = 'ok'
+    result['outfile'] = outfile
+    
+    if colourCache is not None:
+        result['cache_hits'] = colourCache.hits - hits
+        result['cache_lookups'] = (colourCache.hits + colourCache.misses) - (hits + misses)
+    
+    return result
+
+
+def chipTimings(fileN, start, classCounts, timings):
+    
+    """
+    the wall time, pixels and non-null fraction of an image chip, with the
+    peak memory of the process up to the end of the chip
+    """
+    record = {'seconds': time.time() - start, 'predict_seconds': None, 'read_write_seconds': None,
+              'pixels': 0, 'nonnull_fraction': None, 'pid': os.getpid()}
+    
+    if timings is not None:
+        record['predict_seconds'] = timings['predict']
+        record['read_write_seconds'] = timings['read_write']
+    
+    if classCounts is not None:
+        record['pixels'] = int(np.sum(classCounts))
+        if record['pixels'] > 0:
+            record['nonnull_fraction'] = int(np.sum(classCounts[1:])) / record['pixels']
+    
+    record['process_peak_memory_mb'] = classifier.peakMemory()[0]
+    
+    # the time taken to start the worker process is reported with the first chip it classifies
+    if 'startupSeconds' in workerState:
+        record['startup_seconds'] = workerState.pop('startupSeconds')
+    
+    return record
+
+
+def writeProfile(profiler, profileOut):
+    
+    """
+    save the profiler statistics and print the most expensive calls
+    """
+    profiler.dump_stats(profileOut)
+    
+    stats = pstats.Stats(profiler)
+    stats.sort_stats('cumulative').print_stats(20)
+    
+    print ('profile written to ' + profileOut)
+
+
+def timingSummary(results, startup, elapsed):
+    
+    """
+    summarise the per chip timings of a run
+    """
+    chips = [result for result in results if result.get('seconds') is not None]
+    
+    def total(key):
+        return sum(result[key] for result in chips if result.get(key) is not None)
+    
+    pixels = total('pixels')
+    nonnull = [result['nonnull_fraction'] for result in chips if result.get('nonnull_fraction') is not None]
+    memory = [result['process_peak_memory_mb'] for result in chips if result.get('process_peak_memory_mb') is not None]
+    workerStartup = [result['startup_seconds'] for result in chips if result.get('startup_seconds') is not None]
+    slowest = sorted(chips, key=lambda result: result['seconds'], reverse=True)[:5]
     
-    for index, row in df.iterrows():
-        rgb_image =  directory + (str(row[0]))
+    return {'event': 'summary', 'chips': len(results), 'failed': sum(result['status'] != 'ok' for result in results),
+            'wall_seconds': elapsed, 'model_load_seconds': startup.get('model_load_seconds'),
+            'pool_start_seconds': startup.get('pool_start_seconds'), 'worker_startup_seconds': max(workerStartup) if workerStartup else None,
+            'chip_seconds': total('seconds'), 'predict_seconds': total('predict_seconds'), 
+            'read_write_seconds': total('read_write_seconds'), 'pixels': pixels, 
+            'pixels_per_second': pixels / max(elapsed, 1e-9), 
+            'mean_nonnull_fraction': float(np.mean(nonnull)) if nonnull else None,
+            'process_peak_memory_mb': max(memory) if memory else None,
+            'slowest': [(result['site'], result['seconds']) for result in slowest]}
+
+
+def printSummary(summary):
+    
+    """
+    print the summary of the timings of a run
+    """
+    print ('%d image chips (%d failed), %d pixels in %.1f seconds, %.0f pixels/sec' % 
+           (summary['chips'], summary['failed'], summary['pixels'], summary['wall_seconds'], summary['pixels_per_second']))
+    print ('chip time %.1f seconds: predict %.1f, read and write %.1f' % 
+           (summary['chip_seconds'], summary['predict_seconds'], summary['read_write_seconds']))
+    
+    startup = [(name, summary[key]) for name, key in [('classifier load', 'model_load_seconds'), ('pool start', 'pool_start_seconds'), 
+               ('worker startup', 'worker_startup_seconds')] if summary[key] is not None]
+    if startup:
+        print ('startup: ' + ', '.join('%s %.2f seconds' % item for item in startup))
+    if summary['process_peak_memory_mb'] is not None:
+        print ('peak memory of a single process: %.0f MB' % summary['process_peak_memory_mb'])
+    if summary['mean_nonnull_fraction'] is not None:
+        print ('mean non-null fraction: %.3f' % summary['mean_nonnull_fraction'])
+    print ('slowest image chips: ' + ', '.join('%s %.2f s' % item for item in summary['slowest']))
+
+
+# the result fields that describe how a chip was processed rather than its contents
+TIMING_KEYS = ['seconds', 'predict_seconds', 'read_write_seconds', 'startup_seconds', 'process_peak_memory_mb', 'pid',
+               'cache_hits', 'cache_lookups']
+
+
+def fileHash(path, blocksize=2 ** 20):
+    
+    """
+    sha256 of the contents of a file
+    """
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(blocksize), b''):
+            digest.update(block)
+    
+    return digest.hexdigest()
+
+
+def modelHash(picklefile, lut=None, forest=None):
+    
+    """
+    hash of the classifier used for the image chips, the lookup table and
+    exported forest replace the pickle file when they are given
+    """
+    if lut is not None:
+        return 'lut:' + fileHash(lut)
+    if forest is not None:
+        return 'forest:' + fileHash(forest)
+    
+    return 'rf:' + fileHash(picklefile)
+
+
+def loadResultCache(cache, modelKey):
+    
+    """
+    read the results in the manifest that were produced by the same classifier,
+    keyed by the hash of the image chip. A line left incomplete by a crash is skipped
+    """
+    results = {}
+    if cache is None or not os.path.exists(cache):
+        return results
+    
+    with open(cache) as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            
+            if record.get('model_hash') == modelKey:
+                results[record['chip_hash']] = record['result']
+    
+    return results
+
+
+def storeResult(cachefile, modelKey, result):
+    
+    """
+    append the result of a newly classified image chip to the manifest
+    """
+    if cachefile is None or result.get('cached') or result['status'] != 'ok' or result.get('chip_hash') is None:
+        return
+    
+    stored = dict((key, value) for key, value in result.items() if key not in TIMING_KEYS)
+    
+    cachefile.write(json.dumps({'chip_hash': result['chip_hash'], 'model_hash': modelKey, 'result': stored}) + '\n')
+    cachefile.flush()
+
+
+# the classifier and settings held by each process of the worker pool 
+workerState = {}
+
+
+def initWorker(settings, singleCore=True, resultCache=None):
+    
+    """
+    load the classifier once in each worker process. When the pool is 
+    forked the model loaded by the parent process is shared copy-on-write.
+    The results of the result cache are passed to each worker, as a worker
+    started with spawn does not inherit the state of the parent process
+    """
+    if workerState.get('model') is None and not settings['useSubprocess']:
+        workerState['model'] = classifier.loadModel(settings['picklefile'], settings['lut'], settings['colourCache'], settings['forest'])
+    
+    # time from starting the pool until the worker is ready to classify
+    if settings.get('poolStart') is not None:
+        workerState['startupSeconds'] = time.time() - settings['poolStart']
+    
+    # each worker uses a single core so the pool does not oversubscribe the node
+    if singleCore and workerState.get('model') is not None and hasattr(workerState['model'].rf, 'n_jobs'):
+        workerState['model'].rf.n_jobs = 1
         
-        fileN = (str(row[0]))
+    workerState['settings'] = settings
+    workerState['cache'] = resultCache
+    
+    
+def workerChip(fileN):
+    
+    """
+    classify an image chip in a worker process, an image chip already in 
+    the result cache is returned without being classified
+    """
+    settings = workerState['settings']
+    cache = workerState.get('cache')
+    
+    chipHash = None
+    if cache is not None:
+        try:
+            chipHash = fileHash(settings['directory'] + fileN)
+        except (IOError, OSError):
+            # the missing chip is reported as failed by processChip
+            chipHash = None
         
-        outfile = directory + fileN[:-4] + '_rgb_comb_class.tif'
+        cached = cache.get(chipHash)
         
-        #print (fileN)
-        #print (outfile)         
- 
-        # call and run the vegetation index scripts
-        # to get this to work on windows the code being called by os.system needs to be stored 
-        # and run from the same directory. 
-    
-        cmd = "python rgb_digital_aerial_photo_classifier.py --reffile %s --outfile %s"% (rgb_image,outfile) 
-        #subprocess.call(cmd, shell=True)    
-        os.system(cmd)
-        print (outfile + ' complete')
+        # the classified image has to still exist when it is wanted
+        if cached is not None and (not settings['writeRaster'] or (cached.get('outfile') and os.path.exists(cached['outfile']))):
+            print (fileN + ' cached')
+            return dict(cached, site=fileN, cached=True)
+    
+    result = processChip(fileN, workerState.get('model'), settings)
+    result['chip_hash'] = chipHash
+    
+    return result
+
+
+def parseAddress(address):
+    
+    """
+    return the socket family and address for a Unix socket path or a host:port,
+    the classifier service only runs on this machine so the host has to be a 
+    loopback address ([::1]:port for IPv6)
+    """
+    host, sep, port = address.rpartition(':')
+    if sep != '' and port.isdigit():
+        host = host.strip('[]') or '127.0.0.1'
+        if host == 'localhost':
+            return (socket.AF_INET, ('127.0.0.1', int(port)))
         
-        # read in the classified image and calculate the estimated fpc
-        # read in with rasterio
-        dataset = rasterio.open(outfile)
-        # read in the first band as numpy array
-        band1 = dataset.read(1)
+        try:
+            ip = ipaddress.ip_address(host)
+        except ValueError:
+            ip = None
+        if ip is None or not ip.is_loopback:
+            raise ValueError('the classifier service only listens on a loopback address (localhost, 127.0.0.1 or [::1]), not ' + host)
+        
+        return (socket.AF_INET6 if ip.version == 6 else socket.AF_INET, (host, int(port)))
+
+    if not hasattr(socket, 'AF_UNIX'):
+        raise ValueError('Unix sockets are not available on this platform, give a localhost:port address rather than ' + address)
+
+    return (socket.AF_UNIX, address)
+
+
+def requestDaemon(address, request, timeout=None):
+    
+    """
+    send a request to the classifier service (classifier_daemon.py) and return the response
+    """
+    family, sockaddr = parseAddress(address)
+
+    conn = socket.socket(family, socket.SOCK_STREAM)
+    conn.settimeout(timeout)
+    try:
+        conn.connect(sockaddr)
+        conn.sendall((json.dumps(request) + '\n').encode('utf-8'))
+
+        with conn.makefile('rb') as f:
+            line = f.readline()
+    finally:
+        conn.close()
+
+    if line == b'':
+        raise RuntimeError('no response from the classifier service at %s' % address)
+
+    return json.loads(line.decode('utf-8'))
+
+
+def logChip(logfile, result):
+    
+    """
+    write the timing of an image chip to the json lines log
+    """
+    if logfile is None:
+        return
+    
+    keys = ['site', 'status', 'seconds', 'predict_seconds', 'read_write_seconds', 'startup_seconds', 'pixels', 
+            'nonnull_fraction', 'process_peak_memory_mb', 'pid', 'cached']
+    record = dict((key, result.get(key)) for key in keys)
+    record['event'] = 'chip'
+    
+    logfile.write(json.dumps(record) + '\n')
+    logfile.flush()
+
+
+def listSources(df):
+    
+    """
+    the source image and acquisition year of each image chip from the 
+    optional second and third columns of the list of imagery
+    """
+    sources = {}
+    for row in df.itertuples(index=False):
+        image = row[1] if len(row) > 1 and pd.notnull(row[1]) else None
+        year = None
+        if len(row) > 2 and pd.notnull(row[2]):
+            # the year can be given on its own or as the start of a date, when it
+            # can not be read the year is taken from the image chip instead
+            try:
+                year = int(str(row[2]).strip()[:4])
+            except ValueError:
+                year = None
+        sources[str(row[0])] = (image, year)
+    
+    return sources
+
+
+def storeChip(resultsStore, result, sources, directory):
+    
+    """
+    append the result of an image chip to the results store
+    """
+    if resultsStore is None:
+        return
+    
+    image, year = sources.get(result['site'], (None, None))
+    resultsStore.append(result, image, year, directory + result['site'])
+
+
+def runChips(imglist, directory, picklefile, lut, useSubprocess, workers, writeRaster, colourCache, forest, daemon,
+             profile, profileOut, startup, logfile, cache=None, sampling=None, shard=None, resultsStore=None):
+    
+    """
+    classify the image chips in the list of imagery in this process, a pool 
+    of worker processes or the classifier service
+    """
+    if useSubprocess and not writeRaster:
+        raise ValueError("the classified image needs to be written when the classifier is run as a separate process")
+    
+    if daemon is not None and cache is not None:
+        raise ValueError("the result cache can not be used with the classifier service")
+    
+    if sampling is not None and (useSubprocess or daemon is not None or writeRaster):
+        raise ValueError("the fractions can only be estimated from a sample without writing the classified image in this script")
+    
+    # open the list of imagery and read it into memory
+    df = pd.read_csv(imglist,header=None)
+    
+    site_list = [str(fileN) for fileN in df[0]]
+    sources = listSources(df) if resultsStore is not None else {}
+    
+    # only the image chips of this shard are classified
+    if shard is not None:
+        site_list = [fileN for fileN in site_list if shardOf(fileN, shard[1]) == shard[0]]
+        print ('shard %d of %d: %d image chips' % (shard[0], shard[1], len(site_list)))
+    
+    # the classifier service already has the classifier loaded, so only the paths of the image chips are sent
+    if daemon is not None:
+        response = requestDaemon(daemon, {'chips': [directory + fileN for fileN in site_list], 'raster': writeRaster})
+        if response['status'] != 'ok':
+            raise RuntimeError('classifier service: ' + response.get('error', response['status']))
         
-        # get the shape of the image chip which to calculate the percentage fpc
-        numPixels = (band1.shape[0] * band1.shape[1])
+        results = response['results']
+        for fileN, result in zip(site_list, results):
+            result['site'] = fileN
+            print (fileN + ' ' + ('complete' if result['status'] == 'ok' else 'failed'))
+            logChip(logfile, result)
+            storeChip(resultsStore, result, sources, directory)
         
-        # get the number of pixels classifed as green mangroves and calculate the % FPC for the site 
-        greenM = band1[band1 == 1]
-        greenMc = (greenM.shape[0]) 
-        fpc = (greenMc / numPixels)*100
+        return results
+    
+    settings = {'directory': directory, 'picklefile': picklefile, 'lut': lut, 
+                'useSubprocess': useSubprocess, 'writeRaster': writeRaster, 'colourCache': colourCache,
+                'forest': forest, 'profile': profile, 'profileOut': profileOut}
+    
+    # the tolerance, confidence, batch size and strata used to estimate the fractions from a sample
+    if sampling is not None:
+        settings.update(sampling)
+    
+    # the results of the image chips already classified with the same classifier, 
+    # read before the pool is started and passed to each of the workers
+    cachefile = None
+    resultCache = None
+    modelKey = None
+    if cache is not None:
+        modelKey = modelHash(picklefile, lut, forest)
+        # an estimate is only reused with the same sampling settings
+        if sampling is not None:
+            modelKey += ':sample:' + json.dumps(sampling, sort_keys=True)
+        resultCache = loadResultCache(cache, modelKey)
+        cachefile = open(cache, 'a')
+    
+    # load the classifier once and keep it in memory for all of the image chips, 
+    # forked worker processes inherit it rather than unpickling it again
+    if not useSubprocess:
+        start = time.time()
+        workerState['model'] = classifier.loadModel(picklefile, lut, colourCache, forest)
+        startup['model_load_seconds'] = time.time() - start
+    
+    results = []
+    try:
+        if workers > 1:
+            start = time.time()
+            pool = multiprocessing.Pool(workers, initializer=initWorker, initargs=(dict(settings, poolStart=start), True, resultCache))
+            startup['pool_start_seconds'] = time.time() - start
+            try:
+                # imap returns the results in the same order as the list of imagery
+                for result in pool.imap(workerChip, site_list, chunksize=1):
+                    logChip(logfile, result)
+                    storeResult(cachefile, modelKey, result)
+                    storeChip(resultsStore, result, sources, directory)
+                    results.append(result)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            initWorker(settings, False, resultCache)
+            for fileN in site_list:
+                result = workerChip(fileN)
+                logChip(logfile, result)
+                storeResult(cachefile, modelKey, result)
+                storeChip(resultsStore, result, sources, directory)
+                results.append(result)
+    finally:
+        if cachefile is not None:
+            cachefile.close()
+    
+    if cache is not None:
+        print (str(sum(1 for result in results if result.get('cached'))) + ' of ' + str(len(results)) + ' image chips returned from the result cache')
         
-        site_list.append(fileN)
+    return results
+
+
+def applyModel(imglist,directory,picklefile="rfc_cpickle_20200615.p",lut=None,useSubprocess=False,workers=1,writeRaster=True,
+               colourCache=False,forest=None,daemon=None,log=None,profile=None,profileOut=None,cache=None,sampling=None,shard=None,
+               store=None,storeBatch=100,summary=None):
+    
+    """
+    produce the classified image from a image chip representing a site 
+    and extract out the total fpc value and the other class fractions 
+    for the plot. Returns a list with the results for each image chip,
+    the timing of each chip is written to the json lines log if given and
+    the results are kept in the result cache (manifest) if given. When
+    sampling gives the estimate (tolerance), confidence, sampleBatch and
+    strata arguments of sampleChip the fractions are estimated from a sample.
+    When shard is (i, N) only the image chips in shard i of N are classified.
+    The results are appended to the SQLite results store if given and the
+    summary of the timings of the run is added to the summary dict if given
+    """
+    runStart = time.time()
+    startup = {}
+    logfile = open(log, 'w') if log is not None else None
+    
+    # the classifier used by the classifier service is not known to this script
+    resultsStore = None
+    if store is not None:
+        storeHash = None
+        if daemon is None:
+            storeHash = modelHash(picklefile, lut, forest)
+            if sampling is not None:
+                storeHash += ':sample:' + json.dumps(sampling, sort_keys=True)
+        resultsStore = results_store.ResultsStore(store, storeHash, storeBatch)
+    try:
+        results = runChips(imglist, directory, picklefile, lut, useSubprocess, workers, writeRaster, colourCache, forest,
+                           daemon, profile, profileOut, startup, logfile, cache, sampling, shard, resultsStore)
         
-        fpc_value_list.append(fpc)
+        runSummary = timingSummary(results, startup, time.time() - runStart)
+        if summary is not None:
+            summary.update(runSummary)
         
-    return (site_list, fpc_value_list)   
-           
+        if logfile is not None:
+            logfile.write(json.dumps(dict(startup, event='startup')) + '\n')
+            logfile.write(json.dumps(runSummary) + '\n')
+    finally:
+        if logfile is not None:
+            logfile.close()
+        if resultsStore is not None:
+            resultsStore.close()
+            print ('%d results written to %s' % (resultsStore.written, store))
+    
+    return results
+
+
 # calls in the command arguments and applyModel function.        
 def mainRoutine():
     
@@ -164,19 +992,125 @@ def mainRoutine():
     main routine
     """
     
+    if len(sys.argv) > 1 and sys.argv[1] == 'merge':
+        mergeRoutine(getMergeCmdargs(sys.argv[2:]))
+        return
+    
     cmdargs = getCmdargs()
     directory = str(cmdargs.direc)
     csvfile = str(cmdargs.csv)
     
+    # each shard writes its own results, log and cache so no file is shared between the nodes
+    log = cmdargs.log
+    cache = cmdargs.cache
+    store = cmdargs.store
+    if cmdargs.shard is not None:
+        csvfile = shardName(csvfile, cmdargs.shard)
+        log = shardName(log, cmdargs.shard) if log is not None else None
+        cache = shardName(cache, cmdargs.shard) if cache is not None else None
+        store = shardName(store, cmdargs.shard) if store is not None else None
+    
+    # the sampling settings when the fractions are estimated from a sample of the pixels
+    sampling = None
+    if cmdargs.estimate is not None:
+        sampling = {'estimate': cmdargs.estimate, 'confidence': cmdargs.confidence, 
+                    'sampleBatch': cmdargs.samplebatch, 'strata': cmdargs.strata}
+    
     # call the function to classify and extract out the fpc estimates
-    site_list, fpc_value_list = applyModel(cmdargs.imglist,directory)
+    summary = {}
+    results = applyModel(cmdargs.imglist,directory,cmdargs.picklefile,cmdargs.lut,
+                         cmdargs.subprocess,cmdargs.workers,not cmdargs.noraster and sampling is None,cmdargs.colourcache,cmdargs.forest,
+                         cmdargs.daemon,log,cmdargs.profile,cmdargs.profileout,cache,sampling,cmdargs.shard,
+                         store,cmdargs.storebatch,summary)
+    printSummary(summary)
+    
+    # report the colour cache hit rate over all of the image chips
+    if cmdargs.colourcache and not cmdargs.subprocess and cmdargs.daemon is None:
+        hits = sum(result.get('cache_hits', 0) for result in results)
+        lookups = sum(result.get('cache_lookups', 0) for result in results)
+        print ('colour cache hit rate: %.1f%% of %d pixels looked up' % (100 * hits / max(lookups, 1), lookups))
 
-    # save out the results to a csv file
-    data = list(zip(site_list, fpc_value_list))
+    # save out the results to a csv file, the woody green fraction is the fpc
+    columns = ['site','fpc'] + classifier.CLASS_NAMES[1:] + ['nonnull','status']
     
-    results = pd.DataFrame(data,columns=['site','fpc'])
+    # the confidence interval of the estimated fpc and the fraction of the pixels that were classified
+    if sampling is not None:
+        columns = columns[:-1] + ['fpc_ci','fpc_ci_low','fpc_ci_high','sample_fraction','status']
+        used = [result['sample_fraction'] for result in results if result['status'] == 'ok']
+        if len(used) > 0:
+            print ('fpc estimated to within %.2f%% at %.0f%% confidence from %.1f%% of the pixels' % 
+                   (cmdargs.estimate, cmdargs.confidence * 100, 100 * np.mean(used)))
+    
+    # a shard can have no image chips, so the columns are added when missing
+    results = pd.DataFrame(results).rename(columns={'woody_green': 'fpc'}).reindex(columns=columns)
            
-    results.to_csv(csvfile)
+    writeCsv(results, csvfile)
+    
+    # report the failed image chips and return a non zero exit code
+    failed = list(results['site'][results['status'] != 'ok'])
+    if len(failed) > 0:
+        print (str(len(failed)) + ' of ' + str(len(results)) + ' image chips failed: ' + ', '.join(failed))
+        sys.exit(1)
+
+
+def mergeRoutine(cmdargs):
+    
+    """
+    combine the results of the shards into the final csv in the order of the
+    list of imagery and report the missing and failed image chips
+    """
+    site_list = [str(fileN) for fileN in pd.read_csv(cmdargs.imglist, header=None)[0]]
+    
+    stem, ext = os.path.splitext(cmdargs.csv)
+    pattern = re.compile(re.escape(stem) + r'\.shard-(\d+)-of-(\d+)' + re.escape(ext) + '$')
+    
+    partials = {}
+    for path in glob.glob(glob.escape(stem) + '.shard-*-of-*' + ext):
+        match = pattern.match(path)
+        if match is not None:
+            partials[(int(match.group(1)), int(match.group(2)))] = path
+    
+    if len(partials) == 0:
+        print ('no shard results found for ' + cmdargs.csv)
+        sys.exit(1)
+    
+    numShards = set(numShards for index, numShards in partials)
+    if len(numShards) > 1:
+        print ('shard results for different numbers of shards found: ' + ', '.join(sorted(partials.values())))
+        sys.exit(1)
+    numShards = numShards.pop()
+    
+    missingShards = [index for index in range(numShards) if (index, numShards) not in partials]
+    if len(missingShards) > 0:
+        print ('%d of %d shards have no results: %s' % (len(missingShards), numShards, ', '.join(str(index) for index in missingShards)))
+    
+    frames = [pd.read_csv(partials[key], index_col=0, dtype={'site': str}, float_precision='round_trip') for key in sorted(partials)]
+    shardResults = pd.concat(frames, ignore_index=True).drop_duplicates('site', keep='last').set_index('site')
+    
+    # the image chips with no result are kept in the csv with the status missing
+    results = shardResults.reindex(site_list)
+    results['status'] = results['status'].fillna('missing')
+    results = results.reset_index().rename(columns={'index': 'site'})
+    
+    writeCsv(results, cmdargs.csv)
+    
+    print ('%d image chips from %d shards written to %s' % (len(results), len(partials), cmdargs.csv))
+    
+    # the results stores of the shards that were found
+    if cmdargs.store is not None:
+        shardStores = [shardName(cmdargs.store, key) for key in sorted(partials) if os.path.exists(shardName(cmdargs.store, key))]
+        numRows = results_store.mergeStores(cmdargs.store, shardStores)
+        print ('%d results from %d shard stores written to %s' % (numRows, len(shardStores), cmdargs.store))
+    
+    missing = list(results['site'][results['status'] == 'missing'])
+    failed = list(results['site'][(results['status'] != 'ok') & (results['status'] != 'missing')])
+    
+    if len(missing) > 0:
+        print (str(len(missing)) + ' of ' + str(len(results)) + ' image chips missing: ' + ', '.join(missing))
+    if len(failed) > 0:
+        print (str(len(failed)) + ' of ' + str(len(results)) + ' image chips failed: ' + ', '.join(failed))
+    if len(missing) > 0 or len(failed) > 0:
+        sys.exit(1)
     
     
 if __name__ == "__main__":
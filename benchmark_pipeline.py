@@ -0,0 +1,450 @@
+#!/usr/bin/env python
+
+"""
+Benchmark the stages of the aerial photo classification workflow on synthetic imagery so the throughput of the different engines
+(random forest, lookup table, exported forest, colour cache) and of different versions of the scripts can be compared. Everything
+is generated locally so the benchmark runs offline on a plain linux machine.
+
+A synthetic 8 bit RGB mosaic is generated with patches of the five cover classes, each drawn from a colour distribution similar to
+the digital aerial photography (dark green woody foliage, yellow green grasses, red brown bare ground, dark shadow and grey brown
+branches), and with no data edges where the flight strip does not cover the tile. Square plots and training points are placed at
+random over the mosaic. When no pickle file is given a small random forest is trained on the synthetic colours.
+
+The stages timed are;
+
+clip        : multi_clip_tool_rasterio.py clipping the plots out of the mosaic
+classify    : rgb_digital_aerial_photo_classifier.py classifying each clipped image chip (doModel)
+summarise   : apply_rgb_comb_classifier_multi.py applyModel estimating the fpc and class fractions of the image chips
+points      : points_stats_singleImage_class.py extracting the band values under the points
+mosaic      : rgb_mosaic_classifier.py classifying the whole mosaic
+
+Each stage is run --repeat times, the classify stage loads the classifier again before each run so a colour cache filled by an
+earlier run is not timed, and with --colour-cache the runs with a warm cache are reported separately as classify_warm. The best and
+median wall times and the pixels per second are written to a JSON file together
+with the versions of the libraries and the settings, for example;
+
+            {"stages": {"classify": {"seconds": [1.92, 1.88, 1.90], "best": 1.88, "median": 1.90, "pixels": 3200000, "pixels_per_second": 1702127.7}, ...}}
+
+###############################################################################################
+
+MIT License
+
+Copyright (c) 2020 Grant Staben
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+
+###############################################################################################
+
+Parameters:
+-----------
+
+workdir : str
+            directory the synthetic imagery, plots, points and classified images are written to.
+
+output : json file
+            name of the JSON file containing the benchmark results.
+
+picklefile : serilised pickle file (optional)
+            serilised random forest classifer, a small random forest is trained on the synthetic colours if not given.
+
+lut : numpy file .npy (optional)
+            precomputed rgb lookup table produced by build_rgb_lookup_table.py, used instead of the pickle file.
+
+forest : numpy file .npz (optional)
+            random forest exported by flat_forest.py, used instead of the pickle file.
+
+colour-cache : flag (optional)
+            use the colour cache.
+
+size : int
+            width and height of the synthetic mosaic in pixels.
+
+plots : int
+            number of plots clipped out of the mosaic.
+
+plotsize : int
+            width and height of each plot in pixels.
+
+points : int
+            number of training points extracted from the mosaic.
+
+workers : int
+            number of worker processes used by the summarise and mosaic stages.
+
+repeat : int
+            number of times each stage is run.
+
+stages : str
+            the stages to run, all of the stages are run by default.
+
+seed : int
+            seed of the random number generator, the same seed produces the same imagery.
+
+"""
+
+from __future__ import print_function, division
+
+import sys
+import os
+import json
+import time
+import pickle
+import platform
+import argparse
+import multiprocessing
+import numpy as np
+import pandas as pd
+import rasterio
+from rasterio.transform import from_origin
+import geopandas as gpd
+from shapely.geometry import box, Point
+
+import rgb_digital_aerial_photo_classifier as classifier
+import apply_rgb_comb_classifier_multi as batch
+import multi_clip_tool_rasterio as clipper
+import points_stats_singleImage_class as points
+import rgb_mosaic_classifier as mosaicClassifier
+
+STAGES = ['clip', 'classify', 'summarise', 'points', 'mosaic']
+
+# mean and standard deviation of the red, green and blue values of each cover class
+CLASS_COLOURS = {1: ((60, 85, 45), (15, 18, 12)),      # woody green
+                 2: ((135, 140, 80), (20, 20, 18)),    # non-woody green
+                 3: ((185, 150, 120), (25, 22, 20)),   # bare/npv
+                 4: ((30, 32, 35), (10, 10, 10)),      # shadow
+                 5: ((110, 100, 90), (18, 16, 15))}    # branch/trunk
+
+# proportion of each cover class in the synthetic imagery
+CLASS_WEIGHTS = [0.3, 0.3, 0.25, 0.1, 0.05]
+
+# 15 cm pixels in GDA94 / MGA zone 52
+PIXEL_SIZE = 0.15
+EPSG = 'EPSG:28352'
+
+
+def getCmdargs():
+    """
+    Get command line arguments
+    """
+    p = argparse.ArgumentParser()
+
+    p.add_argument("--workdir", default="./benchmark", help="Directory for the synthetic imagery and outputs (default is %(default)s)")
+
+    p.add_argument("--output", default="benchmark_results.json", help="Output JSON file of the results (default is %(default)s)")
+
+    p.add_argument("--picklefile", default=None, help="Input pickle file, a random forest is trained on the synthetic colours if not given (default is %(default)s)")
+
+    p.add_argument("--lut", default=None, help="Input rgb lookup table used instead of the pickle file (default is %(default)s)")
+
+    p.add_argument("--forest", default=None, help="Input forest exported by flat_forest.py, used instead of the pickle file (default is %(default)s)")
+
+    p.add_argument("--colour-cache", dest="colourcache", action="store_true", default=False, help="Use the colour cache")
+
+    p.add_argument("--size", type=int, default=4000, help="Width and height of the synthetic mosaic in pixels (default is %(default)s)")
+
+    p.add_argument("--plots", type=int, default=20, help="Number of plots clipped from the mosaic (default is %(default)s)")
+
+    p.add_argument("--plotsize", type=int, default=400, help="Width and height of each plot in pixels (default is %(default)s)")
+
+    p.add_argument("--points", type=int, default=5000, help="Number of points extracted from the mosaic (default is %(default)s)")
+
+    p.add_argument("--workers", type=int, default=1, help="Number of worker processes for the summarise and mosaic stages (default is %(default)s)")
+
+    p.add_argument("--repeat", type=int, default=3, help="Number of times each stage is run (default is %(default)s)")
+
+    p.add_argument("--stages", nargs="+", default=STAGES, choices=STAGES, help="Stages to run (default is all)")
+
+    p.add_argument("--seed", type=int, default=20200615, help="Seed of the random number generator (default is %(default)s)")
+
+    cmdargs = p.parse_args()
+
+    return cmdargs
+
+
+def syntheticColours(rng, classes):
+    """
+    draw an 8 bit rgb colour for each pixel from the colour distribution of its
+    cover class, 0 is kept free for the no data value
+    """
+    rgb = np.zeros((3,) + classes.shape, dtype=np.uint8)
+
+    for classValue, (mean, std) in CLASS_COLOURS.items():
+        inClass = (classes == classValue)
+        numPixels = int(inClass.sum())
+        for band in range(3):
+            values = rng.normal(mean[band], std[band], numPixels)
+            rgb[band][inClass] = np.clip(np.round(values), 1, 255).astype(np.uint8)
+
+    return rgb
+
+
+def syntheticClasses(rng, height, width, patch=16):
+    """
+    patches of the cover classes, a coarse random grid of classes is
+    enlarged so neighbouring pixels share a class as in real imagery
+    """
+    coarse = rng.choice(np.arange(1, 6), size=((height + patch - 1) // patch, (width + patch - 1) // patch), p=CLASS_WEIGHTS)
+
+    return np.repeat(np.repeat(coarse, patch, axis=0), patch, axis=1)[:height, :width].astype(np.uint8)
+
+
+def writeMosaic(rng, mosaic, size):
+    """
+    write a synthetic tiled 8 bit rgb mosaic, the corners of the tile outside
+    a rotated flight strip are set to the no data value of 0
+    """
+    profile = {'driver': 'GTiff', 'width': size, 'height': size, 'count': 3, 'dtype': 'uint8', 'crs': EPSG,
+               'transform': from_origin(700000, 8600000, PIXEL_SIZE, PIXEL_SIZE), 'nodata': 0,
+               'tiled': True, 'blockxsize': 256, 'blockysize': 256}
+
+    rows = np.arange(size)[:, np.newaxis]
+    cols = np.arange(size)[np.newaxis, :]
+    edge = size // 8
+
+    with rasterio.open(mosaic, 'w', **profile) as dataset:
+        # write in strips so the memory used does not depend on the size of the mosaic
+        for start in range(0, size, 1024):
+            stop = min(start + 1024, size)
+            classes = syntheticClasses(rng, stop - start, size)
+            rgb = syntheticColours(rng, classes)
+
+            # the flight strip is rotated against the tile leaving triangles of no data in two corners
+            stripRows = rows[start:stop]
+            nodata = (cols < edge - stripRows * edge // size) | (cols >= size - stripRows * edge // size)
+            rgb[:, nodata] = 0
+
+            dataset.write(rgb, window=rasterio.windows.Window(0, start, size, stop - start))
+
+    return profile
+
+
+def trainForest(rng, picklefile, numPixels=20000):
+    """
+    train a small random forest on the synthetic colours of each cover class
+    """
+    from sklearn.ensemble import RandomForestClassifier
+
+    classes = rng.choice(np.arange(1, 6), size=(1, numPixels), p=CLASS_WEIGHTS).astype(np.uint8)
+    rgb = syntheticColours(rng, classes)
+
+    rf = RandomForestClassifier(n_estimators=50, n_jobs=-1, random_state=0)
+    rf.fit(rgb[:, 0, :].T.astype(np.float32), classes[0])
+
+    with open(picklefile, 'wb') as f:
+        pickle.dump(rf, f, protocol=2)
+
+
+def writePlots(rng, plotfile, profile, numPlots, plotSize):
+    """
+    write square plots placed at random over the mosaic with an id field
+    """
+    transform = profile['transform']
+    side = plotSize * PIXEL_SIZE
+
+    geometries = []
+    for row, col in zip(rng.integers(0, profile['height'] - plotSize, numPlots), rng.integers(0, profile['width'] - plotSize, numPlots)):
+        x, y = transform * (int(col), int(row))
+        geometries.append(box(x, y - side, x + side, y))
+
+    plots = gpd.GeoDataFrame({'id': ['plot%04d' % i for i in range(numPlots)]}, geometry=geometries, crs=EPSG)
+    plots.to_file(plotfile, driver='GPKG')
+
+
+def writePoints(rng, pointfile, profile, numPoints):
+    """
+    write training points placed at random over the mosaic with a uid and class field
+    """
+    left, top = profile['transform'] * (0, 0)
+    right, bottom = profile['transform'] * (profile['width'], profile['height'])
+
+    xs = rng.uniform(left, right, numPoints)
+    ys = rng.uniform(bottom, top, numPoints)
+
+    pts = gpd.GeoDataFrame({'uid': np.arange(numPoints), 'class': rng.integers(1, 6, numPoints)},
+                           geometry=[Point(x, y) for x, y in zip(xs, ys)], crs=EPSG)
+    pts.to_file(pointfile)
+
+
+def timeStage(func, repeat, setup=None):
+    """
+    run a stage repeat times and return the wall time of each run and the
+    value returned by the last run, setup is run before each run and is not
+    included in the wall time
+    """
+    seconds = []
+    value = None
+    for i in range(repeat):
+        if setup is not None:
+            setup()
+        start = time.time()
+        value = func()
+        seconds.append(time.time() - start)
+
+    return seconds, value
+
+
+def stageResult(seconds, pixels):
+    """
+    summary of the wall times of a stage
+    """
+    best = min(seconds)
+
+    return {'seconds': seconds, 'best': best, 'median': float(np.median(seconds)),
+            'pixels': int(pixels), 'pixels_per_second': pixels / max(best, 1e-9)}
+
+
+def environment():
+    """
+    the versions of python and of the libraries used by the stages
+    """
+    import sklearn
+
+    versions = {'python': platform.python_version(), 'numpy': np.__version__, 'pandas': pd.__version__,
+                'rasterio': rasterio.__version__, 'gdal': rasterio.__gdal_version__, 'scikit-learn': sklearn.__version__,
+                'geopandas': gpd.__version__}
+
+    return {'platform': platform.platform(), 'machine': platform.machine(), 'cpu_count': multiprocessing.cpu_count(),
+            'versions': versions}
+
+
+def runBenchmark(cmdargs):
+    """
+    generate the synthetic data and time each of the stages
+    """
+    rng = np.random.default_rng(cmdargs.seed)
+
+    workdir = cmdargs.workdir
+    chipdir = os.path.join(workdir, 'chips')
+    for directory in [workdir, chipdir]:
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    mosaic = os.path.join(workdir, 'synthetic_mosaic.tif')
+    plotfile = os.path.join(workdir, 'synthetic_plots.gpkg')
+    pointfile = os.path.join(workdir, 'synthetic_points.shp')
+
+    profile = writeMosaic(rng, mosaic, cmdargs.size)
+    writePlots(rng, plotfile, profile, cmdargs.plots, cmdargs.plotsize)
+    writePoints(rng, pointfile, profile, cmdargs.points)
+
+    picklefile = cmdargs.picklefile
+    if picklefile is None and cmdargs.lut is None and cmdargs.forest is None:
+        picklefile = os.path.join(workdir, 'synthetic_rfc.p')
+        trainForest(rng, picklefile)
+
+    if cmdargs.lut is not None:
+        engine = 'lut'
+    elif cmdargs.forest is not None:
+        engine = 'forest'
+    else:
+        engine = 'rf'
+    if cmdargs.colourcache and engine != 'lut':
+        engine += '+cache'
+
+    stages = {}
+    numPixels = cmdargs.size * cmdargs.size
+
+    # the chips are clipped once before the later stages even when the clip stage is not timed
+    chips = lambda: clipper.clipVector(plotfile, 'id', [mosaic], chipdir)
+    if 'clip' in cmdargs.stages:
+        seconds, value = timeStage(chips, cmdargs.repeat)
+    else:
+        chips()
+    chipNames = sorted(name for name in os.listdir(chipdir) if name.endswith('_synthetic_mosaic.tif'))
+    chipPixels = 0
+    for name in chipNames:
+        with rasterio.open(os.path.join(chipdir, name)) as dataset:
+            chipPixels += dataset.width * dataset.height
+    if 'clip' in cmdargs.stages:
+        stages['clip'] = stageResult(seconds, chipPixels)
+
+    imglist = os.path.join(workdir, 'synthetic_chips.csv')
+    pd.DataFrame(chipNames).to_csv(imglist, header=False, index=False)
+
+    if 'classify' in cmdargs.stages:
+        state = {}
+
+        # each run starts from a freshly loaded classifier so a colour cache filled by an earlier run is not timed
+        def loadModel():
+            state['model'] = classifier.loadModel(picklefile, cmdargs.lut, cmdargs.colourcache, cmdargs.forest)
+
+        def classifyChips():
+            for name in chipNames:
+                path = os.path.join(chipdir, name)
+                classifier.classify_chip(path, state['model'], os.path.join(workdir, 'classified_' + name))
+
+        seconds, value = timeStage(classifyChips, cmdargs.repeat, setup=loadModel)
+        stages['classify'] = stageResult(seconds, chipPixels)
+
+        # the colour cache of the last run already holds the colours of the chips, the warm runs are reported separately
+        if state['model'].colourCache is not None:
+            seconds, value = timeStage(classifyChips, cmdargs.repeat)
+            stages['classify_warm'] = stageResult(seconds, chipPixels)
+
+    if 'summarise' in cmdargs.stages:
+        def summarise():
+            return batch.applyModel(imglist, chipdir + os.sep, picklefile, cmdargs.lut, workers=cmdargs.workers,
+                                    writeRaster=False, colourCache=cmdargs.colourcache, forest=cmdargs.forest)
+
+        seconds, results = timeStage(summarise, cmdargs.repeat)
+        stages['summarise'] = stageResult(seconds, chipPixels)
+        stages['summarise']['failed'] = sum(result['status'] != 'ok' for result in results)
+
+    if 'points' in cmdargs.stages:
+        seconds, value = timeStage(lambda: points.extractPoints(mosaic, 0, pointfile, 'uid'), cmdargs.repeat)
+        # the pixels of the points stage are the number of points extracted
+        stages['points'] = stageResult(seconds, cmdargs.points)
+
+    if 'mosaic' in cmdargs.stages:
+        outfile = os.path.join(workdir, 'synthetic_mosaic_rgb_comb_class.tif')
+
+        def classifyMosaic():
+            return mosaicClassifier.classifyMosaic(mosaic, outfile, picklefile, cmdargs.lut, max(cmdargs.workers, 1),
+                                                   colourCache=cmdargs.colourcache, forest=cmdargs.forest)
+
+        seconds, value = timeStage(classifyMosaic, cmdargs.repeat)
+        stages['mosaic'] = stageResult(seconds, numPixels)
+
+    settings = {'engine': engine, 'size': cmdargs.size, 'plots': cmdargs.plots, 'plotsize': cmdargs.plotsize,
+                'points': cmdargs.points, 'workers': cmdargs.workers, 'repeat': cmdargs.repeat, 'seed': cmdargs.seed,
+                'picklefile': picklefile, 'lut': cmdargs.lut, 'forest': cmdargs.forest, 'colour_cache': cmdargs.colourcache}
+
+    return {'created': time.strftime('%Y-%m-%dT%H:%M:%S'), 'environment': environment(), 'settings': settings, 'stages': stages}
+
+
+def main():
+    """
+    Main routine
+
+    """
+    cmdargs = getCmdargs()
+
+    results = runBenchmark(cmdargs)
+
+    with open(cmdargs.output, 'w') as f:
+        json.dump(results, f, indent=2)
+
+    for name, stage in results['stages'].items():
+        print ('%-13s best %8.3f s  median %8.3f s  %12.0f pixels/sec' % (name, stage['best'], stage['median'], stage['pixels_per_second']))
+
+    print (cmdargs.output + ' complete')
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,208 @@
+#!/usr/bin/env python
+
+"""
+This code precomputes the random forest classification for every possible 8 bit red, green and blue combination and saves the
+result as a lookup table. As the classifier only uses the three 8 bit bands of the digital aerial photography there are only
+256 x 256 x 256 = 16,777,216 possible inputs, so the classified value of every pixel can be read straight out of the table.
+
+The lookup table is a flat uint8 numpy array (.npy, 16 MB) indexed by the packed 24 bit pixel value (red << 16 | green << 8 | blue)
+and is loaded memory mapped by "rgb_digital_aerial_photo_classifier.py" when run with the --lut option.
+
+The five classes represent cover for;
+
+Class               Pixel value            Description
+------------------------------------------------------------------------------------------
+Woody green:          1                    Green leaf for all woody vegetation
+Non-woody green:      2                    Green leaf from all non-woody vegetation
+Bare/npv vegetation:  3                    Bare ground and senescent vegetation (woody and non-woody)
+Shadow:               4                    Shadow
+Branch/trunk:         5                    Branches and trunks of woody vegetation
+------------------------------------------------------------------------------------------
+
+The lookup table needs to be rebuilt each time the pickle file is re-produced using "train_class/aerial_photo_classifier_pickle_file.py".
+
+###############################################################################################
+
+MIT License
+
+Copyright (c) 2020 Grant Staben
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+
+###############################################################################################
+
+Parameters:
+-----------
+
+picklefile : serilised pickle file
+            serilised random forest classifer using pickle library. The serilised pickle file is produced from the script aerial_photo_classifier_pickle_file.py.
+
+lutfile : numpy file .npy
+            is a string containing the directory path and the name of the output lookup table.
+
+checkimage : raster image file .tif (optional)
+            8 bit digital aerial photography used to check the lookup table against the random forest pixel for pixel.
+
+"""
+
+from __future__ import print_function, division
+
+import sys
+import argparse
+import pickle as pickle
+import numpy as np
+
+# total number of 24 bit rgb combinations
+NUM_RGB = 256 ** 3
+
+
+def getCmdargs():
+    """
+    Get command line arguments
+    """
+    p = argparse.ArgumentParser()
+
+    p.add_argument("--picklefile", default="rfc_cpickle_20200615.p", help="Input pickle file (default is %(default)s)")
+
+    p.add_argument("--lutfile", help="Name of the output lookup table (.npy)")
+
+    p.add_argument("--chunk", type=int, default=2 ** 20, help="Number of rgb combinations classified per call to the classifier (default is %(default)s)")
+
+    p.add_argument("--checkimage", default=None, help="8 bit image used to check the lookup table against the classifier pixel for pixel (default is %(default)s)")
+
+    p.add_argument("--nocheck", action="store_true", default=False, help="Skip checking the lookup table against the classifier")
+
+    cmdargs = p.parse_args()
+
+    if cmdargs.lutfile is None:
+        p.print_help()
+        sys.exit()
+
+    return cmdargs
+
+
+def packRGB(red, green, blue):
+    """
+    pack the 8 bit red, green and blue values into a single
+    24 bit key (red << 16 | green << 8 | blue)
+    """
+    return (red.astype(np.uint32) << 16) | (green.astype(np.uint32) << 8) | blue.astype(np.uint32)
+
+
+def unpackRGB(keys):
+    """
+    convert packed 24 bit keys (red << 16 | green << 8 | blue) back
+    to a (n, 3) array of red, green and blue values
+    """
+    keys = np.asarray(keys, dtype=np.uint32)
+
+    return np.vstack([(keys >> 16) & 255, (keys >> 8) & 255, keys & 255]).T.astype(np.uint8)
+
+
+def buildLookupTable(rf, chunk=2 ** 20):
+    """
+    run the random forest over every rgb combination and return the
+    predicted classes as a flat uint8 array indexed by the packed rgb value
+    """
+    if not np.all((rf.classes_ >= 0) & (rf.classes_ <= 255)):
+        raise ValueError("classifier classes do not fit in an 8 bit lookup table")
+
+    lut = np.zeros(NUM_RGB, dtype=np.uint8)
+
+    for start in range(0, NUM_RGB, chunk):
+        keys = np.arange(start, min(start + chunk, NUM_RGB), dtype=np.uint32)
+
+        # the classifier was trained on the float values of the bands, as used in doModel
+        allVars = unpackRGB(keys).astype(np.float32)
+
+        lut[start:start + keys.shape[0]] = rf.predict(allVars)
+
+        print ('classified ' + str(start + keys.shape[0]) + ' of ' + str(NUM_RGB) + ' rgb combinations')
+
+    return lut
+
+
+def loadLookupTable(lutfile):
+    """
+    memory map the lookup table produced by this script
+    """
+    lut = np.load(lutfile, mmap_mode='r')
+
+    if lut.shape != (NUM_RGB,) or lut.dtype != np.uint8:
+        raise ValueError("%s is not a 24 bit rgb lookup table" % lutfile)
+
+    return lut
+
+
+def checkLookupTable(lut, rf, checkimage=None, nsample=2 ** 20, refnull=0):
+    """
+    compare the lookup table against the random forest and return the number
+    of pixels that differ. If an image is given every non-null pixel in the image
+    is checked, otherwise a random sample of the rgb combinations is checked.
+    """
+    if checkimage is not None:
+        import rasterio
+
+        with rasterio.open(checkimage) as dataset:
+            image = dataset.read([1, 2, 3])
+
+        if image.dtype != np.uint8:
+            raise ValueError("lookup table can only be checked against 8 bit imagery")
+
+        nonNullmask = (image[0] != refnull)
+        keys = packRGB(image[0][nonNullmask], image[1][nonNullmask], image[2][nonNullmask])
+    else:
+        keys = np.random.randint(0, NUM_RGB, size=nsample).astype(np.uint32)
+
+    if keys.shape[0] == 0:
+        return 0
+
+    expected = rf.predict(unpackRGB(keys).astype(np.float32))
+
+    mismatch = np.count_nonzero(lut[keys] != expected)
+    print ('checked ' + str(keys.shape[0]) + ' pixels, ' + str(mismatch) + ' differ from the classifier')
+
+    return mismatch
+
+
+def main():
+    """
+    Main routine
+
+    """
+    cmdargs = getCmdargs()
+
+    rf = pickle.load(open(cmdargs.picklefile, 'rb'))
+
+    lut = buildLookupTable(rf, cmdargs.chunk)
+
+    # save the table as a plain .npy file so it can be memory mapped by the classifier
+    np.save(cmdargs.lutfile, lut)
+    print (cmdargs.lutfile + ' complete')
+
+    if not cmdargs.nocheck:
+        lut = loadLookupTable(cmdargs.lutfile)
+        mismatch = checkLookupTable(lut, rf, cmdargs.checkimage)
+
+        if mismatch > 0:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
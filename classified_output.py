@@ -0,0 +1,239 @@
+#!/usr/bin/env python
+
+"""
+Output options for the classified images produced by "rgb_digital_aerial_photo_classifier.py" and "rgb_mosaic_classifier.py". The
+classified image can be written as a tiled GeoTIFF compressed with DEFLATE, ZSTD or LZW and a horizontal predictor, with a colour
+table for the five classes and internal overviews built with mode resampling, so the most common class is kept at each zoom level
+rather than an arbitrary pixel. With --cog the image is then rewritten as a Cloud Optimized GeoTIFF (GDAL 3.1 or later) using the
+overviews already built. The size of the output and the time taken to write it are reported.
+
+Run on its own this script converts a classified image that has already been written.
+
+The five classes represent cover for;
+
+Class               Pixel value            Colour
+------------------------------------------------------------------------------------------
+Woody green:          1                    dark green
+Non-woody green:      2                    light green
+Bare/npv vegetation:  3                    tan
+Shadow:               4                    dark grey
+Branch/trunk:         5                    brown
+------------------------------------------------------------------------------------------
+
+###############################################################################################
+
+MIT License
+
+Copyright (c) 2020 Grant Staben
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+
+###############################################################################################
+
+Parameters:
+-----------
+
+infile : raster image file .tif
+            classified image to convert.
+
+outfile : raster image file .tif
+            name of the converted classified image.
+
+compress : str
+            compression of the output, DEFLATE, ZSTD, LZW or NONE.
+
+predictor : int
+            1 for no predictor or 2 for the horizontal differencing predictor.
+
+level : int (optional)
+            DEFLATE or ZSTD compression level.
+
+blocksize : int
+            width and height of the tiles of the output.
+
+cog : flag (optional)
+            write the output as a Cloud Optimized GeoTIFF.
+
+"""
+
+from __future__ import print_function, division
+
+import sys
+import os
+import time
+import argparse
+import rasterio
+import rasterio.shutil
+from rasterio.enums import Resampling
+
+# colour of each class value, the null pixels (0) are transparent
+CLASS_COLOURS = {0: (0, 0, 0, 0),
+                 1: (0, 100, 0, 255),
+                 2: (150, 220, 80, 255),
+                 3: (210, 180, 140, 255),
+                 4: (60, 60, 60, 255),
+                 5: (139, 69, 19, 255)}
+
+COMPRESSION = ['DEFLATE', 'ZSTD', 'LZW', 'NONE']
+
+
+def getCmdargs():
+    """
+    Get command line arguments
+    """
+    p = argparse.ArgumentParser()
+
+    p.add_argument("--infile", help="Input classified image")
+
+    p.add_argument("--outfile", help="Name of the output classified image")
+
+    addOutputArgs(p)
+
+    cmdargs = p.parse_args()
+
+    if cmdargs.infile is None or cmdargs.outfile is None:
+        p.print_help()
+        sys.exit()
+
+    return cmdargs
+
+
+def addOutputArgs(p, compress="DEFLATE"):
+    """
+    add the output options to the command line arguments of a script
+    """
+    p.add_argument("--compress", default=compress, type=str.upper, choices=COMPRESSION, help="Compression of the classified image (default is %(default)s)")
+
+    p.add_argument("--predictor", type=int, default=2, choices=[1, 2], help="Predictor used with the compression, 2 is horizontal differencing (default is %(default)s)")
+
+    p.add_argument("--level", type=int, default=None, help="DEFLATE or ZSTD compression level (default is the GDAL default)")
+
+    p.add_argument("--blocksize", type=int, default=512, help="Width and height of the tiles of the classified image (default is %(default)s)")
+
+    p.add_argument("--cog", action="store_true", default=False, help="Write the classified image as a Cloud Optimized GeoTIFF with a colour table and mode overviews")
+
+
+def creationOptions(compress="DEFLATE", predictor=2, level=None, blocksize=512):
+    """
+    GDAL creation options for a tiled, compressed GeoTIFF
+    """
+    options = {'TILED': 'YES', 'BLOCKXSIZE': str(blocksize), 'BLOCKYSIZE': str(blocksize),
+               'COMPRESS': compress, 'BIGTIFF': 'IF_SAFER'}
+
+    if compress != 'NONE':
+        options['PREDICTOR'] = str(predictor)
+    if level is not None and compress == 'DEFLATE':
+        options['ZLEVEL'] = str(level)
+    if level is not None and compress == 'ZSTD':
+        options['ZSTD_LEVEL'] = str(level)
+
+    return options
+
+
+def overviewFactors(width, height, blocksize=512):
+    """
+    the overview levels needed until the whole image fits in a single tile
+    """
+    factors = []
+    factor = 2
+    while max(width, height) / (factor // 2) > blocksize:
+        factors.append(factor)
+        factor *= 2
+
+    return factors
+
+
+def finishOutput(outfile, compress="DEFLATE", predictor=2, level=None, blocksize=512, cog=False, rewrite=False):
+    """
+    add the class colour table and the mode resampled overviews to a classified
+    image, then rewrite it as a Cloud Optimized GeoTIFF or, when rewrite is True,
+    as a compressed tiled GeoTIFF. Returns the time taken in seconds
+    """
+    start = time.time()
+
+    with rasterio.open(outfile, 'r+') as dst:
+        dst.write_colormap(1, CLASS_COLOURS)
+
+        factors = overviewFactors(dst.width, dst.height, blocksize)
+        if len(factors) > 0:
+            dst.build_overviews(factors, Resampling.mode)
+            dst.update_tags(ns='rio_overview', resampling='mode')
+
+    if cog or rewrite:
+        # the image is copied so the overviews built above are reused rather than resampled again
+        tmpfile = outfile + '.tmp.tif'
+        os.replace(outfile, tmpfile)
+
+        try:
+            if cog:
+                options = {'COMPRESS': compress, 'BLOCKSIZE': str(blocksize), 'OVERVIEWS': 'FORCE_USE_EXISTING',
+                           'BIGTIFF': 'IF_SAFER'}
+                if compress != 'NONE':
+                    options['PREDICTOR'] = 'YES' if predictor == 2 else 'NO'
+                if level is not None and compress in ['DEFLATE', 'ZSTD']:
+                    options['LEVEL'] = str(level)
+                rasterio.shutil.copy(tmpfile, outfile, driver='COG', **options)
+            else:
+                options = creationOptions(compress, predictor, level, blocksize)
+                rasterio.shutil.copy(tmpfile, outfile, driver='GTiff', COPY_SRC_OVERVIEWS='YES', **options)
+        except Exception:
+            os.replace(tmpfile, outfile)
+            raise
+
+        os.remove(tmpfile)
+
+    return time.time() - start
+
+
+def outputReport(outfile, writeSeconds, finishSeconds):
+    """
+    print the size of the classified image and the rate it was written at
+    """
+    with rasterio.open(outfile) as dataset:
+        numPixels = dataset.width * dataset.height
+
+    size = os.path.getsize(outfile)
+    seconds = writeSeconds + finishSeconds
+
+    print ('%s: %.1f MB, %.3f bytes per pixel (%.1f%% of uncompressed), written at %.0f pixels/sec (%.1f s classify and write, %.1f s colour table, overviews and copy)' %
+           (outfile, size / 2 ** 20, size / max(numPixels, 1), 100 * size / max(numPixels, 1), numPixels / max(seconds, 1e-9),
+            writeSeconds, finishSeconds))
+
+    return {'bytes': size, 'pixels': numPixels, 'seconds': seconds}
+
+
+def main():
+    """
+    Main routine
+
+    """
+    cmdargs = getCmdargs()
+
+    start = time.time()
+    rasterio.shutil.copy(cmdargs.infile, cmdargs.outfile, driver='GTiff',
+                         **creationOptions(cmdargs.compress, cmdargs.predictor, cmdargs.level, cmdargs.blocksize))
+    writeSeconds = time.time() - start
+
+    finishSeconds = finishOutput(cmdargs.outfile, cmdargs.compress, cmdargs.predictor, cmdargs.level, cmdargs.blocksize, cmdargs.cog)
+
+    outputReport(cmdargs.outfile, writeSeconds, finishSeconds)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,278 @@
+#!/usr/bin/env python
+
+"""
+Long running local service that keeps the random forest classifier and a pool of worker processes loaded so that repeated small
+jobs (e.g. from the cells of Aerial_photo_class_workflow.ipynb) do not pay the cost of importing the libraries and unpickling the
+classifier each time.
+
+The service listens on a Unix socket or on a localhost TCP port. Each request is a single line of JSON and is answered with a single
+line of JSON, for example;
+
+            {"chips": ["C:/DATA/todd/example/shp/grd_50m4_ID01.tif"], "raster": false}
+
+returns the class fractions and pixel counts for each image chip, and the path of the classified image when "raster" is true;
+
+            {"status": "ok", "results": [{"site": "...", "woody_green": 35.2, "non_woody_green": ..., "nonnull": 435600, "outfile": null, "status": "ok"}]}
+
+The requests are queued and at most --max-requests are classified at the same time, a request that arrives when the queue is full
+is answered with {"status": "busy"}. A request of {"command": "ping"} returns the state of the service and {"command": "shutdown"}
+stops it. The client is built into apply_rgb_comb_classifier_multi.py (--daemon).
+
+###############################################################################################
+
+MIT License
+
+Copyright (c) 2020 Grant Staben
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+
+###############################################################################################
+
+Parameters:
+-----------
+
+socket : str
+            path of the Unix socket to listen on, or host:port to listen on a localhost TCP port. The default is
+            ./aerial_photo_classifier.sock, or 127.0.0.1:8765 on windows where Unix sockets are not available. The host
+            has to be a loopback address (localhost, 127.0.0.1 or [::1]), the service has no authentication so it is 
+            never exposed to other machines.
+
+picklefile : serilised pickle file
+            serilised random forest classifer, loaded once by each worker process.
+
+lut : numpy file .npy (optional)
+            precomputed rgb lookup table produced by build_rgb_lookup_table.py, used instead of the pickle file.
+
+forest : numpy file .npz (optional)
+            random forest exported by flat_forest.py, used instead of the pickle file.
+
+workers : int
+            number of worker processes classifying the image chips.
+
+max-requests : int
+            number of requests classified at the same time.
+
+queue : int
+            number of requests that can wait for a free slot before new requests are turned away.
+
+"""
+
+from __future__ import print_function, division
+
+import sys
+import os
+import json
+import socket
+import argparse
+import threading
+import multiprocessing
+import socketserver
+import apply_rgb_comb_classifier_multi as batch
+
+
+# Unix sockets are not available on windows, where the service listens on a localhost port by default
+if hasattr(socketserver, 'UnixStreamServer'):
+    DEFAULT_SOCKET = './aerial_photo_classifier.sock'
+else:
+    DEFAULT_SOCKET = '127.0.0.1:8765'
+
+
+def getCmdargs():
+    """
+    Get command line arguments
+    """
+    p = argparse.ArgumentParser()
+
+    p.add_argument("--socket", default=DEFAULT_SOCKET, help="Unix socket path or host:port to listen on (default is %(default)s)")
+
+    p.add_argument("--picklefile", default="rfc_cpickle_20200615.p", help="Input pickle file (default is %(default)s)")
+
+    p.add_argument("--lut", default=None, help="Input rgb lookup table used instead of the pickle file (default is %(default)s)")
+
+    p.add_argument("--forest", default=None, help="Input forest exported by flat_forest.py, used instead of the pickle file (default is %(default)s)")
+
+    p.add_argument("--colour-cache", dest="colourcache", action="store_true", default=False, help="Cache the class of each rgb colour in each worker")
+
+    p.add_argument("--workers", type=int, default=multiprocessing.cpu_count(), help="Number of worker processes (default is %(default)s)")
+
+    p.add_argument("--max-requests", dest="maxrequests", type=int, default=4, help="Number of requests classified at the same time (default is %(default)s)")
+
+    p.add_argument("--queue", type=int, default=32, help="Number of requests waiting before new requests are turned away (default is %(default)s)")
+
+    cmdargs = p.parse_args()
+
+    # the service is only reachable from this machine
+    try:
+        family, sockaddr = batch.parseAddress(cmdargs.socket)
+    except ValueError as err:
+        p.error(str(err))
+
+    if family == getattr(socket, 'AF_UNIX', None) and not hasattr(socketserver, 'UnixStreamServer'):
+        p.error('Unix sockets are not available on this platform, give a localhost:port address to --socket')
+
+    return cmdargs
+
+
+def daemonChip(task):
+    """
+    classify an image chip in a worker process of the service
+    """
+    path, writeRaster = task
+
+    settings = dict(batch.workerState['settings'], directory='', writeRaster=writeRaster)
+
+    return batch.processChip(path, batch.workerState.get('model'), settings)
+
+
+class ClassifierService(object):
+    """
+    the warm worker pool and the limits on the requests being classified
+    """
+    def __init__(self, settings, workers, maxRequests, queueSize):
+        self.pool = multiprocessing.Pool(workers, initializer=batch.initWorker, initargs=(settings, True))
+        self.slots = threading.BoundedSemaphore(maxRequests)
+        self.maxWaiting = maxRequests + queueSize
+        self.waiting = 0
+        self.completed = 0
+        self.lock = threading.Lock()
+
+    def classify(self, chips, writeRaster):
+        """
+        classify a list of image chips, None is returned when the queue is full
+        """
+        with self.lock:
+            if self.waiting >= self.maxWaiting:
+                return None
+            self.waiting += 1
+
+        try:
+            with self.slots:
+                results = list(self.pool.imap(daemonChip, [(path, writeRaster) for path in chips], chunksize=1))
+        finally:
+            with self.lock:
+                self.waiting -= 1
+                self.completed += 1
+
+        return results
+
+    def state(self):
+        """
+        the number of requests in the service
+        """
+        with self.lock:
+            return {'status': 'ok', 'requests': self.waiting, 'completed': self.completed}
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+
+
+class RequestHandler(socketserver.StreamRequestHandler):
+    """
+    answer each line of JSON sent on the connection with a line of JSON
+    """
+    def handle(self):
+        service = self.server.service
+
+        for line in self.rfile:
+            if line.strip() == b'':
+                continue
+
+            try:
+                request = json.loads(line.decode('utf-8'))
+                command = request.get('command', 'classify')
+
+                if command == 'ping':
+                    response = service.state()
+                elif command == 'shutdown':
+                    response = {'status': 'ok'}
+                    threading.Thread(target=self.server.shutdown).start()
+                elif command == 'classify':
+                    results = service.classify([str(path) for path in request['chips']], bool(request.get('raster', False)))
+                    if results is None:
+                        response = {'status': 'busy', 'error': 'the request queue is full'}
+                    else:
+                        response = {'status': 'ok', 'results': results}
+                else:
+                    response = {'status': 'error', 'error': 'unknown command %s' % command}
+            except Exception as err:
+                response = {'status': 'error', 'error': str(err)}
+
+            self.wfile.write((json.dumps(response) + '\n').encode('utf-8'))
+            self.wfile.flush()
+
+
+# Unix sockets are not available on windows, a localhost port is used instead
+if hasattr(socketserver, 'UnixStreamServer'):
+    class UnixClassifierServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+        daemon_threads = True
+
+
+class TCPClassifierServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class TCP6ClassifierServer(TCPClassifierServer):
+    address_family = socket.AF_INET6
+
+
+def main():
+    """
+    Main routine
+
+    """
+    cmdargs = getCmdargs()
+
+    settings = {'directory': '', 'picklefile': cmdargs.picklefile, 'lut': cmdargs.lut,
+                'useSubprocess': False, 'writeRaster': False, 'colourCache': cmdargs.colourcache,
+                'forest': cmdargs.forest}
+
+    # load the classifier in this process so the forked workers share it copy-on-write
+    batch.workerState['model'] = batch.classifier.loadModel(cmdargs.picklefile, cmdargs.lut, cmdargs.colourcache, cmdargs.forest)
+
+    service = ClassifierService(settings, cmdargs.workers, cmdargs.maxrequests, cmdargs.queue)
+
+    family, sockaddr = batch.parseAddress(cmdargs.socket)
+    if family == socket.AF_UNIX:
+        # remove the socket left behind by a previous service
+        if os.path.exists(sockaddr):
+            os.remove(sockaddr)
+        server = UnixClassifierServer(sockaddr, RequestHandler)
+    elif family == socket.AF_INET6:
+        server = TCP6ClassifierServer(sockaddr, RequestHandler)
+    else:
+        server = TCPClassifierServer(sockaddr, RequestHandler)
+
+    server.service = service
+    print ('classifier service listening on ' + cmdargs.socket)
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.close()
+        if family == socket.AF_UNIX and os.path.exists(sockaddr):
+            os.remove(sockaddr)
+
+
+if __name__ == "__main__":
+    main()
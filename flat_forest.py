@@ -0,0 +1,294 @@
+#!/usr/bin/env python
+
+"""
+This code exports the serialised random forest classifier to a compact set of plain numpy arrays (.npz) and predicts from those
+arrays without importing scikit-learn. This removes the dependency on the scikit-learn version (0.21.3) used to produce the pickle
+file, the exported forest can be loaded by any version of numpy.
+
+All of the trees are flattened into a single set of arrays over the split nodes;
+
+feature      : int8     band used by each split node
+threshold    : uint8    pixels with a value <= threshold go to the left child
+children     : int32    left and right child of split node i stored at 2i and 2i+1, a split node index or ~leaf for a leaf
+leaf_proba   : float64  class probabilities of each leaf
+roots        : int32    root of each tree, a split node index or ~leaf
+depth        : int32    depth of each tree
+classes      : int64    class values
+
+As the pixel values are 8 bit integers a split x <= threshold is the same as x <= floor(threshold), so the thresholds are stored
+as uint8 and the pixels are compared without a float32 copy. The class probabilities of the leaves are kept as float64 and summed
+over the trees in the same order as scikit-learn so the predictions are identical to rf.predict.
+
+The .npz file is written uncompressed so the arrays can be memory mapped straight out of the file when the forest is loaded.
+
+###############################################################################################
+
+MIT License
+
+Copyright (c) 2020 Grant Staben
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+
+###############################################################################################
+
+Parameters:
+-----------
+
+picklefile : serilised pickle file
+            serilised random forest classifer using pickle library. The serilised pickle file is produced from the script aerial_photo_classifier_pickle_file.py.
+
+forestfile : numpy file .npz
+            is a string containing the directory path and the name of the exported forest.
+
+nsample : int
+            number of random rgb combinations used to check the exported forest against the random forest, 0 checks all 16.7M.
+
+"""
+
+from __future__ import print_function, division
+
+import sys
+import zipfile
+import argparse
+import pickle as pickle
+import numpy as np
+
+# the arrays saved in the .npz file
+FOREST_ARRAYS = ['feature', 'threshold', 'children', 'leaf_proba', 'roots', 'depth', 'classes']
+
+
+def getCmdargs():
+    """
+    Get command line arguments
+    """
+    p = argparse.ArgumentParser()
+
+    p.add_argument("--picklefile", default="rfc_cpickle_20200615.p", help="Input pickle file (default is %(default)s)")
+
+    p.add_argument("--forestfile", help="Name of the exported forest (.npz)")
+
+    p.add_argument("--nsample", type=int, default=2 ** 20, help="Number of random rgb combinations used to check the exported forest, 0 checks every combination (default is %(default)s)")
+
+    cmdargs = p.parse_args()
+
+    if cmdargs.forestfile is None:
+        p.print_help()
+        sys.exit()
+
+    return cmdargs
+
+
+def exportForest(rf, forestfile):
+    """
+    flatten the trees of a fitted scikit-learn random forest into plain
+    numpy arrays and save them to an uncompressed .npz file
+    """
+    features = []
+    thresholds = []
+    children = []
+    leafProbas = []
+    roots = []
+    depths = []
+
+    numSplits = 0
+    numLeaves = 0
+
+    for estimator in rf.estimators_:
+        tree = estimator.tree_
+        isLeaf = (tree.children_left == -1)
+
+        # number the split nodes and the leaves of the tree after those of the previous trees,
+        # a leaf is stored as ~leaf so it can be told apart from a split node by its sign
+        index = np.zeros(tree.node_count, dtype=np.int64)
+        index[~isLeaf] = np.arange((~isLeaf).sum()) + numSplits
+        index[isLeaf] = ~(np.arange(isLeaf.sum()) + numLeaves)
+
+        # 8 bit pixels only change branch at whole numbers, so floor the thresholds of the split nodes
+        threshold = np.floor(tree.threshold[~isLeaf])
+        if np.any(threshold < 0):
+            raise ValueError("the forest has splits below 0 and was not trained on 8 bit imagery")
+
+        # normalise the leaf values into class probabilities the same way as DecisionTreeClassifier.predict_proba
+        proba = tree.value[isLeaf][:, 0, :rf.n_classes_]
+        normalizer = proba.sum(axis=1)[:, np.newaxis]
+        normalizer[normalizer == 0.0] = 1.0
+        proba = proba / normalizer
+
+        features.append(tree.feature[~isLeaf].astype(np.int8))
+        thresholds.append(np.minimum(threshold, 255).astype(np.uint8))
+        children.append(np.vstack([index[tree.children_left[~isLeaf]], index[tree.children_right[~isLeaf]]]).T.ravel().astype(np.int32))
+        leafProbas.append(proba.astype(np.float64))
+        roots.append(index[0])
+        depths.append(tree.max_depth)
+
+        numSplits += int((~isLeaf).sum())
+        numLeaves += int(isLeaf.sum())
+
+    np.savez(forestfile, feature=np.concatenate(features), threshold=np.concatenate(thresholds),
+             children=np.concatenate(children), leaf_proba=np.concatenate(leafProbas), 
+             roots=np.array(roots, dtype=np.int32), depth=np.array(depths, dtype=np.int32), 
+             classes=np.asarray(rf.classes_).astype(np.int64))
+
+
+def mmapNpz(forestfile):
+    """
+    memory map each of the arrays stored in an uncompressed .npz file,
+    arrays that are compressed are read into memory instead
+    """
+    arrays = {}
+
+    with zipfile.ZipFile(forestfile) as archive:
+        with open(forestfile, 'rb') as f:
+            for info in archive.infolist():
+                name = info.filename[:-4]
+
+                if info.compress_type != zipfile.ZIP_STORED:
+                    arrays[name] = np.load(archive.open(info))
+                    continue
+
+                # skip the local zip header to find the start of the .npy file
+                f.seek(info.header_offset)
+                header = f.read(30)
+                nameLength = int.from_bytes(header[26:28], 'little')
+                extraLength = int.from_bytes(header[28:30], 'little')
+                f.seek(info.header_offset + 30 + nameLength + extraLength)
+
+                version = np.lib.format.read_magic(f)
+                if version == (1, 0):
+                    shape, fortranOrder, dtype = np.lib.format.read_array_header_1_0(f)
+                else:
+                    shape, fortranOrder, dtype = np.lib.format.read_array_header_2_0(f)
+
+                arrays[name] = np.memmap(forestfile, dtype=dtype, mode='r', shape=shape,
+                                         order='F' if fortranOrder else 'C', offset=f.tell())
+
+    return arrays
+
+
+class FlatForest(object):
+    """
+    random forest classifier predicting from the flattened arrays written
+    by exportForest, without scikit-learn
+    """
+    def __init__(self, arrays):
+        for name in FOREST_ARRAYS:
+            setattr(self, name, arrays[name])
+
+        self.classes_ = self.classes
+        self.n_classes_ = self.classes.shape[0]
+
+    @classmethod
+    def load(cls, forestfile):
+        """
+        load a forest written by exportForest, the arrays are memory mapped
+        """
+        # plain array views of the memory maps avoid the overhead of the memmap subclass on every index
+        return cls(dict((name, np.asarray(array)) for name, array in mmapNpz(forestfile).items()))
+
+    def predict_proba(self, X, chunk=2 ** 18):
+        """
+        mean class probabilities over the trees for the 8 bit pixel values in X (n, bands)
+        """
+        X = np.asarray(X)
+        if X.dtype != np.uint8:
+            X = X.astype(np.uint8)
+
+        proba = np.zeros((X.shape[0], self.n_classes_), dtype=np.float64)
+
+        for start in range(0, X.shape[0], chunk):
+            # the bands are flattened one after the other so a node's band and pixel give a single index
+            Xchunk = X[start:start + chunk]
+            numPixels = Xchunk.shape[0]
+            values = np.ascontiguousarray(Xchunk.T).ravel()
+            out = proba[start:start + numPixels]
+
+            # the probabilities are summed in the order of the trees, as scikit-learn does
+            for root in self.roots:
+                leaf = np.full(numPixels, root, dtype=np.int32)
+
+                # only the pixels that have not reached a leaf are moved down the tree
+                active = np.arange(numPixels)
+                node = leaf.copy()
+                while root >= 0 and active.shape[0] > 0:
+                    goRight = values[self.feature[node].astype(np.intp) * numPixels + active] > self.threshold[node]
+                    node = self.children[2 * node + goRight]
+
+                    atLeaf = node < 0
+                    if atLeaf.any():
+                        leaf[active[atLeaf]] = node[atLeaf]
+                        active = active[~atLeaf]
+                        node = node[~atLeaf]
+
+                out += self.leaf_proba[~leaf]
+
+        proba /= self.roots.shape[0]
+
+        return proba
+
+    def predict(self, X):
+        """
+        predict the class of the 8 bit pixel values in X (n, bands)
+        """
+        return self.classes.take(np.argmax(self.predict_proba(X), axis=1), axis=0)
+
+
+def checkForest(forest, rf, nsample=2 ** 20):
+    """
+    compare the predictions of the exported forest against the random forest
+    and return the number that differ, nsample = 0 checks every rgb combination
+    """
+    numRGB = 256 ** 3
+    if nsample == 0:
+        keys = np.arange(numRGB, dtype=np.uint32)
+    else:
+        keys = np.random.randint(0, numRGB, size=nsample).astype(np.uint32)
+
+    mismatch = 0
+    for start in range(0, keys.shape[0], 2 ** 20):
+        chunk = keys[start:start + 2 ** 20]
+        rgb = np.vstack([(chunk >> 16) & 255, (chunk >> 8) & 255, chunk & 255]).T.astype(np.uint8)
+
+        mismatch += np.count_nonzero(forest.predict(rgb) != rf.predict(rgb.astype(np.float32)))
+
+    print ('checked ' + str(keys.shape[0]) + ' rgb combinations, ' + str(mismatch) + ' differ from the classifier')
+
+    return mismatch
+
+
+def main():
+    """
+    Main routine
+
+    """
+    cmdargs = getCmdargs()
+
+    rf = pickle.load(open(cmdargs.picklefile, 'rb'))
+
+    exportForest(rf, cmdargs.forestfile)
+    print (cmdargs.forestfile + ' complete')
+
+    forest = FlatForest.load(cmdargs.forestfile)
+    mismatch = checkForest(forest, rf, cmdargs.nsample)
+
+    if mismatch > 0:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -12,6 +12,12 @@ example of the expected csv or txt file shown below which includes a header and
             C:/DATA/todd/example/asp_2015_15cm_02_wgs84.tif, C:/DATA/todd/example/shp/grd_50m4_ID02.shp
             C:/DATA/todd/example/asp_2015_15cm_02_wgs84.tif, C:/DATA/todd/example/shp/grd_50m4_ID03.shp
 
+Alternatively a single GeoPackage or shapefile holding all of the plot polygons with an id field can be given with --vector,
+the polygons are read once into a spatial index (STRtree) and each image is clipped to the plots that overlap it. The clipped 
+images are named <id>_<image name>.tif and written to --outdir.
+
+            python multi_clip_tool_rasterio.py --vector plots.gpkg --idfield id --images asp_2015_15cm_02_wgs84.tif --outdir chips
+
 # This script is written to run on the py3k environment. 
 
 Grant Staben
@@ -48,6 +54,24 @@ Parameters:
 
 list : csv or text file 
             csv file containing the image and shapefile defining the extent of the image to be clipped.
+
+threads : int
+            number of threads used to write the clipped image chips.
+
+vector : GeoPackage or shapefile (optional)
+            single file containing all of the plot polygons, used instead of the list of shapefiles.
+
+idfield : str
+            field in the vector file that identifies each plot.
+
+images : raster image files .tif
+            images clipped to the plots in the vector file.
+
+outdir : str
+            directory the clipped images from the vector file are written to.
+
+The rows of the list are grouped by image so each image is only opened once, the pixels under each shapefile are read
+from the image blocks that cover it and the crs of the image is passed through to the clipped image chips.
             
            
 """
@@ -55,20 +79,16 @@ list : csv or text file
 import sys
 import os
 import argparse
-import json
+import math
+from concurrent.futures import ThreadPoolExecutor
 import rasterio
-from rasterio.plot import show
-from rasterio.plot import show_hist
-from rasterio.mask import mask
-from shapely.geometry import box
+from rasterio.windows import Window
+from rasterio.features import geometry_mask, geometry_window
+from shapely.geometry import box, mapping
+from shapely.strtree import STRtree
 import geopandas as gpd
 import pandas as pd
-from fiona.crs import from_epsg
-#import pycrs
-
-# define the paths to the PROJ lib and GDAL, this is needed when running on some NTG laptops
-os.environ['PROJ_LIB'] = 'C:/ProgramData/Miniconda3/Library/share/proj'
-os.environ['GDAL_DATA'] = 'C:/ProgramData/Miniconda3/Library/share'
+import numpy as np
 
 #function to get cmd line inputs
 def getCmdargs():
@@ -77,10 +97,19 @@ def getCmdargs():
     
     p.add_argument("-i","--list", help="list of raster imagery and the corresponding shapefiles used to clip the raster")
     
+    p.add_argument("-t","--threads", type=int, default=4, help="number of threads used to write the clipped images (default is %(default)s)")
+    
+    p.add_argument("-v","--vector", help="single GeoPackage or shapefile containing all of the plot polygons, used instead of the list")
+    
+    p.add_argument("-f","--idfield", default="id", help="field in the vector file identifying each plot (default is %(default)s)")
+    
+    p.add_argument("-r","--images", nargs="+", help="raster imagery clipped to the plots in the vector file")
+    
+    p.add_argument("-o","--outdir", default=".", help="directory the images clipped from the vector file are written to (default is %(default)s)")
    
     cmdargs = p.parse_args()
     
-    if cmdargs.list is None:
+    if cmdargs.list is None and (cmdargs.vector is None or cmdargs.images is None):
 
         p.print_help()
 
@@ -95,7 +124,7 @@ def covShp(geo_dissovle):
     a manner that rasterio wants them
     """
    
-    return [json.loads(geo_dissovle.to_json())['features'][0]['geometry']]
+    return [mapping(geo_dissovle.geometry.iloc[0])]
 
 
 def dissolveShp(inshp):
@@ -115,84 +144,213 @@ def dissolveShp(inshp):
     return geo_dissolve
 
 
-def epsg(epsg_code):
+def blockWindow(data, window):
     
     """
-    function to convert the epsg code to proj4, the orginal example of the code used pycrs 
-    to obtain this infromatin for the internet. This version relies on it being in this function. 
-    I have covered all the codes relevent to me however it may fail if used elsewhere.
+    expand a window out to the edges of the image blocks it 
+    covers so only whole blocks are read from the image
+    """
+    blockRows, blockCols = data.block_shapes[0]
+    
+    rowStart = (int(window.row_off) // blockRows) * blockRows
+    colStart = (int(window.col_off) // blockCols) * blockCols
+    rowEnd = min(int(math.ceil((window.row_off + window.height) / blockRows)) * blockRows, data.height)
+    colEnd = min(int(math.ceil((window.col_off + window.width) / blockCols)) * blockCols, data.width)
+    
+    return Window(colStart, rowStart, colEnd - colStart, rowEnd - rowStart)
+
+
+def clipPolygon(data, coords):
     
     """
-    if epsg_code == 32752:
-        epsg_code_proj4 = '+proj=utm +zone=52 +south +ellps=WGS84 +datum=WGS84 +units=m +no_defs'
-    if epsg_code == 32753:
-        epsg_code_proj4 = '+proj=utm +zone=53 +south +ellps=WGS84 +datum=WGS84 +units=m +no_defs'
-        
-    if epsg_code == 28352:
-        epsg_code_proj4 = '+proj=utm +zone=52 +south +ellps=GRS80 +towgs84=0,0,0,0,0,0,0 +units=m +no_defs'   
+    clip the image to the extent of the polygon and set the pixels 
+    outside the polygon to the no data value, the same as mask(..., crop=True)
+    """
+    # the window covering the polygon, cropped to the extent of the image
+    window = geometry_window(data, coords)
     
-    if epsg_code == 28353:
-        epsg_code_proj4 = '+proj=utm +zone=53 +south +ellps=GRS80 +towgs84=0,0,0,0,0,0,0 +units=m +no_defs'        
+    # read the whole blocks covering the window and cut the window out of them
+    readWindow = blockWindow(data, window)
+    blocks = data.read(window=readWindow)
     
-    if epsg_code == 4283:
-        epsg_code_proj4 = '+proj=longlat +ellps=GRS80 +towgs84=0,0,0,0,0,0,0 +no_defs'     
-        
-    if epsg_code == 6644:
-        epsg_code_proj4 = '+proj=aea +lat_1=-18 +lat_2=-36 +lat_0=0 +lon_0=134 +x_0=0 +y_0=0 +ellps=GRS80 +towgs84=0,0,0,0,0,0,0 +units=m +no_defs' 
-    if epsg_code == 3577:
-        epsg_code_proj4 = '+proj=aea +lat_1=-18 +lat_2=-36 +lat_0=0 +lon_0=132 +x_0=0 +y_0=0 +ellps=GRS80 +towgs84=0,0,0,0,0,0,0 +units=m +no_defs'
+    rowOff = int(window.row_off - readWindow.row_off)
+    colOff = int(window.col_off - readWindow.col_off)
+    out_img = blocks[:, rowOff:rowOff + int(window.height), colOff:colOff + int(window.width)].copy()
+    
+    out_transform = data.window_transform(window)
+    
+    # the pixels outside the polygon are set to no data (0 if the image has no nodata value)
+    outside = geometry_mask(coords, out_shape=out_img.shape[1:], transform=out_transform)
+    out_img[:, outside] = data.nodata if data.nodata is not None else 0
     
-    return epsg_code_proj4
+    return out_img, out_transform
 
 
-def main():
+def writeChip(out_tif, out_img, out_meta):
     
     """
-    Main routine
+    write out the clipped raster image
+    """
+    with rasterio.open(out_tif, "w", **out_meta) as dest:
+        dest.write(out_img)
+
+
+def writeChips(data, chips, threads=4):
     
     """
+    clip the image to each of the (polygon, output file) pairs and 
+    write the clipped images with a pool of threads
+    """
+    # the projection and datum of the input image are passed through to the clipped images 
+    meta = data.meta.copy()
+    meta.update({"driver": "GTiff", "crs": data.crs})
     
-    cmdargs = getCmdargs()
+    numChips = 0
+    
+    with ThreadPoolExecutor(threads) as executor:
+        pending = []
         
-    # open the list of imagery and read it into memory
-    df = pd.read_csv(cmdargs.list,header=0)
-   
-    for index, row in df.iterrows():
-        inImage = (str(row['img']))
-        inshp = (str(row['shp']))
+        for coords, out_tif in chips:
+            # produce the clipped raster image
+            out_img, out_transform = clipPolygon(data, coords)
+            
+            out_meta = dict(meta)
+            out_meta.update({"height": out_img.shape[1],"width": out_img.shape[2],"transform": out_transform})
+            
+            pending.append(executor.submit(writeChip, out_tif, out_img, out_meta))
+            numChips += 1
+            
+            # limit the number of clipped images held in memory waiting to be written
+            while len(pending) > 2 * threads:
+                pending.pop(0).result()
+                
+        for future in pending:
+            future.result()
+            
+    return numChips
 
-        # create the output file name by removeing the .shp and replacing it with .tif
-        out_tif = (str(row['shp'][:-4]) +'.tif')
 
-        # read in the raster image to produce the clip rasters from
-        data = rasterio.open(inImage)
+def shapefileChips(shapefiles):
+    
+    """
+    the polygon and output file name for each shapefile
+    """
+    for inshp in shapefiles:
+        # create the output file name by removeing the .shp and replacing it with .tif
+        out_tif = inshp[:-4] + '.tif'
         
         # function to dissolve any multi polygons
         geo_dissolve = dissolveShp(inshp)
         
         # get the extent of the shapefile    
         coords = covShp(geo_dissolve)
-    
-        # produce the clipped raster image
-        out_img, out_transform = mask(data, coords, crop=True)
         
-        # get the projection and datum form the input image and update the clip datas metadata
+        yield (coords, out_tif)
+
+
+def clipImage(inImage, shapefiles, threads=4):
+    
+    """
+    clip all of the shapefiles that share an image, the image is 
+    opened once and the clipped images are written by a pool of threads
+    """
+    with rasterio.open(inImage) as data:
+        numChips = writeChips(data, shapefileChips(shapefiles), threads)
+                
+    print (inImage + ' ' + str(numChips) + ' images clipped')
+
+
+def readPlots(vector, idfield):
+    
+    """
+    read all of the plot polygons from a single vector file, the parts 
+    of a plot with more than one polygon are dissolved into a single plot
+    """
+    plots = gpd.read_file(vector)
+    
+    if idfield not in plots.columns:
+        raise ValueError("%s does not have the id field %s" % (vector, idfield))
+    
+    return plots[[idfield, 'geometry']].dissolve(by=idfield).reset_index()
+
+
+def queryPlots(tree, geometries, footprint):
+    
+    """
+    return the index of the plots that intersect the footprint of an image
+    """
+    hits = tree.query(footprint)
+    
+    # shapely 2 returns the index of the geometries, earlier versions return the geometries
+    if len(hits) > 0 and not isinstance(hits[0], (int, np.integer)):
+        lookup = dict((id(geom), index) for index, geom in enumerate(geometries))
+        hits = [lookup[id(geom)] for geom in hits]
+    
+    return sorted(int(index) for index in hits if geometries[index].intersects(footprint))
+
+
+def imagePlots(data, plots, idfield, indexes):
+    
+    """
+    the id and geometry of each plot that overlaps the footprint of the image,
+    the plots are reprojected and indexed once for each projection of the images
+    """
+    key = data.crs.to_string()
+    if key not in indexes:
+        projected = plots.to_crs(data.crs) if plots.crs != data.crs else plots
+        geometries = list(projected.geometry)
+        indexes[key] = (projected, geometries, STRtree(geometries))
+    projected, geometries, tree = indexes[key]
+    
+    # the plots that fall within the footprint of the image
+    matches = queryPlots(tree, geometries, box(*data.bounds))
+    
+    return [(projected[idfield].iloc[index], [mapping(geometries[index])]) for index in matches]
+
+
+def clipVector(vector, idfield, images, outdir=".", threads=4):
+    
+    """
+    clip each image to the plots in a single vector file that overlap it,
+    the plots are read once and matched to the images with a spatial index
+    """
+    plots = readPlots(vector, idfield)
+    
+    # the spatial index for each projection the plots are needed in
+    indexes = {}
+    
+    for inImage in images:
+        with rasterio.open(inImage) as data:
+            imageName = os.path.splitext(os.path.basename(inImage))[0]
+            chips = ((coords, os.path.join(outdir, '%s_%s.tif' % (plotId, imageName))) 
+                     for plotId, coords in imagePlots(data, plots, idfield, indexes))
+            
+            numChips = writeChips(data, chips, threads)
         
-        epsg_code = int(data.crs.data['init'][5:])
-        print (epsg_code)
-        # select the relevent epsg code and convert it to proj4 format 
-        epsg_code_proj4 = epsg(epsg_code)
-       
-        out_meta = data.meta.copy()
+        print (inImage + ' ' + str(numChips) + ' images clipped')
 
-        out_meta.update({"driver": "GTiff","height": out_img.shape[1],"width": out_img.shape[2],"transform": out_transform,"crs": epsg_code_proj4})
+
+def main():
     
-        # write out the clipped raster image
-        with rasterio.open(out_tif, "w", **out_meta) as dest:
-            dest.write(out_img)
+    """
+    Main routine
+    
+    """
+    
+    cmdargs = getCmdargs()
     
-        # close the output raster image
-        data.close()
+    # a single vector file holding all of the plots
+    if cmdargs.vector is not None:
+        clipVector(cmdargs.vector, cmdargs.idfield, cmdargs.images, cmdargs.outdir, cmdargs.threads)
+        return
+        
+    # open the list of imagery and read it into memory
+    df = pd.read_csv(cmdargs.list,header=0)
+    
+    # group the shapefiles by image so each image is only opened once
+    for inImage, rows in df.groupby('img', sort=False):
+        clipImage(str(inImage), [str(inshp) for inshp in rows['shp']], cmdargs.threads)
+
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
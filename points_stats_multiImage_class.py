@@ -0,0 +1,240 @@
+#!/usr/bin/env python
+
+"""
+Extract the training data for the classifier from many images at once. A manifest (csv) lists each image with the point shapefile
+collected on it, the pairs are extracted in parallel across a pool of worker processes with the single pass, block grouped point
+sampling of "points_stats_singleImage_class.py" and the results are written to a single table.
+
+The manifest needs the columns "image" and "shape", the optional columns "uid" and "date" override the --uid option and the
+acquisition date read from the image for that pair;
+
+            image,shape
+            C:/DATA/todd/asp_2015_15cm_02_wgs84.tif,C:/DATA/todd/training/points_2015.shp
+            C:/DATA/todd/asp_2018_15cm_02_wgs84.tif,C:/DATA/todd/training/points_2018.shp
+
+Each row of the output is tagged with the name of the image and its acquisition date. The date is read from the image metadata
+(the TIFFTAG_DATETIME or ACQUISITION_DATE tags) rather than sliced out of the file name. The output format is chosen from the file
+extension, Parquet (.parquet) or Feather (.feather) keep the column types and can be loaded directly by
+"train_class/aerial_photo_classifier_pickle_file.py --training", a csv is written for any other extension.
+
+###############################################################################################
+
+MIT License
+
+Copyright (c) 2020 Grant Staben
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+
+###############################################################################################
+
+Parameters:
+-----------
+
+manifest : csv file
+            csv file listing the image and point shapefile pairs, with the columns "image" and "shape".
+
+nodata : int
+            no data value of the input images, points falling on no data are returned empty. The no data value of each image is used if not given.
+
+uid : str
+            attribute of the point shapefiles which identifies each of the points as unique.
+
+output : parquet, feather or csv file
+            Directory path and file name of the table containing the band values under each point of every image.
+
+workers : int
+            number of worker processes extracting the image and point pairs.
+
+"""
+
+from __future__ import print_function, division
+import os
+import re
+import sys
+import argparse
+import datetime
+import multiprocessing
+import rasterio
+import pandas as pd
+import points_stats_singleImage_class as points
+
+
+def getCmdargs():
+
+    p = argparse.ArgumentParser(description="""Extract the band values under the training points from each image and point shapefile pair listed in the manifest and write them to a single table.""")
+
+    p.add_argument("-m","--manifest", help="csv file listing the image and shape (point shapefile) pairs")
+
+    p.add_argument("-n","--nodata",default=None, help="define the no data value for the input raster images (default is %(default)s)")
+
+    p.add_argument("-u","--uid", default="uid", help="the column name for the unique id field in the shapefiles (default is %(default)s)")
+
+    p.add_argument("-o","--output", help="name of the output table, .parquet, .feather or .csv")
+
+    p.add_argument("-w","--workers", type=int, default=multiprocessing.cpu_count(), help="number of worker processes (default is %(default)s)")
+
+    cmdargs = p.parse_args()
+
+    if cmdargs.manifest is None or cmdargs.output is None:
+
+        p.print_help()
+
+        sys.exit()
+
+    return cmdargs
+
+
+def imageDate(srci):
+
+    """
+    read the acquisition date of the image from its metadata, None is
+    returned when the image does not record a date
+    """
+    tags = srci.tags()
+
+    for tag in ['ACQUISITION_DATE', 'TIFFTAG_DATETIME']:
+        value = tags.get(tag)
+        if not value:
+            continue
+
+        # TIFFTAG_DATETIME is written as YYYY:MM:DD HH:MM:SS
+        match = re.match(r'(\d{4})[:\-/](\d{2})[:\-/](\d{2})', value.strip())
+        if match:
+            return datetime.date(*[int(part) for part in match.groups()]).isoformat()
+
+    return None
+
+
+def extractPair(task):
+
+    """
+    extract the band values under the points of a single image and point
+    shapefile pair and tag them with the image name and date
+    """
+    image, shape, uid, nodata, date = task
+
+    try:
+        with rasterio.open(image) as srci:
+            if date is None:
+                date = imageDate(srci)
+
+        output = points.extractPoints(image, nodata, shape, uid)
+
+    except Exception as err:
+        print (image + ' ' + 'failed' + ' ' + str(err))
+        return image, None
+
+    output.insert(0, 'date', date)
+    output.insert(0, 'image', os.path.splitext(os.path.basename(image))[0])
+
+    return image, output
+
+
+def readManifest(manifest, uid, nodata):
+
+    """
+    read the image and point shapefile pairs from the manifest
+    """
+    df = pd.read_csv(manifest, header=0)
+
+    for column in ['image', 'shape']:
+        if column not in df.columns:
+            raise ValueError("%s does not have the column %s" % (manifest, column))
+
+    tasks = []
+    for row in df.itertuples(index=False):
+        rowUid = row.uid if 'uid' in df.columns else uid
+        rowDate = row.date if 'date' in df.columns else None
+        if pd.isnull(rowDate):
+            rowDate = None
+
+        tasks.append((row.image, row.shape, rowUid, nodata, rowDate))
+
+    return tasks
+
+
+def writeTable(df, output):
+
+    """
+    write the table in the format given by the extension of the output file
+    """
+    extension = os.path.splitext(output)[1].lower()
+
+    if extension == '.parquet':
+        df.to_parquet(output, index=False)
+    elif extension == '.feather':
+        df.to_feather(output)
+    else:
+        df.to_csv(output, index=False)
+
+
+def extractManifest(manifest, output, uid='uid', nodata=None, workers=1):
+
+    """
+    extract all of the image and point shapefile pairs in the manifest in parallel
+    and write them to a single table, the images that failed are returned
+    """
+    tasks = readManifest(manifest, uid, nodata)
+
+    tables = []
+    failed = []
+
+    if workers > 1 and len(tasks) > 1:
+        pool = multiprocessing.Pool(min(workers, len(tasks)))
+        results = pool.imap(extractPair, tasks, chunksize=1)
+    else:
+        pool = None
+        results = map(extractPair, tasks)
+
+    try:
+        for image, table in results:
+            if table is None:
+                failed.append(image)
+            else:
+                tables.append(table)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    if len(tables) == 0:
+        raise ValueError("no points were extracted from the images in %s" % manifest)
+
+    df = pd.concat(tables, ignore_index=True)
+    writeTable(df, output)
+
+    print (output + ' ' + str(len(df)) + ' ' + 'points from' + ' ' + str(len(tables)) + ' ' + 'images' + ' ' + 'complete')
+
+    return failed
+
+
+def mainRoutine():
+
+    # read in the command arguments
+    cmdargs = getCmdargs()
+    nodata = None if cmdargs.nodata is None else int(cmdargs.nodata)
+
+    failed = extractManifest(cmdargs.manifest, cmdargs.output, cmdargs.uid, nodata, cmdargs.workers)
+
+    if len(failed) > 0:
+        print ('the points could not be extracted from ' + str(len(failed)) + ' images: ' + ', '.join(failed))
+        sys.exit(1)
+
+if __name__ == "__main__":
+    mainRoutine()
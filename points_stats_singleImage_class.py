@@ -3,6 +3,11 @@
 """
 Read in a raster image and point shapefile with classes and extracts values from the imput imagery and return a csv of the results for each band in the raster file.
 
+The point coordinates are read once and converted to pixel rows and columns with the affine transform of the image, all of the bands
+are then sampled at those pixels together and written to a single table. The points are grouped by the internal block of the image
+they fall in and only the blocks that contain points are read, so the memory used does not depend on the size of the image and the
+amount read grows with the number of blocks holding points.
+
 Author: Grant Staben
 Date: 14/10/2017
 Modified 20/03/2019
@@ -39,8 +44,8 @@ Parameters:
 image : image file .tif 
             is a string containing the directory path and the name of the input file.
 
-nodata : image file .tiff
-            is a string containing the name of the output directory path and classified file.
+nodata : int
+            no data value of the input image, points falling on no data are returned empty. The no data value of the image is used if not given.
 
 shape : esri shapefile 
             esri shapefile containing the individual points, note this must contain the following attributes "class" and "uid".
@@ -54,17 +59,13 @@ csv : csv file
 """
 
 from __future__ import print_function, division
-import pdb   
 import fiona
 import rasterio
+from rasterio.windows import Window
+import numpy as np
 import pandas as pd 
 import argparse
-from rasterstats import zonal_stats 
-from rasterstats import point_query
 import sys
-import os
-import shutil
-import glob
 
 
 def getCmdargs():
@@ -92,138 +93,131 @@ def getCmdargs():
     return cmdargs
 
 
-def applyZonalstats(image,nodata, band, shape, uid):
-        
+def readPoints(shape, uid):
+    
+    """
+    read the id, class and coordinates of each point in the shapefile 
     """
-    function to extract statistics from a single or multi band raster image
-    """    
-    # create an empty lists to write the results         
-    zonestats = []
     siteID = []
-    classifcation =[]
-    image_Name = []
-    nodata = nodata
+    classifcation = []
+    xs = []
+    ys = []
     
-    with rasterio.open(image, nodata=nodata) as srci:
-        affine = srci.transform
-        array = srci.read(band)
-        
-        with fiona.open(shape) as src:
-            # added kwgs the interpolate to nearest - this ensures that only the value for the pixel under the point is returned
-            # the 'bilinear' (which is the default) interploate method returns the weighted mean of the 4 closest pixels.  
-            zs = point_query(src, array, interpolate='nearest', affine=affine,nodata=nodata) 
-                        
-            # extract the image name from the opened file from the input file read in by rasterio
-            imgName1 = str(srci)[:-11]
-            imgName = imgName1[-34:] 
-            imgDate = imgName[16:20]      
+    with fiona.open(shape) as src:
+        for i in src:
+            table_attributes = i['properties'] # reads in the attribute table for each record 
             
-            for zone in zs:
-                value = zone
-                           
-                # put the individual results in a list and append them to the zonestats list
-                result = [value]
-                zonestats.append(result)
-                            
-            # extract out the site number for the polygon
-            for i in src:
-                table_attributes = i['properties'] # reads in the attribute table for each record 
-                        
-                site = table_attributes[uid] # reads in the id field from the attribute table 
-                details = [site] 
-                siteID.append(details)
-                
-                classif = table_attributes["class"] 
-                Classif = [classif]
-                classifcation.append(Classif)
-
-        # join the elements in each of the lists row by row 
-        finalresults =  [siteid + classi + zoneR for siteid, classi, zoneR in zip(siteID,classifcation, zonestats)]                     
-        
-        # close the vector and raster file 
-        src.close() 
-        srci.close() 
+            siteID.append(table_attributes[uid]) # reads in the id field from the attribute table 
+            classifcation.append(table_attributes["class"])
+            
+            x, y = i['geometry']['coordinates'][:2]
+            xs.append(x)
+            ys.append(y)
+    
+    return siteID, classifcation, np.array(xs, dtype=np.float64), np.array(ys, dtype=np.float64)
 
-        # print out the file name of the processed image
-        print (imgName1 + ' ' + 'band' + ' ' + str(band) + ' ' + 'is' + ' ' + 'complete') 
-                
-    return(finalresults)
 
-def mainRoutine():
-        
-    # read in the command arguments
-    cmdargs = getCmdargs()
-    image = cmdargs.image
-    nodata= int(cmdargs.nodata)
-    shape = cmdargs.shape 
-    uid = cmdargs.uid
-    export_csv = cmdargs.csv
+def pointPixels(affine, xs, ys):
+    
+    """
+    convert the point coordinates to the row and column of the pixel under each point
+    """
+    inverse = ~affine
+    cols = np.floor(inverse.a * xs + inverse.b * ys + inverse.c).astype(np.int64)
+    rows = np.floor(inverse.d * xs + inverse.e * ys + inverse.f).astype(np.int64)
+    
+    return rows, cols
+
+
+def samplePixels(srci, rows, cols, nodata=None):
     
-    # make a temp dir to save the individual band results 
-    tempDir = './temp_individual_bands'
+    """
+    sample all of the bands of the image at the pixel rows and columns together,
+    points outside the image or on the no data value are returned as nan. The points 
+    are grouped by the internal block of the image and only those blocks are read. 
+    """
+    values = np.full((rows.shape[0], srci.count), np.nan)
     
-    # check if the temp dir exists and if it does remove it, otherwise create the new dir for the individual outputs
-    check_if_dir_exists = os.path.isdir(tempDir)
-    if check_if_dir_exists == True:
-        shutil.rmtree(tempDir)
-    else:    
-        os.makedirs(tempDir)
+    inside = np.flatnonzero((rows >= 0) & (rows < srci.height) & (cols >= 0) & (cols < srci.width))
+    if inside.shape[0] == 0:
+        return values, 0
     
-    # create a list of headers for the final output csv file
-    final_header = []
+    # the block holding each point, the points are sorted so each block is read once
+    blockRows, blockCols = srci.block_shapes[0]
+    numBlockCols = (srci.width + blockCols - 1) // blockCols
+    blocks = (rows[inside] // blockRows) * numBlockCols + cols[inside] // blockCols
+    
+    order = np.argsort(blocks, kind='stable')
+    inside = inside[order]
+    blocks = blocks[order]
+    
+    starts = np.flatnonzero(np.r_[True, blocks[1:] != blocks[:-1]])
+    ends = np.r_[starts[1:], blocks.shape[0]]
+    
+    for start, end in zip(starts, ends):
+        blockRow, blockCol = divmod(int(blocks[start]), numBlockCols)
+        rowOff = blockRow * blockRows
+        colOff = blockCol * blockCols
+        window = Window(colOff, rowOff, min(blockCols, srci.width - colOff), min(blockRows, srci.height - rowOff))
         
-    with rasterio.open(image, nodata=nodata) as srci:
+        array = srci.read(window=window)
         
-        bands = srci.indexes # this will return the number of spectral band for the input raster image as a tuple
-        num_bands = len(bands)
+        points = inside[start:end]
+        values[points] = array[:, rows[points] - rowOff, cols[points] - colOff].T
     
-    for band in bands:
-        
-        # creates the individual band csv file name
-        bandResults = 'band_'+str(band)+'.csv'
+    if nodata is not None:
+        values[values == nodata] = np.nan
+    
+    return values, starts.shape[0]
+
 
-        # run the zonal stats function 
-        finalresults = applyZonalstats(image, nodata, band,shape, uid)
+def extractPoints(image, nodata, shape, uid):
         
-        # write out the individual band results to a list
-        outputlist = []
+    """
+    function to extract the value of every band of a single or multi band raster image
+    under each of the points
+    """    
+    siteID, classifcation, xs, ys = readPoints(shape, uid)
+    
+    with rasterio.open(image) as srci:
+        if nodata is None:
+            nodata = srci.nodata
         
-        for i in finalresults:
+        rows, cols = pointPixels(srci.transform, xs, ys)
+        values, numBlocks = samplePixels(srci, rows, cols, nodata)
         
-            outputlist.append(i)    
-       
-        # convert the list to a pandas dataframe with a headers identifying the band number being processed
-        headers = ['site', "class", "b" + str(band)] 
+        headers = ["b" + str(band) for band in srci.indexes]
+        
+        # keep the bands as integers when every point has a value
+        if not np.isnan(values).any():
+            values = values.astype(srci.dtypes[0])
+    
+    output = pd.DataFrame(values, columns=headers)
+    output.insert(0, 'class', classifcation)
+    output.insert(0, 'site', siteID)
+    
+    # print out the file name of the processed image
+    print (image + ' ' + str(len(siteID)) + ' ' + 'points' + ' ' + 'from' + ' ' + str(numBlocks) + ' ' + 'blocks' + ' ' + 'complete') 
+    
+    return output
+
+
+def mainRoutine():
         
-        # select out the band being assessed to make the header for the final output csv
-        current_band = "b" + str(band)
-        final_header.append(current_band)
-                                  
-        output  = pd.DataFrame.from_records(outputlist,columns=headers)
-              
-        output.to_csv(tempDir + '/'+ bandResults,index=False)
-    
-    # read in the individual band results and concatenate them to a single dataframe
-    all_files = glob.glob(os.path.join(tempDir, "*.csv"))     # advisable to use os.path.join as this makes concatenation OS independent
-    
-    df_from_each_file = (pd.read_csv(f) for f in all_files)
-    concatenated_df   = pd.concat(df_from_each_file,ignore_index=False, axis=1)
-    print (list(concatenated_df))
- 
-    # select out the site and class rows to add to the new df  
-    new_df = concatenated_df.iloc[:, 0:2]
-    
-    # select out the bands only from the results to add to the final csv file
-    new_df2 = concatenated_df[final_header]
-    
-    # join the selected data frames
-    join_df = new_df.join(new_df2)
+    # read in the command arguments
+    cmdargs = getCmdargs()
+    image = cmdargs.image
+    nodata = None if cmdargs.nodata is None else int(cmdargs.nodata)
+    shape = cmdargs.shape 
+    uid = cmdargs.uid
+    export_csv = cmdargs.csv
+    
+    # sample all of the bands under the points in a single pass
+    join_df = extractPoints(image, nodata, shape, uid)
+    print (list(join_df))
     
     # export the results to a csv file
     join_df.to_csv(export_csv)  
     
-    # remove the temp dir and single band csv files
-    shutil.rmtree(tempDir)
-    
 if __name__ == "__main__":
-    mainRoutine()   
\ No newline at end of file
+    mainRoutine()   
@@ -0,0 +1,264 @@
+#!/usr/bin/env python
+
+"""
+This code keeps the woody FPC and the other class fractions of each image chip classified by "apply_rgb_comb_classifier_multi.py"
+in a SQLite database, so the results of many runs can be queried by site or acquisition year (for example when validating the Landsat
+woody fpc products) without reading and parsing a growing set of csv files. The results are appended in batches as the image chips
+are classified, each batch in a single transaction, so an interrupted run keeps the results already written.
+
+Each row holds the site (image chip), the source image, the acquisition year, the five class fractions, the number of non-null pixels,
+the status, the hash of the classifier and the timing of the image chip, together with the time the run started. The table is indexed
+on the site and the acquisition year.
+
+The source image and acquisition year are taken from the second and third columns of the list of imagery when they are given. Otherwise
+the source image is the image chip name and the year is read from the ACQUISITION_DATE or TIFFTAG_DATETIME metadata of the image chip,
+or a year (1950 to 2099) in the image chip name.
+
+Run on its own this script writes the results for a site or a year from the store to a csv file.
+
+###############################################################################################
+
+MIT License
+
+Copyright (c) 2020 Grant Staben
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+
+###############################################################################################
+
+Parameters:
+-----------
+
+store : SQLite database file
+            the results store written by apply_rgb_comb_classifier_multi.py --store.
+
+site : str (optional)
+            only the results of this site (image chip).
+
+year : int (optional)
+            only the results of image chips acquired in this year.
+
+csv : csv file (optional)
+            name of the csv file the results are written to, - writes to the standard output.
+
+"""
+
+from __future__ import print_function, division
+
+import sys
+import os
+import re
+import argparse
+import sqlite3
+import datetime
+import pandas as pd
+import rasterio
+
+# the columns of the results table and their types
+COLUMNS = [('site', 'TEXT'), ('image', 'TEXT'), ('year', 'INTEGER'),
+           ('fpc', 'REAL'), ('non_woody_green', 'REAL'), ('bare_npv', 'REAL'), ('shadow', 'REAL'), ('branch_trunk', 'REAL'),
+           ('nonnull', 'INTEGER'), ('status', 'TEXT'), ('model_hash', 'TEXT'),
+           ('seconds', 'REAL'), ('predict_seconds', 'REAL'), ('read_write_seconds', 'REAL'), ('run', 'TEXT')]
+
+
+def getCmdargs():
+    """
+    Get command line arguments
+    """
+    p = argparse.ArgumentParser()
+
+    p.add_argument("--store", help="Input SQLite results store")
+
+    p.add_argument("--site", default=None, help="only the results of this site (default is %(default)s)")
+
+    p.add_argument("--year", type=int, default=None, help="only the results acquired in this year (default is %(default)s)")
+
+    p.add_argument("-c", "--csv", default="-", help="output csv file, - for the standard output (default is %(default)s)")
+
+    cmdargs = p.parse_args()
+
+    if cmdargs.store is None:
+        p.print_help()
+        sys.exit()
+
+    return cmdargs
+
+
+def openStore(path):
+    """
+    open the results store, creating the results table and its indexes if needed
+    """
+    conn = sqlite3.connect(path)
+    conn.execute('CREATE TABLE IF NOT EXISTS results (%s)' % ', '.join('%s %s' % column for column in COLUMNS))
+    conn.execute('CREATE INDEX IF NOT EXISTS results_site ON results (site)')
+    conn.execute('CREATE INDEX IF NOT EXISTS results_year ON results (year)')
+    conn.commit()
+
+    return conn
+
+
+def acquisitionYear(path):
+    """
+    the year the image chip was acquired, from its metadata or its name,
+    None is returned when neither records a year
+    """
+    try:
+        with rasterio.open(path) as dataset:
+            tags = dataset.tags()
+    except Exception:
+        tags = {}
+
+    for tag in ['ACQUISITION_DATE', 'TIFFTAG_DATETIME']:
+        # TIFFTAG_DATETIME is written as YYYY:MM:DD HH:MM:SS
+        match = re.match(r'(\d{4})[:\-/]\d{2}[:\-/]\d{2}', (tags.get(tag) or '').strip())
+        if match:
+            return int(match.group(1))
+
+    match = re.search(r'(?<!\d)(19[5-9]\d|20\d\d)(?!\d)', os.path.basename(path))
+    if match:
+        return int(match.group(1))
+
+    return None
+
+
+class ResultsStore(object):
+    """
+    append the results of the image chips to the results store in batches,
+    each batch is written in a single transaction
+    """
+    def __init__(self, path, modelHash=None, batchSize=100):
+        self.conn = openStore(path)
+        self.modelHash = modelHash
+        self.batchSize = batchSize
+        self.run = datetime.datetime.now().isoformat(timespec='seconds')
+        self.rows = []
+        self.written = 0
+
+    def append(self, result, image=None, year=None, path=None):
+        """
+        add the result of an image chip, the year is read from the image chip
+        at path when it is not given
+        """
+        if year is None and path is not None:
+            year = acquisitionYear(path)
+
+        row = dict(result, image=image or result['site'], year=year, fpc=result.get('woody_green', result.get('fpc')),
+                   model_hash=self.modelHash, run=self.run)
+        self.rows.append(tuple(storeValue(row.get(name)) for name, columnType in COLUMNS))
+
+        if len(self.rows) >= self.batchSize:
+            self.flush()
+
+    def flush(self):
+        """
+        write the rows waiting in the batch
+        """
+        if len(self.rows) == 0:
+            return
+
+        with self.conn:
+            self.conn.executemany('INSERT INTO results VALUES (%s)' % ', '.join('?' * len(COLUMNS)), self.rows)
+
+        self.written += len(self.rows)
+        self.rows = []
+
+    def close(self):
+        """
+        write the last batch and close the store
+        """
+        try:
+            self.flush()
+        finally:
+            self.conn.close()
+
+
+def storeValue(value):
+    """
+    convert numpy numbers and nan to values sqlite stores
+    """
+    if value is None:
+        return None
+    if hasattr(value, 'item'):
+        value = value.item()
+    if isinstance(value, float) and value != value:
+        return None
+
+    return value
+
+
+def mergeStores(path, shardPaths):
+    """
+    copy the rows of the stores written by the shards of a run into a single
+    store, the rows already copied by an earlier merge are replaced
+    """
+    conn = openStore(path)
+    numRows = 0
+    try:
+        for shardPath in shardPaths:
+            conn.execute('ATTACH DATABASE ? AS shard', (shardPath,))
+            try:
+                with conn:
+                    conn.execute('DELETE FROM results WHERE EXISTS (SELECT 1 FROM shard.results AS s WHERE s.run = results.run '
+                                 'AND s.site = results.site AND s.model_hash IS results.model_hash)')
+                    numRows += conn.execute('INSERT INTO results SELECT %s FROM shard.results' %
+                                            ', '.join(name for name, columnType in COLUMNS)).rowcount
+            finally:
+                conn.execute('DETACH DATABASE shard')
+    finally:
+        conn.close()
+
+    return numRows
+
+
+def queryStore(path, site=None, year=None):
+    """
+    read the results for a site and/or year from the store
+    """
+    where = []
+    params = []
+    if site is not None:
+        where.append('site = ?')
+        params.append(site)
+    if year is not None:
+        where.append('year = ?')
+        params.append(year)
+
+    query = 'SELECT * FROM results' + (' WHERE ' + ' AND '.join(where) if where else '') + ' ORDER BY site, year, run'
+
+    conn = sqlite3.connect(path)
+    try:
+        return pd.read_sql_query(query, conn, params=params, dtype={'year': 'Int64', 'nonnull': 'Int64'})
+    finally:
+        conn.close()
+
+
+def main():
+    """
+    Main routine
+
+    """
+    cmdargs = getCmdargs()
+
+    results = queryStore(cmdargs.store, cmdargs.site, cmdargs.year)
+
+    results.to_csv(sys.stdout if cmdargs.csv == '-' else cmdargs.csv, index=False)
+
+
+if __name__ == "__main__":
+    main()
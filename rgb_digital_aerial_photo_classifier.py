@@ -62,16 +62,74 @@ outfile : raster image file .tiff
 picklefile : serilised pickle file
             serilised random forest classifer using pickle library. The serilised pickle file is produced from the script aerial_photo_classifier_pickle_file.py.
 
+lut : numpy file .npy (optional)
+            precomputed 24 bit rgb lookup table produced by build_rgb_lookup_table.py. When given the pixels are classified with a single
+            lookup into the table instead of running the random forest.
+
+no-raster : flag (optional)
+            only count the pixels in each class and report the class fractions, the classified image is not written.
+
+colour-cache : flag (optional)
+            cache the class of each rgb colour. The class of every colour classified is held in a 16 MB array indexed by the
+            packed rgb value, so each block is looked up at once and only the unique colours not already in the cache are
+            classified by the random forest. The cache is kept for the whole run and the fraction of the pixels found in the 
+            cache (hit rate) is reported.
+
+forest : numpy file .npz (optional)
+            random forest exported to plain numpy arrays by flat_forest.py, used instead of the pickle file so scikit-learn 
+            is not needed to apply the classifier.
+
+compress, predictor, level, blocksize : output options (optional)
+            write the classified image as a tiled GeoTIFF compressed with DEFLATE, ZSTD or LZW, with a predictor, a colour table
+            for the classes and internal overviews built with mode resampling (see classified_output.py). Without these options
+            the classified image is written with the rios defaults.
+
+cog : flag (optional)
+            write the classified image as a Cloud Optimized GeoTIFF, DEFLATE compression is used unless --compress is given.
+
+pipeline : int (optional)
+            number of threads classifying the blocks. Instead of rios reading, classifying and writing each block in turn, a 
+            reader thread reads the blocks ahead, these threads classify them and a writer thread writes the classified blocks 
+            in order, so reading, classifying and writing overlap. The classified image is always written as a GeoTIFF.
+
+queue-size : int (optional)
+            number of blocks held in each of the queues between the stages of the pipeline, which bounds the memory used.
+
+The wall time of the image chip is reported split into the time spent classifying the blocks (predict) and the time spent by 
+rios reading and writing the blocks (read_write), together with the peak memory of the process. With --pipeline the stages 
+overlap, so the time spent in each stage adds up to more than the wall time.
+
 """
 
 import sys
 import os
+import time
 import argparse
 import pickle as pickle
+import copy
+import threading
+from queue import Queue, Full, Empty
 import numpy as np
+import rasterio
+from rasterio.windows import Window
 from rios import applier, fileinfo
 import pdb
-from sklearn.preprocessing import Imputer
+from build_rgb_lookup_table import packRGB, unpackRGB, loadLookupTable, NUM_RGB
+from flat_forest import FlatForest
+import classified_output
+
+try:
+    import resource
+except ImportError:
+    # the resource module is not available on windows
+    resource = None
+
+# the number of cover classes and the names used when reporting the class fractions
+NUM_CLASSES = 5
+CLASS_NAMES = ['woody_green', 'non_woody_green', 'bare_npv', 'shadow', 'branch_trunk']
+
+# size of the windows read and classified by the pipelined engine
+PIPELINE_BLOCKSIZE = 256
 
 
 def getCmdargs():
@@ -85,6 +143,21 @@ def getCmdargs():
     
     p.add_argument("--picklefile", default="rfc_cpickle_20200615.p",help="Input pickle file (default is %(default)s)")
     
+    p.add_argument("--lut", default=None, help="Input rgb lookup table produced by build_rgb_lookup_table.py, used instead of the pickle file (default is %(default)s)")
+    
+    p.add_argument("--forest", default=None, help="Input forest exported by flat_forest.py, used instead of the pickle file (default is %(default)s)")
+    
+    p.add_argument("--no-raster", dest="noraster", action="store_true", default=False, help="Do not write the classified image, only report the class fractions")
+    
+    p.add_argument("--colour-cache", dest="colourcache", action="store_true", default=False, help="Cache the class of each rgb colour so only the colours not already classified are passed to the random forest")
+    
+    p.add_argument("--pipeline", type=int, default=0, help="Number of threads classifying the blocks while other threads read and write them, 0 uses rios (default is %(default)s)")
+    
+    p.add_argument("--queue-size", dest="queuesize", type=int, default=8, help="Number of blocks held between the read, classify and write stages of the pipeline (default is %(default)s)")
+    
+    # the output is written with the rios defaults unless a compression or --cog is given
+    classified_output.addOutputArgs(p, compress=None)
+    
     cmdargs = p.parse_args()
     
     if cmdargs.reffile is None:
@@ -94,63 +167,486 @@ def getCmdargs():
     return cmdargs
 
 
-def main():
+class ColourCache(object):
     """
-    Main routine
+    cache of the class predicted by the random forest for each packed 24 bit
+    rgb colour, kept across blocks and image chips. The classes are held in a
+    16 MB array indexed by the packed colour (UNCACHED until the colour has been
+    classified), so a block is looked up with a single gather. The array holds
+    every rgb colour, so each colour is only classified once and nothing is
+    evicted
+    """
+    # value of the colours that have not been classified, larger than any class
+    UNCACHED = 255
+    
+    def __init__(self):
+        self.classes = np.full(NUM_RGB, self.UNCACHED, dtype=np.uint8)
+        self.size = 0
+        self.pixels = 0
+        self.hits = 0
+        self.misses = 0
+        # the cache may be shared by threads classifying blocks
+        self.lock = threading.Lock()
+    
+    def predict(self, keys, rf):
+        """
+        return the class of each packed rgb value, only the unique colours
+        not already in the cache are classified by the random forest
+        """
+        classes = self.classes[keys]
+        missing = classes == self.UNCACHED
+        numMissing = int(np.count_nonzero(missing))
+        
+        if numMissing > 0:
+            missingKeys, inverse = np.unique(keys[missing], return_inverse=True)
+            missingClasses = predictRGB(rf, unpackRGB(missingKeys)).astype(np.uint8)
+            classes[missing] = missingClasses[inverse.ravel()]
+            
+            with self.lock:
+                # another thread may have cached some of the colours in the meantime
+                new = self.classes[missingKeys] == self.UNCACHED
+                self.classes[missingKeys[new]] = missingClasses[new]
+                self.size += int(np.count_nonzero(new))
+        
+        with self.lock:
+            self.pixels += keys.shape[0]
+            self.hits += keys.shape[0] - numMissing
+            self.misses += numMissing
+        
+        return classes
+    
+    def hitRate(self):
+        """
+        fraction of the pixels looked up whose colour was found in the cache
+        """
+        lookups = self.hits + self.misses
+        
+        return self.hits / lookups if lookups > 0 else 0.0
     
+    def report(self):
+        """
+        summary of the cache for printing
+        """
+        return ('colour cache: %d pixels looked up, hit rate %.1f%% of the pixels, %d colours cached' % 
+                (self.pixels, self.hitRate() * 100, self.size))
+
+
+def predictRGB(rf, rgb):
+    """
+    classify (n, 3) 8 bit rgb values with either the random forest or a
+    forest exported by flat_forest.py, which takes the 8 bit values directly
+    """
+    if isinstance(rf, FlatForest):
+        return rf.predict(rgb)
+    
+    # the random forest was trained on the float values of the bands
+    return rf.predict(rgb.astype(np.float32))
+
+
+def loadModel(picklefile="rfc_cpickle_20200615.p", lut=None, colourCache=False, forest=None):
+    """
+    load the classifier once so it can be kept resident and applied to
+    any number of image chips with classify_chip. A colour cache is set up 
+    when colourCache is true
+    """
+    model = applier.OtherInputs()
+    
+    # the lookup table and the exported forest replace the random forest so the pickle file is only loaded without them
+    if lut is not None:
+        model.lut = loadLookupTable(lut)
+        model.rf = None
+    elif forest is not None:
+        model.lut = None
+        model.rf = FlatForest.load(forest)
+    else:
+        model.lut = None
+        model.rf = pickle.load(open(picklefile, 'rb'))
+    # no data value
+    model.refnull =  0
+    
+    # the cache is not needed with the lookup table, which already holds every colour
+    if colourCache and model.lut is None:
+        model.colourCache = ColourCache()
+    else:
+        model.colourCache = None
+    
+    return model
+
+
+def classify_chip(path, model, outfile=None, writeRaster=True, creationOptions=None):
+    """
+    classify a single image chip with a model returned by loadModel and 
+    return the number of pixels in each class together with the name of 
+    the classified image. If no output name is given the chip name is used 
+    with the suffix _rgb_comb_class.tif, when writeRaster is False the pixels
+    are only counted and the name returned is None. The classified image is
+    written as a GeoTIFF with the GDAL creationOptions (a dict) if given
     """
-    cmdargs = getCmdargs()
     controls = applier.ApplierControls()
     infiles = applier.FilenameAssociations()
     outfiles = applier.FilenameAssociations()
-    otherargs = applier.OtherInputs()
     
-    infiles.image = cmdargs.reffile
+    infiles.image = path
     
-    imageExt = infiles.image
-         
     controls.setReferenceImage(infiles.image) 
     
-    outfiles.hgt = cmdargs.outfile
+    if creationOptions is not None:
+        controls.setOutputDriverName('GTiff')
+        controls.setCreationOptions(['%s=%s' % (key, value) for key, value in creationOptions.items()])
+        # the overviews are built with mode resampling by classified_output.finishOutput
+        controls.setCalcStats(False)
     
-    otherargs.rf = pickle.load(open(cmdargs.picklefile, 'rb'))
-    # no data value
-    otherargs.refnull =  0
+    if writeRaster:
+        if outfile is None:
+            outfile = path[:-4] + '_rgb_comb_class.tif'
+        outfiles.hgt = outfile
+    else:
+        outfile = None
+    
+    # the pixel counts for each class are collected by doModel as each block is classified 
+    model.writeRaster = writeRaster
+    model.classCounts = np.zeros(NUM_CLASSES + 1, dtype=np.int64)
+    
+    # the time spent classifying the blocks is collected by doModel, the rest is spent reading and writing
+    model.timings = {'predict': 0.0}
+    start = time.time()
 
-    applier.apply(doModel, infiles, outfiles, otherargs,controls=controls)
+    applier.apply(doModel, infiles, outfiles, model, controls=controls)
+    
+    model.timings['total'] = time.time() - start
+    model.timings['read_write'] = model.timings['total'] - model.timings['predict']
+    
+    return (model.classCounts, outfile)
+
+
+def pipelineWindows(width, height, blockShape, blocksize=PIPELINE_BLOCKSIZE):
+    """
+    windows of about blocksize x blocksize pixels covering the image, made up
+    of whole internal blocks so each block of the input is only read once
+    """
+    blockRows, blockCols = blockShape
+    rows = blockRows * max(1, blocksize // blockRows)
+    cols = blockCols * max(1, blocksize // blockCols)
+
+    windows = []
+    for rowOff in range(0, height, rows):
+        for colOff in range(0, width, cols):
+            windows.append(Window(colOff, rowOff, min(cols, width - colOff), min(rows, height - rowOff)))
+
+    return windows
 
+
+def putItem(queue, item, stop):
+    """
+    put an item on a bounded queue, giving up if the pipeline is stopped
+    """
+    while not stop.is_set():
+        try:
+            queue.put(item, timeout=0.1)
+            return True
+        except Full:
+            continue
+
+    return False
+
+
+def getItem(queue, stop):
+    """
+    take an item from a queue, None is returned if the pipeline is stopped
+    """
+    while not stop.is_set():
+        try:
+            return queue.get(timeout=0.1)
+        except Empty:
+            continue
+
+    return None
+
+
+def classifyPipelined(path, model, outfile=None, writeRaster=True, creationOptions=None, workers=2, queueSize=8):
+    """
+    classify an image chip or mosaic like classify_chip, but with reading,
+    classifying and writing overlapped. A reader thread reads the windows
+    ahead into a bounded queue, the workers threads classify them and a
+    writer thread writes the classified windows in order, so the disk and the
+    cpu are kept busy at the same time. The classified image is written as a
+    tiled GeoTIFF with the GDAL creationOptions (a dict) if given
+    """
+    if writeRaster and outfile is None:
+        outfile = path[:-4] + '_rgb_comb_class.tif'
+    if not writeRaster:
+        outfile = None
+
+    model.writeRaster = writeRaster
+    model.classCounts = np.zeros(NUM_CLASSES + 1, dtype=np.int64)
+    model.timings = {'predict': 0.0, 'read': 0.0, 'write': 0.0}
+    start = time.time()
+
+    src = rasterio.open(path)
+    windows = pipelineWindows(src.width, src.height, src.block_shapes[0])
+
+    dst = None
+    if writeRaster:
+        profile = {'driver': 'GTiff', 'width': src.width, 'height': src.height, 'count': 1, 'dtype': 'uint8',
+                   'crs': src.crs, 'transform': src.transform}
+        if creationOptions is None:
+            creationOptions = {'TILED': 'YES', 'BLOCKXSIZE': str(PIPELINE_BLOCKSIZE), 'BLOCKYSIZE': str(PIPELINE_BLOCKSIZE)}
+        profile.update(creationOptions)
+        dst = rasterio.open(outfile, 'w', **profile)
+
+    readQueue = Queue(queueSize)
+    writeQueue = Queue(queueSize)
+    stop = threading.Event()
+    errors = []
+
+    # the windows read but not yet written, so the windows held waiting for an earlier window to be written are bounded
+    inFlight = threading.BoundedSemaphore(2 * queueSize + workers)
+
+    # each worker counts the classes into its own copy of the model, the colour cache is shared
+    workerModels = []
+    for i in range(workers):
+        workerModel = copy.copy(model)
+        workerModel.classCounts = np.zeros(NUM_CLASSES + 1, dtype=np.int64)
+        workerModel.timings = {'predict': 0.0}
+        workerModels.append(workerModel)
+
+    def reader():
+        try:
+            for index, window in enumerate(windows):
+                while not inFlight.acquire(timeout=0.1):
+                    if stop.is_set():
+                        return
+                readStart = time.time()
+                image = src.read(window=window)
+                model.timings['read'] += time.time() - readStart
+                if not putItem(readQueue, (index, window, image), stop):
+                    return
+        except Exception as err:
+            errors.append(err)
+            stop.set()
+        finally:
+            # one end marker for each worker
+            for i in range(workers):
+                putItem(readQueue, None, stop)
+
+    def predictor(workerModel):
+        try:
+            while True:
+                item = getItem(readQueue, stop)
+                if item is None:
+                    break
+                index, window, image = item
+                predictStart = time.time()
+                hgtBlock = classifyBlock(image, workerModel)
+                workerModel.timings['predict'] += time.time() - predictStart
+                if not putItem(writeQueue, (index, window, hgtBlock), stop):
+                    break
+        except Exception as err:
+            errors.append(err)
+            stop.set()
+
+    def writer():
+        # the windows classified ahead of the next window to be written
+        pending = {}
+        nextIndex = 0
+        try:
+            while nextIndex < len(windows):
+                item = getItem(writeQueue, stop)
+                if item is None:
+                    break
+                pending[item[0]] = item
+
+                while nextIndex in pending:
+                    index, window, hgtBlock = pending.pop(nextIndex)
+                    if dst is not None:
+                        writeStart = time.time()
+                        dst.write(hgtBlock, window=window)
+                        model.timings['write'] += time.time() - writeStart
+                    inFlight.release()
+                    nextIndex += 1
+        except Exception as err:
+            errors.append(err)
+            stop.set()
+
+    threads = [threading.Thread(target=reader), threading.Thread(target=writer)]
+    threads += [threading.Thread(target=predictor, args=(workerModel,)) for workerModel in workerModels]
+    try:
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    finally:
+        stop.set()
+        src.close()
+        if dst is not None:
+            dst.close()
+
+    if len(errors) > 0:
+        raise errors[0]
+
+    for workerModel in workerModels:
+        model.classCounts += workerModel.classCounts
+        model.timings['predict'] += workerModel.timings['predict']
+
+    # the stages overlap, so the time spent in each stage adds up to more than the total
+    model.timings['total'] = time.time() - start
+    model.timings['read_write'] = model.timings['read'] + model.timings['write']
+
+    return (model.classCounts, outfile)
+
+
+def classFractions(classCounts):
+    """
+    convert the pixel counts for each class into the percentage of the 
+    non-null pixels in each class, index 0 of the counts holds the null pixels
+    """
+    nonNull = int(classCounts[1:].sum())
     
-def doModel(info, inputs, outputs, otherargs):
+    fractions = {'nonnull': nonNull}
+    for classValue, name in enumerate(CLASS_NAMES, start=1):
+        if nonNull > 0:
+            fractions[name] = (classCounts[classValue] / nonNull) * 100
+        else:
+            fractions[name] = np.nan
+    
+    return fractions
+
+
+def peakMemory():
+    """
+    return the peak resident memory (MB) of this process and of the largest
+    child process, None is returned where it can not be measured
+    """
+    if resource is None:
+        return (None, None)
+
+    # ru_maxrss is reported in kilobytes on linux and bytes on mac
+    scale = 1024 * 1024 if sys.platform == 'darwin' else 1024
+    selfRSS = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / scale
+    childRSS = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / scale
+
+    return (selfRSS, childRSS)
+
+
+def main():
+    """
+    Main routine
+    
+    """
+    cmdargs = getCmdargs()
+    
+    model = loadModel(cmdargs.picklefile, cmdargs.lut, cmdargs.colourcache, cmdargs.forest)
+    
+    compress = cmdargs.compress
+    if compress is None and cmdargs.cog:
+        compress = 'DEFLATE'
+    
+    options = None
+    if compress is not None and not cmdargs.noraster:
+        options = classified_output.creationOptions(compress, cmdargs.predictor, cmdargs.level, cmdargs.blocksize)
+    
+    if cmdargs.pipeline > 0:
+        classCounts, outfile = classifyPipelined(cmdargs.reffile, model, cmdargs.outfile, not cmdargs.noraster, options,
+                                                 cmdargs.pipeline, cmdargs.queuesize)
+    else:
+        classCounts, outfile = classify_chip(cmdargs.reffile, model, cmdargs.outfile, not cmdargs.noraster, options)
+    
+    # add the colour table and overviews and report the size of the classified image
+    if options is not None:
+        finishSeconds = classified_output.finishOutput(outfile, compress, cmdargs.predictor, cmdargs.level, cmdargs.blocksize, cmdargs.cog)
+        classified_output.outputReport(outfile, model.timings['total'], finishSeconds)
+    
+    # report the percentage of the non-null pixels in each class
+    fractions = classFractions(classCounts)
+    for name in CLASS_NAMES:
+        print ('%s: %.2f' % (name, fractions[name]))
+    
+    if model.colourCache is not None:
+        print (model.colourCache.report())
+    
+    selfRSS, childRSS = peakMemory()
+    print ('%.2f seconds, %.2f predict, %.2f read and write' % (model.timings['total'], model.timings['predict'], model.timings['read_write']) + 
+           ('' if selfRSS is None else ', peak memory %.0f MB' % selfRSS))
 
-    nonNullmask = (inputs.image[0] != otherargs.refnull)
+    
+def classifyBlock(image, otherargs):
+    """
+    classify a block of the 8 bit rgb imagery and return the classified 
+    block, the pixel counts for each class are added to otherargs.classCounts
+    """
+    nonNullmask = (image[0] != otherargs.refnull)
     
     # get the shape of the annual image and convert it to the shape of a single band  
-    imgshape = inputs.image.shape
+    imgshape = image.shape
     # convert the tuple to a list to convert all bands to represent 1 band and then convert it back to a tuple
     list_imgshape = list(imgshape)
     list_imgshape[0] = 1
     imgShape = tuple(list_imgshape)
 
-    # read in the individual bands of the RGB imagery 
-    red = (inputs.image[0][nonNullmask]).astype(np.float32)
-    green = (inputs.image[1][nonNullmask]).astype(np.float32)
-    blue = (inputs.image[2][nonNullmask]).astype(np.float32)
-      
-    # parse the variables into a np array and transform it to look like the pandas df 
-    allVars= np.vstack([red,green,blue]).T
-       
     # sets up the shape and dtype for the classified output  
-    outputs.hgt = np.zeros(imgShape, dtype=np.uint8)
+    hgtBlock = np.zeros(imgShape, dtype=np.uint8)
     
-    # applies the rf classifer to produce the classified image
-    if allVars.shape[0] > 0:
-        # run check over the input data and replaces nan and infinity values
-        allVars[np.isnan(allVars)] = 0.0
-        allVars[np.isinf(allVars)] = 0.0
+    # classify the pixels with a single lookup of the packed rgb values into the precomputed table
+    if otherargs.lut is not None:
+        if image.dtype != np.uint8:
+            raise ValueError("the rgb lookup table can only be applied to 8 bit imagery")
+        
+        keys = packRGB(image[0][nonNullmask], image[1][nonNullmask], image[2][nonNullmask])
         
-        hgt = otherargs.rf.predict(allVars)
+        hgtBlock[0][nonNullmask] = otherargs.lut[keys]
+    elif getattr(otherargs, 'colourCache', None) is not None:
+        # only the unique colours in the block that are not in the cache are classified
+        if image.dtype != np.uint8:
+            raise ValueError("the colour cache can only be applied to 8 bit imagery")
         
-        outputs.hgt[0][nonNullmask] = hgt
+        keys = packRGB(image[0][nonNullmask], image[1][nonNullmask], image[2][nonNullmask])
+        
+        if keys.shape[0] > 0:
+            hgtBlock[0][nonNullmask] = otherargs.colourCache.predict(keys, otherargs.rf)
+    elif isinstance(otherargs.rf, FlatForest):
+        # the exported forest compares the 8 bit values directly so no float32 copy is made
+        rgb = np.vstack([image[0][nonNullmask], image[1][nonNullmask], image[2][nonNullmask]]).T
+        
+        if rgb.shape[0] > 0:
+            hgtBlock[0][nonNullmask] = otherargs.rf.predict(rgb)
+    else:
+        # read in the individual bands of the RGB imagery 
+        red = (image[0][nonNullmask]).astype(np.float32)
+        green = (image[1][nonNullmask]).astype(np.float32)
+        blue = (image[2][nonNullmask]).astype(np.float32)
+          
+        # parse the variables into a np array and transform it to look like the pandas df 
+        allVars= np.vstack([red,green,blue]).T
+        
+        # applies the rf classifer to produce the classified image
+        if allVars.shape[0] > 0:
+            # run check over the input data and replaces nan and infinity values
+            allVars[np.isnan(allVars)] = 0.0
+            allVars[np.isinf(allVars)] = 0.0
+            
+            hgt = otherargs.rf.predict(allVars)
+            
+            hgtBlock[0][nonNullmask] = hgt
+    
+    # count the pixels in each class, the null pixels are counted in class 0
+    if getattr(otherargs, 'classCounts', None) is not None:
+        otherargs.classCounts += np.bincount(hgtBlock.ravel(), minlength=NUM_CLASSES + 1)[:NUM_CLASSES + 1]
+    
+    return hgtBlock
+
+
+def doModel(info, inputs, outputs, otherargs):
+
+    start = time.time()
+    hgtBlock = classifyBlock(inputs.image, otherargs)
+    
+    if getattr(otherargs, 'timings', None) is not None:
+        otherargs.timings['predict'] += time.time() - start
+    
+    # the classified image is only written when requested
+    if getattr(otherargs, 'writeRaster', True):
+        outputs.hgt = hgtBlock
+
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,442 @@
+#!/usr/bin/env python
+
+"""
+This code applies the random forest classifer from "rgb_digital_aerial_photo_classifier.py" to a whole 8 bit digital aerial
+photography mosaic tile rather than a single image chip. The mosaic is split into windows aligned with the internal blocks of the
+reference image, the windows are classified in parallel by a pool of worker processes and written to a single tiled GeoTIFF.
+
+The size of the windows is set from the memory budget so that all of the workers together stay within it. The memory each worker
+needs for python and the classifier (about 200 MB plus 2.5 times the size of the pickle file for the random forest, the lookup
+table and exported forest are memory mapped and shared) is taken from the budget first, and the rest is split into windows using
+the measured working memory per pixel of the classifier. Each completed window is recorded in a progress file next to the output
+image (outfile.done) together with its class counts, so a run that crashes can be resumed with --resume, only the windows that
+were not recorded are classified again and the class fractions are reported for the whole mosaic.
+
+The five classes represent cover for;
+
+Class               Pixel value            Description
+------------------------------------------------------------------------------------------
+Woody green:          1                    Green leaf for all woody vegetation
+Non-woody green:      2                    Green leaf from all non-woody vegetation
+Bare/npv vegetation:  3                    Bare ground and senescent vegetation (woody and non-woody)
+Shadow:               4                    Shadow
+Branch/trunk:         5                    Branches and trunks of woody vegetation
+------------------------------------------------------------------------------------------
+
+###############################################################################################
+
+MIT License
+
+Copyright (c) 2020 Grant Staben
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+
+###############################################################################################
+
+Parameters:
+-----------
+
+reffile : raster image file .tif
+            is a string containing the directory path and the name of the input mosaic.
+
+outfile : raster image file .tif
+            is a string containing the name of the output directory path and classified mosaic.
+
+picklefile : serilised pickle file
+            serilised random forest classifer, loaded once by each worker process.
+
+lut : numpy file .npy (optional)
+            precomputed rgb lookup table produced by build_rgb_lookup_table.py, used instead of the pickle file.
+
+forest : numpy file .npz (optional)
+            random forest exported by flat_forest.py, used instead of the pickle file so scikit-learn is not needed.
+
+colour-cache : flag (optional)
+            each worker caches the class of each rgb colour, only the unique colours not already classified are passed to the random forest.
+
+workers : int
+            number of worker processes used to classify the windows.
+
+memory : int
+            memory budget in MB shared by all of the workers, including the memory each worker needs for the classifier, 
+            used to set the size of the windows.
+
+resume : flag (optional)
+            continue a run that did not finish using the progress file written next to the output image.
+
+compress, predictor, level, blocksize, cog : output options (optional)
+            once every window is complete the classified image is rewritten as a compressed tiled GeoTIFF, or a Cloud Optimized
+            GeoTIFF with --cog, with a colour table and internal overviews built with mode resampling (see classified_output.py).
+
+"""
+
+from __future__ import print_function, division
+
+import sys
+import os
+import math
+import time
+import argparse
+import threading
+import multiprocessing
+import numpy as np
+import rasterio
+from rasterio.windows import Window
+import rgb_digital_aerial_photo_classifier as classifier
+import classified_output
+
+OUT_BLOCKSIZE = 256
+
+# working memory needed by a worker to classify one pixel of a window with each classifier, measured as the rise in the peak
+# resident memory of classifyBlock; the 8 bit input, the float32 predictor variables and the class probabilities of the random
+# forest, the node indices of the exported forest or the packed rgb keys of the lookup table. Two bytes are added for the 
+# classified windows waiting to be written by the main process
+BYTES_PER_PIXEL = {'rf': 102, 'forest': 216, 'lut': 36}
+
+# resident memory of a worker process before the classifier is loaded (python, numpy, rasterio and scikit-learn)
+WORKER_BASE_MB = 200
+
+# the unpickled random forest takes about 2.5 times the size of the pickle file in memory
+PICKLE_MEMORY_FACTOR = 2.5
+
+
+def getCmdargs():
+    """
+    Get command line arguments
+    """
+    p = argparse.ArgumentParser()
+
+    p.add_argument("--reffile", help="Input 8bit digital aerial photography mosaic")
+
+    p.add_argument("--outfile", help="Name of output classified image")
+
+    p.add_argument("--picklefile", default="rfc_cpickle_20200615.p", help="Input pickle file (default is %(default)s)")
+
+    p.add_argument("--lut", default=None, help="Input rgb lookup table used instead of the pickle file (default is %(default)s)")
+
+    p.add_argument("--forest", default=None, help="Input forest exported by flat_forest.py, used instead of the pickle file (default is %(default)s)")
+
+    p.add_argument("--colour-cache", dest="colourcache", action="store_true", default=False, help="Cache the class of each rgb colour in each worker")
+
+    p.add_argument("--workers", type=int, default=multiprocessing.cpu_count(), help="Number of worker processes (default is %(default)s)")
+
+    p.add_argument("--memory", type=int, default=4096, help="Memory budget in MB shared by all of the workers (default is %(default)s)")
+
+    p.add_argument("--checkpoint", type=int, default=16, help="Number of windows written between each checkpoint of the progress file (default is %(default)s)")
+
+    p.add_argument("--resume", action="store_true", default=False, help="Resume a run that did not finish")
+
+    # the output is left uncompressed unless a compression or --cog is given
+    classified_output.addOutputArgs(p, compress=None)
+
+    cmdargs = p.parse_args()
+
+    if cmdargs.reffile is None or cmdargs.outfile is None:
+        p.print_help()
+        sys.exit()
+
+    return cmdargs
+
+
+def classifierMemory(picklefile, lut=None, forest=None, colourCache=False):
+    """
+    return the memory (MB) each worker needs before classifying any pixels,
+    the memory (MB) of the classifier shared by all of the workers and the
+    working memory (bytes) needed for each pixel of a window. The lookup table
+    and the exported forest are memory mapped so their pages are shared
+    """
+    if lut is not None:
+        return (WORKER_BASE_MB, os.path.getsize(lut) / 2 ** 20, BYTES_PER_PIXEL['lut'])
+
+    # the colour cache of each worker holds the class of every rgb colour
+    workerMemory = WORKER_BASE_MB + (classifier.NUM_RGB / 2 ** 20 if colourCache else 0)
+    if forest is not None:
+        return (workerMemory, os.path.getsize(forest) / 2 ** 20, BYTES_PER_PIXEL['forest'])
+
+    return (workerMemory + PICKLE_MEMORY_FACTOR * os.path.getsize(picklefile) / 2 ** 20, 0, BYTES_PER_PIXEL['rf'])
+
+
+def windowShape(width, height, blockShape, workers, memory, workerMemory=0, sharedMemory=0, bytesPerPixel=BYTES_PER_PIXEL['rf']):
+    """
+    return the number of rows and columns of each window, the windows are a
+    whole number of the image blocks and sized so all of the workers together
+    stay within the memory budget (MB), after the memory each worker needs
+    for the classifier (workerMemory) and the memory shared by the workers
+    """
+    blockRows, blockCols = blockShape
+
+    available = memory - workers * workerMemory - sharedMemory
+    if available * 1024 * 1024 < workers * blockRows * blockCols * bytesPerPixel:
+        raise ValueError('a memory budget of %d MB is too small for %d workers, each worker needs about %.0f MB for the classifier '
+                         'and %.0f MB for a block of the mosaic' % (memory, workers, workerMemory, 
+                                                                    blockRows * blockCols * bytesPerPixel / 2 ** 20))
+
+    pixels = max(1, int(available * 1024 * 1024) // (workers * bytesPerPixel))
+
+    # as close to square as the blocks allow, with at least one block in each direction
+    nBlockCols = max(1, min(int(math.ceil(width / blockCols)), int(math.sqrt(pixels) // blockCols)))
+    nBlockRows = max(1, min(int(math.ceil(height / blockRows)), int(pixels // (nBlockCols * blockCols) // blockRows)))
+
+    return (nBlockRows * blockRows, nBlockCols * blockCols)
+
+
+def mosaicWindows(width, height, rows, cols):
+    """
+    split the mosaic into windows of the given size, the windows on the
+    right and bottom edges are clipped to the extent of the mosaic
+    """
+    windows = []
+    for rowOff in range(0, height, rows):
+        for colOff in range(0, width, cols):
+            windows.append(Window(colOff, rowOff, min(cols, width - colOff), min(rows, height - rowOff)))
+
+    return windows
+
+
+def readProgress(donefile):
+    """
+    read the window size and the windows recorded as complete in the progress
+    file, the window size is None if there is no progress file. The windows are
+    returned as a dict of the index of each window and its class counts, the
+    counts are None for a window recorded without them
+    """
+    shape = None
+    done = {}
+    if os.path.exists(donefile):
+        with open(donefile) as f:
+            for line in f:
+                if line.startswith('#'):
+                    # the window size used by the run is recorded on the first line
+                    shape = tuple(int(v) for v in line[1:].split())
+                elif line.strip() != '':
+                    values = [int(v) for v in line.split()]
+                    done[values[0]] = np.array(values[1:], dtype=np.int64) if len(values) == classifier.NUM_CLASSES + 2 else None
+
+    return (shape, done)
+
+
+def progressLines(pending):
+    """
+    the lines of the progress file for the completed windows, the index of
+    each window followed by its class counts
+    """
+    return ''.join(' '.join(str(int(v)) for v in [index] + list(counts)) + '\n' for index, counts in pending)
+
+
+# the classifier and open mosaic held by each worker process
+workerState = {}
+
+
+def initWorker(reffile, picklefile, lut, colourCache=False, forest=None):
+    """
+    load the classifier and open the mosaic once in each worker process
+    """
+    workerState['model'] = classifier.loadModel(picklefile, lut, colourCache, forest)
+
+    # each worker uses a single core so the pool does not oversubscribe the node
+    if hasattr(workerState['model'].rf, 'n_jobs'):
+        workerState['model'].rf.n_jobs = 1
+
+    workerState['dataset'] = rasterio.open(reffile)
+
+
+def classifyWindow(task):
+    """
+    read and classify a single window of the mosaic in a worker process
+    """
+    index, window = task
+
+    model = workerState['model']
+    model.classCounts = np.zeros(classifier.NUM_CLASSES + 1, dtype=np.int64)
+
+    image = workerState['dataset'].read([1, 2, 3], window=window)
+
+    colourCache = model.colourCache
+    if colourCache is not None:
+        hits, lookups = (colourCache.hits, colourCache.hits + colourCache.misses)
+
+    hgtBlock = classifier.classifyBlock(image, model)
+
+    # the colour cache hits and lookups for this window
+    if colourCache is not None:
+        cacheStats = (colourCache.hits - hits, colourCache.hits + colourCache.misses - lookups)
+    else:
+        cacheStats = (0, 0)
+
+    return (index, window, hgtBlock, model.classCounts, cacheStats)
+
+
+def classifyMosaic(reffile, outfile, picklefile="rfc_cpickle_20200615.p", lut=None, workers=1,
+                   memory=4096, checkpoint=16, resume=False, colourCache=False, forest=None):
+    """
+    classify the mosaic window by window across a pool of worker processes
+    and write the result to a single tiled GeoTIFF. Returns the pixel counts
+    for each class over the whole mosaic, the counts of the windows completed
+    by an earlier run are read from the progress file. None is returned when
+    the progress file does not hold the counts of every completed window
+    """
+    donefile = outfile + '.done'
+
+    with rasterio.open(reffile) as src:
+        width = src.width
+        height = src.height
+        blockShape = src.block_shapes[0]
+        profile = src.profile.copy()
+
+    if resume and os.path.exists(outfile):
+        shape, done = readProgress(donefile)
+    else:
+        shape, done = (None, {})
+        
+    # a resumed run has to use the same windows as the run it continues
+    if shape is None:
+        shape = windowShape(width, height, blockShape, workers, memory, *classifierMemory(picklefile, lut, forest, colourCache))
+        
+    rows, cols = shape
+    windows = mosaicWindows(width, height, rows, cols)
+
+    if not (resume and os.path.exists(outfile)):
+        # create the empty output image, tiled in blocks of OUT_BLOCKSIZE
+        profile.update(driver='GTiff', count=1, dtype='uint8', nodata=0, tiled=True,
+                       blockxsize=OUT_BLOCKSIZE, blockysize=OUT_BLOCKSIZE, BIGTIFF='IF_SAFER')
+        for key in ['compress', 'photometric', 'interleave']:
+            profile.pop(key, None)
+        with rasterio.open(outfile, 'w', **profile):
+            pass
+        
+    if len(done) == 0:
+        with open(donefile, 'w') as f:
+            f.write('# %d %d\n' % (rows, cols))
+
+    tasks = [(index, window) for index, window in enumerate(windows) if index not in done]
+
+    print ('%d windows of %d x %d pixels, %d already complete' % (len(windows), cols, rows, len(done)))
+
+    # limit the number of windows waiting to be written so the memory budget holds
+    inFlight = threading.BoundedSemaphore(2 * workers)
+    stop = threading.Event()
+
+    def feedTasks():
+        # runs in the task handler thread of the pool, so it gives up when the run stops rather than blocking the pool from closing
+        for task in tasks:
+            while not inFlight.acquire(timeout=0.1):
+                if stop.is_set():
+                    return
+            yield task
+
+    # the class counts of the windows completed by an earlier run are added back
+    classCounts = np.zeros(classifier.NUM_CLASSES + 1, dtype=np.int64)
+    for counts in done.values():
+        if counts is not None:
+            classCounts += counts
+    complete = all(counts is not None for counts in done.values())
+    numPixels = 0
+    cacheHits = 0
+    cacheLookups = 0
+    pending = []
+    startTime = time.time()
+
+    pool = multiprocessing.Pool(workers, initializer=initWorker, initargs=(reffile, picklefile, lut, colourCache, forest))
+    dst = rasterio.open(outfile, 'r+')
+    failed = True
+    try:
+        for index, window, hgtBlock, counts, cacheStats in pool.imap_unordered(classifyWindow, feedTasks()):
+            dst.write(hgtBlock, window=window)
+            inFlight.release()
+
+            classCounts += counts
+            cacheHits += cacheStats[0]
+            cacheLookups += cacheStats[1]
+            numPixels += int(window.width * window.height)
+            pending.append((index, counts))
+
+            # close and reopen the output so the written windows are on disk before they are recorded as complete
+            if len(pending) >= checkpoint:
+                dst.close()
+                with open(donefile, 'a') as f:
+                    f.write(progressLines(pending))
+                pending = []
+                dst = rasterio.open(outfile, 'r+')
+        failed = False
+    finally:
+        stop.set()
+        dst.close()
+        if len(pending) > 0:
+            with open(donefile, 'a') as f:
+                f.write(progressLines(pending))
+        # a failed window, write or Ctrl-C stops the workers straight away, the completed windows are already recorded for --resume
+        if failed:
+            pool.terminate()
+        else:
+            pool.close()
+        pool.join()
+
+    elapsed = time.time() - startTime
+    selfRSS, childRSS = classifier.peakMemory()
+
+    print ('%d pixels classified in %.1f seconds, %.0f pixels/sec' % (numPixels, elapsed, numPixels / max(elapsed, 1e-9)))
+    if selfRSS is not None:
+        print ('peak memory: %.0f MB main process, %.0f MB largest worker' % (selfRSS, childRSS))
+    if colourCache and lut is None:
+        print ('colour cache hit rate: %.1f%% of %d pixels looked up' % (100 * cacheHits / max(cacheLookups, 1), cacheLookups))
+
+    # the run is complete so the progress file is no longer needed
+    if len(readProgress(donefile)[1]) == len(windows):
+        os.remove(donefile)
+
+    if not complete:
+        print ('the progress file does not hold the class counts of the windows completed before --resume')
+        return None
+
+    return classCounts
+
+
+def main():
+    """
+    Main routine
+
+    """
+    cmdargs = getCmdargs()
+
+    start = time.time()
+    classCounts = classifyMosaic(cmdargs.reffile, cmdargs.outfile, cmdargs.picklefile, cmdargs.lut, cmdargs.workers,
+                                 cmdargs.memory, cmdargs.checkpoint, cmdargs.resume, cmdargs.colourcache,
+                                 cmdargs.forest)
+    writeSeconds = time.time() - start
+
+    # the windows are written out of order so the compressed image is written in a single copy once they are all complete
+    compress = cmdargs.compress
+    if compress is None and cmdargs.cog:
+        compress = 'DEFLATE'
+    if compress is not None and not os.path.exists(cmdargs.outfile + '.done'):
+        finishSeconds = classified_output.finishOutput(cmdargs.outfile, compress, cmdargs.predictor, cmdargs.level,
+                                                       cmdargs.blocksize, cmdargs.cog, rewrite=True)
+        classified_output.outputReport(cmdargs.outfile, writeSeconds, finishSeconds)
+
+    # report the percentage of the non-null pixels in each class of the whole mosaic
+    if classCounts is not None:
+        fractions = classifier.classFractions(classCounts)
+        for name in classifier.CLASS_NAMES:
+            print ('%s: %.2f' % (name, fractions[name]))
+
+    print (cmdargs.outfile + ' complete')
+
+
+if __name__ == "__main__":
+    main()
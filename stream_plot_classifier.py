@@ -0,0 +1,226 @@
+#!/usr/bin/env python
+
+"""
+This code classifies the plots straight out of the digital aerial photography mosaic and streams the woody FPC and the other class
+fractions of each plot, replacing the three steps of clipping each plot to an image chip on disk (multi_clip_tool_rasterio.py),
+listing the image chips (list_of_files_in_dir.py) and reading them back in to be classified (apply_rgb_comb_classifier_multi.py).
+
+The plot polygons are read once from a single GeoPackage or shapefile and matched to each mosaic with a spatial index. The window of
+the mosaic covering each plot is read in memory, the pixels outside the polygon are set to no data and the window is classified with
+the random forest classifer from "rgb_digital_aerial_photo_classifier.py". The results are written to the csv as each plot is
+classified, so they can be read while the run continues, and are also available to other scripts as a generator (streamPlots).
+
+The clipped image chips and the classified image chips are only written to disk when --chipdir is given.
+
+The five classes represent cover for;
+
+Class               Pixel value            Description
+------------------------------------------------------------------------------------------
+Woody green:          1                    Green leaf for all woody vegetation
+Non-woody green:      2                    Green leaf from all non-woody vegetation
+Bare/npv vegetation:  3                    Bare ground and senescent vegetation (woody and non-woody)
+Shadow:               4                    Shadow
+Branch/trunk:         5                    Branches and trunks of woody vegetation
+------------------------------------------------------------------------------------------
+
+###############################################################################################
+
+MIT License
+
+Copyright (c) 2020 Grant Staben
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+
+###############################################################################################
+
+Parameters:
+-----------
+
+vector : GeoPackage or shapefile
+            single file containing all of the plot polygons.
+
+idfield : str
+            field in the vector file that identifies each plot.
+
+images : raster image files .tif
+            8 bit digital aerial photography mosaics the plots are classified from.
+
+csv : csv file
+            name of the csv file the fpc and class fractions of each plot are written to, - writes to the standard output.
+
+picklefile : serilised pickle file
+            serilised random forest classifer, loaded once and kept in memory while all of the plots are classified.
+
+lut : numpy file .npy (optional)
+            precomputed rgb lookup table produced by build_rgb_lookup_table.py, used instead of the pickle file.
+
+forest : numpy file .npz (optional)
+            random forest exported by flat_forest.py, used instead of the pickle file so scikit-learn is not needed.
+
+colour-cache : flag (optional)
+            use the colour cache, only the unique colours not already classified are passed to the random forest.
+
+chipdir : str (optional)
+            directory the clipped image chips (<id>_<image name>.tif) and the classified image chips
+            (<id>_<image name>_rgb_comb_class.tif) are written to, nothing is written when not given.
+
+"""
+
+from __future__ import print_function, division
+
+import sys
+import os
+import csv
+import argparse
+import numpy as np
+import rasterio
+import rgb_digital_aerial_photo_classifier as classifier
+import multi_clip_tool_rasterio as clipper
+
+# the columns of the csv, the woody green fraction is the fpc
+COLUMNS = ['site', 'image', 'fpc'] + classifier.CLASS_NAMES[1:] + ['nonnull', 'status']
+
+
+def getCmdargs():
+    """
+    Get command line arguments
+    """
+    p = argparse.ArgumentParser()
+
+    p.add_argument("-v", "--vector", help="GeoPackage or shapefile containing all of the plot polygons")
+
+    p.add_argument("-f", "--idfield", default="id", help="field in the vector file identifying each plot (default is %(default)s)")
+
+    p.add_argument("-r", "--images", nargs="+", help="8 bit digital aerial photography mosaics")
+
+    p.add_argument("-c", "--csv", default="-", help="output csv file of the plot fractions, - for the standard output (default is %(default)s)")
+
+    p.add_argument("-p", "--picklefile", default="rfc_cpickle_20200615.p", help="Input pickle file (default is %(default)s)")
+
+    p.add_argument("--lut", default=None, help="Input rgb lookup table used instead of the pickle file (default is %(default)s)")
+
+    p.add_argument("--forest", default=None, help="Input forest exported by flat_forest.py, used instead of the pickle file (default is %(default)s)")
+
+    p.add_argument("--colour-cache", dest="colourcache", action="store_true", default=False, help="cache the class of each rgb colour so only the colours not already classified are passed to the random forest")
+
+    p.add_argument("--chipdir", default=None, help="directory the clipped and classified image chips are written to, none are written by default")
+
+    cmdargs = p.parse_args()
+
+    if cmdargs.vector is None or cmdargs.images is None:
+        p.print_help()
+        sys.exit()
+
+    return cmdargs
+
+
+def writePlotChips(chipdir, chipName, data, out_img, out_transform, hgtBlock):
+    """
+    write the clipped image chip and the classified image chip of a plot
+    """
+    out_meta = data.meta.copy()
+    out_meta.update({"driver": "GTiff", "crs": data.crs, "height": out_img.shape[1], "width": out_img.shape[2],
+                     "transform": out_transform})
+    clipper.writeChip(os.path.join(chipdir, chipName + '.tif'), out_img, out_meta)
+
+    out_meta.update({"count": 1, "dtype": "uint8", "nodata": None})
+    clipper.writeChip(os.path.join(chipdir, chipName + '_rgb_comb_class.tif'), hgtBlock, out_meta)
+
+
+def streamPlots(vector, idfield, images, model, chipdir=None):
+    """
+    classify each plot in the vector file straight out of the mosaics it
+    overlaps and yield the fpc and class fractions of the plots one at a time
+    """
+    plots = clipper.readPlots(vector, idfield)
+
+    # the spatial index for each projection the plots are needed in
+    indexes = {}
+
+    for inImage in images:
+        imageName = os.path.splitext(os.path.basename(inImage))[0]
+
+        with rasterio.open(inImage) as data:
+            for plotId, coords in clipper.imagePlots(data, plots, idfield, indexes):
+                result = {'site': plotId, 'image': imageName}
+
+                try:
+                    # the window covering the plot with the pixels outside the polygon set to no data
+                    out_img, out_transform = clipper.clipPolygon(data, coords)
+
+                    model.classCounts = np.zeros(classifier.NUM_CLASSES + 1, dtype=np.int64)
+                    hgtBlock = classifier.classifyBlock(out_img, model)
+
+                    if chipdir is not None:
+                        writePlotChips(chipdir, '%s_%s' % (plotId, imageName), data, out_img, out_transform, hgtBlock)
+                except Exception as err:
+                    print (str(plotId) + ' ' + imageName + ' failed: ' + str(err), file=sys.stderr)
+                    result.update(classifier.classFractions(np.zeros(classifier.NUM_CLASSES + 1)))
+                    result['status'] = 'failed'
+                    yield result
+                    continue
+
+                result.update(classifier.classFractions(model.classCounts))
+                result['status'] = 'ok'
+
+                yield result
+
+
+def main():
+    """
+    Main routine
+
+    """
+    cmdargs = getCmdargs()
+
+    model = classifier.loadModel(cmdargs.picklefile, cmdargs.lut, cmdargs.colourcache, cmdargs.forest)
+
+    if cmdargs.chipdir is not None and not os.path.isdir(cmdargs.chipdir):
+        os.makedirs(cmdargs.chipdir)
+
+    output = sys.stdout if cmdargs.csv == '-' else open(cmdargs.csv, 'w', newline='')
+
+    numPlots = 0
+    failed = []
+    try:
+        writer = csv.DictWriter(output, fieldnames=COLUMNS, extrasaction='ignore')
+        writer.writeheader()
+
+        for result in streamPlots(cmdargs.vector, cmdargs.idfield, cmdargs.images, model, cmdargs.chipdir):
+            result['fpc'] = result['woody_green']
+            writer.writerow(result)
+            # each plot is available in the csv as soon as it is classified
+            output.flush()
+
+            numPlots += 1
+            if result['status'] != 'ok':
+                failed.append('%s %s' % (result['site'], result['image']))
+    finally:
+        if output is not sys.stdout:
+            output.close()
+
+    print (str(numPlots) + ' plots classified', file=sys.stderr)
+
+    if len(failed) > 0:
+        print (str(len(failed)) + ' plots failed: ' + ', '.join(failed), file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,70 @@
+import os
+import sys
+import pickle
+
+import numpy as np
+import pytest
+
+# the scripts are run from the root of the repository, so the tests import them from there
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def syntheticPixels(numPixels, seed=0):
+    """
+    8 bit rgb pixels of five classes (1 to 5) scattered around a colour each
+    """
+    rng = np.random.RandomState(seed)
+    centres = rng.randint(0, 256, size=(5, 3))
+    labels = rng.randint(0, 5, size=numPixels)
+    rgb = np.clip(centres[labels] + rng.normal(0, 40, size=(numPixels, 3)), 0, 255).astype(np.uint8)
+
+    return rgb, labels + 1
+
+
+@pytest.fixture(scope='session')
+def picklefile(tmp_path_factory):
+    """
+    a small random forest pickled the same way as the training script
+    """
+    from sklearn.ensemble import RandomForestClassifier
+
+    rgb, labels = syntheticPixels(3000)
+    rf = RandomForestClassifier(n_estimators=10, max_depth=8, random_state=0)
+    rf.fit(rgb.astype(np.float32), labels)
+
+    path = str(tmp_path_factory.mktemp('model') / 'rf.p')
+    with open(path, 'wb') as f:
+        pickle.dump(rf, f, protocol=2)
+
+    return path
+
+
+def writeChip(path, seed, size=48):
+    """
+    write an 8 bit rgb image chip with a row of null pixels along the top
+    """
+    import rasterio
+    from rasterio.transform import from_origin
+
+    rng = np.random.RandomState(seed)
+    image = rng.randint(1, 256, size=(3, size, size)).astype(np.uint8)
+    image[:, 0, :] = 0
+
+    with rasterio.open(path, 'w', driver='GTiff', width=size, height=size, count=3, dtype='uint8', nodata=0,
+                       crs='EPSG:28352', transform=from_origin(700000, 8600000, 0.15, 0.15)) as dst:
+        dst.write(image)
+
+
+@pytest.fixture
+def chipdir(tmp_path):
+    """
+    a directory of six image chips and the list of imagery naming them
+    """
+    names = ['chip%d.tif' % i for i in range(6)]
+    for seed, name in enumerate(names):
+        writeChip(str(tmp_path / name), seed)
+
+    imglist = tmp_path / 'img_list.csv'
+    imglist.write_text(''.join(name + '\n' for name in names))
+
+    return str(tmp_path) + os.sep, str(imglist), names
@@ -0,0 +1,143 @@
+"""
+behaviour of the batch classifier apply_rgb_comb_classifier_multi.py
+"""
+import json
+import multiprocessing
+
+import numpy as np
+import pytest
+
+pytest.importorskip('rios')
+
+import apply_rgb_comb_classifier_multi as batch
+
+
+def testResultCacheSkipsChipsWithSpawnedWorkers(chipdir, picklefile, tmp_path, monkeypatch):
+    # workers started with spawn (the default on Windows and macOS) do not inherit the state of the parent process
+    monkeypatch.setattr(batch.multiprocessing, 'Pool', multiprocessing.get_context('spawn').Pool)
+    directory, imglist, names = chipdir
+    cache = str(tmp_path / 'manifest.jsonl')
+
+    first = batch.applyModel(imglist, directory, picklefile, workers=2, writeRaster=False, cache=cache)
+
+    assert all(result['status'] == 'ok' and not result.get('cached') for result in first)
+    with open(cache) as f:
+        assert len([json.loads(line) for line in f]) == len(names)
+
+    second = batch.applyModel(imglist, directory, picklefile, workers=2, writeRaster=False, cache=cache)
+
+    assert all(result.get('cached') for result in second)
+    assert [result['woody_green'] for result in second] == [result['woody_green'] for result in first]
+
+
+def testResultCacheReclassifiesChangedChips(chipdir, picklefile, tmp_path):
+    from conftest import writeChip
+
+    directory, imglist, names = chipdir
+    cache = str(tmp_path / 'manifest.jsonl')
+
+    batch.applyModel(imglist, directory, picklefile, writeRaster=False, cache=cache)
+    writeChip(directory + names[2], seed=99)
+    second = batch.applyModel(imglist, directory, picklefile, writeRaster=False, cache=cache)
+
+    assert [bool(result.get('cached')) for result in second] == [name != names[2] for name in names]
+
+
+def testEstimateOfEveryPixelIsExact(chipdir, picklefile):
+    directory, imglist, names = chipdir
+    model = batch.classifier.loadModel(picklefile)
+    counts, outfile = batch.classifier.classify_chip(directory + names[0], model, None, False)
+    exact = batch.classifier.classFractions(counts)
+
+    # a zero tolerance samples every pixel
+    estimate, sampledCounts = batch.sampleChip(directory + names[0], model, 0.0, batch=500)
+
+    assert estimate['sample_fraction'] == 1.0
+    assert estimate['sampled'] == exact['nonnull']
+    np.testing.assert_array_equal(sampledCounts[1:], counts[1:])
+    for name in batch.classifier.CLASS_NAMES:
+        assert estimate[name] == pytest.approx(exact[name])
+
+
+def testEstimateStopsWithinTheTolerance(chipdir, picklefile, monkeypatch):
+    directory, imglist, names = chipdir
+    model = batch.classifier.loadModel(picklefile)
+    counts, outfile = batch.classifier.classify_chip(directory + names[1], model, None, False)
+    exact = batch.classifier.classFractions(counts)['woody_green']
+
+    # the number of pixels in each call to the classifier
+    calls = []
+    classifyBlock = batch.classifier.classifyBlock
+    def countingClassifyBlock(image, otherargs):
+        calls.append(image.shape[2])
+        return classifyBlock(image, otherargs)
+    monkeypatch.setattr(batch.classifier, 'classifyBlock', countingClassifyBlock)
+
+    estimate, sampledCounts = batch.sampleChip(directory + names[1], model, 6.0, batch=200, strata=2)
+
+    assert estimate['fpc_ci'] <= 6.0
+    assert estimate['sample_fraction'] < 1.0
+    assert estimate['fpc_ci_low'] <= exact <= estimate['fpc_ci_high']
+    # a single classification of the pixels sampled from all of the strata in each batch
+    assert sum(calls) == estimate['sampled'] == sampledCounts.sum()
+    assert len(calls) <= estimate['sampled'] // 200 + 1
+
+
+def testParseShard():
+    assert batch.parseShard('2/8') == (2, 8)
+    for shard in ['8/8', '1', '-1/4', 'a/b', '0/0']:
+        with pytest.raises(ValueError):
+            batch.parseShard(shard)
+
+
+def testShardsSplitTheChipsBetweenThem():
+    names = ['chip%d.tif' % i for i in range(200)]
+    shards = [batch.shardOf(name, 4) for name in names]
+
+    assert set(shards) == {0, 1, 2, 3}
+    # the shard only depends on the name of the chip
+    assert shards == [batch.shardOf(name, 4) for name in reversed(names)][::-1]
+    assert batch.shardName('out/results.csv', (1, 4)) == 'out/results.shard-1-of-4.csv'
+
+
+def testMergedShardsMatchAPlainRun(chipdir, picklefile, tmp_path, monkeypatch):
+    directory, imglist, names = chipdir
+
+    def run(*args):
+        monkeypatch.setattr(batch.sys, 'argv', ['apply_rgb_comb_classifier_multi.py'] + list(args))
+        batch.mainRoutine()
+
+    plain = str(tmp_path / 'plain.csv')
+    run('-s', imglist, '-d', directory, '-c', plain, '-p', picklefile, '--no-raster')
+
+    sharded = str(tmp_path / 'sharded.csv')
+    for shard in range(3):
+        run('-s', imglist, '-d', directory, '-c', sharded, '-p', picklefile, '--no-raster', '--shard', '%d/3' % shard)
+    run('merge', '-s', imglist, '-c', sharded)
+
+    with open(plain, 'rb') as a, open(sharded, 'rb') as b:
+        assert a.read() == b.read()
+
+
+def testMergeReportsMissingShards(chipdir, picklefile, tmp_path, monkeypatch):
+    directory, imglist, names = chipdir
+    sharded = str(tmp_path / 'sharded.csv')
+
+    monkeypatch.setattr(batch.sys, 'argv', ['apply_rgb_comb_classifier_multi.py', '-s', imglist, '-d', directory, '-c', sharded,
+                                            '-p', picklefile, '--no-raster', '--shard', '0/3'])
+    batch.mainRoutine()
+
+    monkeypatch.setattr(batch.sys, 'argv', ['apply_rgb_comb_classifier_multi.py', 'merge', '-s', imglist, '-c', sharded])
+    with pytest.raises(SystemExit) as exit:
+        batch.mainRoutine()
+    assert exit.value.code == 1
+
+
+def testSourcesFromTheListOfImagery():
+    import pandas as pd
+
+    df = pd.DataFrame([['a.tif', 'mosaic_2015.tif', '2015-08-01'], ['b.tif', 'mosaic_2016.tif', 'unknown'], ['c.tif', None, None]])
+
+    # a year that can not be read is taken from the image chip instead
+    assert batch.listSources(df) == {'a.tif': ('mosaic_2015.tif', 2015), 'b.tif': ('mosaic_2016.tif', None), 'c.tif': (None, None)}
+    assert batch.listSources(df[[0]]) == {'a.tif': (None, None), 'b.tif': (None, None), 'c.tif': (None, None)}
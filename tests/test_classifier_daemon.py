@@ -0,0 +1,61 @@
+"""
+behaviour of the addresses of the classifier service classifier_daemon.py
+"""
+import importlib
+import socket
+import socketserver
+import sys
+
+import pytest
+
+pytest.importorskip('rios')
+
+import apply_rgb_comb_classifier_multi as batch
+
+
+@pytest.mark.parametrize('address, expected', [
+    ('localhost:8765', (socket.AF_INET, ('127.0.0.1', 8765))),
+    (':8765', (socket.AF_INET, ('127.0.0.1', 8765))),
+    ('127.0.0.2:8765', (socket.AF_INET, ('127.0.0.2', 8765))),
+    ('[::1]:8765', (socket.AF_INET6, ('::1', 8765))),
+])
+def testLoopbackAddressesAreAccepted(address, expected):
+    assert batch.parseAddress(address) == expected
+
+
+@pytest.mark.parametrize('address', ['0.0.0.0:8765', '192.168.1.10:8765', 'example.com:8765', '[::]:8765'])
+def testOtherHostsAreRejected(address):
+    with pytest.raises(ValueError):
+        batch.parseAddress(address)
+
+
+def testSocketPathWithoutUnixSockets(monkeypatch):
+    if hasattr(socket, 'AF_UNIX'):
+        assert batch.parseAddress('./classifier.sock') == (socket.AF_UNIX, './classifier.sock')
+
+    monkeypatch.delattr(socket, 'AF_UNIX', raising=False)
+    with pytest.raises(ValueError):
+        batch.parseAddress('./classifier.sock')
+
+
+def testDaemonDefaultsToALocalhostPortWithoutUnixSockets(monkeypatch):
+    import classifier_daemon
+
+    monkeypatch.delattr(socketserver, 'UnixStreamServer', raising=False)
+    monkeypatch.setattr(sys, 'argv', ['classifier_daemon.py'])
+    try:
+        daemon = importlib.reload(classifier_daemon)
+        cmdargs = daemon.getCmdargs()
+
+        assert batch.parseAddress(cmdargs.socket)[0] == socket.AF_INET
+    finally:
+        monkeypatch.undo()
+        importlib.reload(classifier_daemon)
+
+
+def testDaemonRejectsAnotherHost(monkeypatch):
+    import classifier_daemon
+
+    monkeypatch.setattr(sys, 'argv', ['classifier_daemon.py', '--socket', '0.0.0.0:8765'])
+    with pytest.raises(SystemExit):
+        classifier_daemon.getCmdargs()
@@ -0,0 +1,67 @@
+"""
+check the forest exported by flat_forest.py predicts the same classes as the
+scikit-learn random forest it was exported from
+"""
+import numpy as np
+import pytest
+from sklearn.ensemble import RandomForestClassifier
+
+from flat_forest import FlatForest, exportForest, checkForest
+
+
+@pytest.fixture(scope='module')
+def forests(tmp_path_factory):
+    """
+    a 30 tree forest fitted on synthetic 8 bit rgb pixels of five classes,
+    together with the forest exported from it and loaded from the .npz file
+    """
+    rng = np.random.RandomState(0)
+    centres = rng.randint(0, 256, size=(5, 3))
+    labels = rng.randint(0, 5, size=5000)
+    rgb = np.clip(centres[labels] + rng.normal(0, 40, size=(5000, 3)), 0, 255).astype(np.uint8)
+
+    rf = RandomForestClassifier(n_estimators=30, min_samples_leaf=2, random_state=0)
+    rf.fit(rgb.astype(np.float32), labels + 1)
+
+    forestfile = str(tmp_path_factory.mktemp('forest') / 'forest.npz')
+    exportForest(rf, forestfile)
+
+    return rf, FlatForest.load(forestfile)
+
+
+def gridColours():
+    """
+    262,144 rgb colours, a 64 x 64 x 64 grid spanning 0 to 255 in each band
+    """
+    values = np.round(np.linspace(0, 255, 64)).astype(np.uint8)
+    red, green, blue = np.meshgrid(values, values, values, indexing='ij')
+
+    return np.vstack([red.ravel(), green.ravel(), blue.ravel()]).T
+
+
+def testPredictMatchesRandomForest(forests):
+    rf, forest = forests
+    rgb = gridColours()
+
+    assert rgb.shape == (262144, 3)
+    np.testing.assert_array_equal(forest.predict(rgb), rf.predict(rgb.astype(np.float32)))
+
+
+def testProbabilitiesMatchRandomForest(forests):
+    rf, forest = forests
+    rgb = gridColours()[::16]
+
+    np.testing.assert_allclose(forest.predict_proba(rgb), rf.predict_proba(rgb.astype(np.float32)), rtol=0, atol=1e-12)
+
+
+def testCheckForest(forests):
+    rf, forest = forests
+
+    assert checkForest(forest, rf, nsample=2 ** 16) == 0
+
+
+def testFlatForestKeepsClasses(forests):
+    rf, forest = forests
+
+    np.testing.assert_array_equal(forest.classes_, rf.classes_)
+    assert forest.n_classes_ == rf.n_classes_
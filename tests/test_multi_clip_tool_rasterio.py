@@ -0,0 +1,49 @@
+"""
+behaviour of the block aligned clipping of multi_clip_tool_rasterio.py
+"""
+import numpy as np
+import pytest
+import rasterio
+from rasterio.mask import mask
+from rasterio.transform import from_origin
+from rasterio.windows import Window
+
+import multi_clip_tool_rasterio as clipper
+
+
+@pytest.fixture
+def image(tmp_path):
+    """
+    a tiled three band image of 4 x 3 blocks of 32 pixels
+    """
+    rng = np.random.RandomState(4)
+    data = rng.randint(1, 256, size=(3, 96, 128)).astype(np.uint8)
+
+    path = str(tmp_path / 'image.tif')
+    with rasterio.open(path, 'w', driver='GTiff', width=128, height=96, count=3, dtype='uint8', nodata=0, tiled=True,
+                       blockxsize=32, blockysize=32, crs='EPSG:28352', transform=from_origin(700000, 8600000, 1, 1)) as dst:
+        dst.write(data)
+
+    return path
+
+
+@pytest.mark.parametrize('coords', [
+    # a square across four blocks, a triangle and a polygon running off the edge of the image
+    [{'type': 'Polygon', 'coordinates': [[(700020, 8599980), (700050, 8599980), (700050, 8599950), (700020, 8599950), (700020, 8599980)]]}],
+    [{'type': 'Polygon', 'coordinates': [[(700005.5, 8599990), (700070, 8599930.2), (700010, 8599920), (700005.5, 8599990)]]}],
+    [{'type': 'Polygon', 'coordinates': [[(700100, 8599940), (700140, 8599940), (700140, 8599880), (700100, 8599880), (700100, 8599940)]]}],
+])
+def testClipPolygonMatchesRasterioMask(image, coords):
+    with rasterio.open(image) as data:
+        out_img, out_transform = clipper.clipPolygon(data, coords)
+        expected_img, expected_transform = mask(data, coords, crop=True)
+
+    np.testing.assert_array_equal(out_img, expected_img)
+    assert out_transform == expected_transform
+
+
+def testBlockWindowCoversWholeBlocks(image):
+    with rasterio.open(image) as data:
+        window = clipper.blockWindow(data, Window(40, 10, 30, 60))
+
+    assert (window.col_off, window.row_off, window.width, window.height) == (32, 0, 64, 96)
@@ -0,0 +1,104 @@
+"""
+behaviour of the point sampling of points_stats_singleImage_class.py
+"""
+import numpy as np
+import pytest
+import rasterio
+from rasterio.transform import from_origin
+
+import points_stats_singleImage_class as points
+
+
+@pytest.fixture
+def image(tmp_path):
+    """
+    a tiled three band image of 3 x 3 blocks of 32 pixels
+    """
+    rng = np.random.RandomState(2)
+    data = rng.randint(1, 256, size=(3, 96, 96)).astype(np.uint8)
+
+    path = str(tmp_path / 'image.tif')
+    with rasterio.open(path, 'w', driver='GTiff', width=96, height=96, count=3, dtype='uint8', nodata=0, tiled=True,
+                       blockxsize=32, blockysize=32, crs='EPSG:28352', transform=from_origin(700000, 8600000, 1, 1)) as dst:
+        dst.write(data)
+
+    return path
+
+
+def writePoints(path, xs, ys):
+    import fiona
+
+    schema = {'geometry': 'Point', 'properties': {'uid': 'int', 'class': 'int'}}
+    with fiona.open(path, 'w', driver='ESRI Shapefile', schema=schema, crs='EPSG:28352') as dst:
+        for i, (x, y) in enumerate(zip(xs, ys)):
+            dst.write({'geometry': {'type': 'Point', 'coordinates': (x, y)}, 'properties': {'uid': i, 'class': i % 5 + 1}})
+
+
+def testAllBandsAreSampledUnderEachPoint(image, tmp_path):
+    rng = np.random.RandomState(3)
+    xs = 700000 + rng.uniform(0, 96, 50)
+    ys = 8600000 - rng.uniform(0, 96, 50)
+    shape = str(tmp_path / 'points.shp')
+    writePoints(shape, xs, ys)
+
+    output = points.extractPoints(image, None, shape, 'uid')
+
+    with rasterio.open(image) as src:
+        expected = np.array(list(src.sample(zip(xs, ys))))
+
+    assert list(output.columns) == ['site', 'class', 'b1', 'b2', 'b3']
+    assert list(output['site']) == list(range(50))
+    np.testing.assert_array_equal(output[['b1', 'b2', 'b3']].values, expected)
+    # the bands stay integers when every point has a value
+    assert output['b1'].dtype == np.uint8
+
+
+def testPointPixels():
+    rows, cols = points.pointPixels(from_origin(100, 200, 2, 2), np.array([100.0, 103.9, 99.0]), np.array([200.0, 195.0, 199.0]))
+
+    np.testing.assert_array_equal(rows, [0, 2, 0])
+    np.testing.assert_array_equal(cols, [0, 1, -1])
+
+
+class CountingDataset(object):
+    """
+    wraps an open image and records the windows read from it
+    """
+    def __init__(self, dataset):
+        self.dataset = dataset
+        self.windows = []
+
+    def __getattr__(self, name):
+        return getattr(self.dataset, name)
+
+    def read(self, *args, **kwargs):
+        self.windows.append(kwargs.get('window'))
+        return self.dataset.read(*args, **kwargs)
+
+
+def testOnlyTheBlocksHoldingPointsAreRead(image):
+    # two points in the first block, one in the last block and one off the image
+    rows = np.array([1, 30, 95, 120])
+    cols = np.array([2, 31, 90, 5])
+
+    with rasterio.open(image) as src:
+        dataset = CountingDataset(src)
+        values, numBlocks = points.samplePixels(dataset, rows, cols)
+        data = src.read()
+
+    assert numBlocks == 2
+    assert len(dataset.windows) == 2
+    assert all(window.width == 32 and window.height == 32 for window in dataset.windows)
+    np.testing.assert_array_equal(values[:3], data[:, rows[:3], cols[:3]].T)
+    assert np.isnan(values[3]).all()
+
+
+def testNoDataPointsAreNan(image):
+    with rasterio.open(image, 'r+') as dst:
+        dst.write(np.zeros((3, 1, 1), dtype=np.uint8), window=rasterio.windows.Window(4, 4, 1, 1))
+
+    with rasterio.open(image) as src:
+        values, numBlocks = points.samplePixels(src, np.array([4, 5]), np.array([4, 5]), nodata=0)
+
+    assert np.isnan(values[0]).all()
+    assert not np.isnan(values[1]).any()
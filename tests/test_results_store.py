@@ -0,0 +1,90 @@
+"""
+behaviour of the results store results_store.py
+"""
+import numpy as np
+import pandas as pd
+import pytest
+
+import results_store
+
+
+def chipResult(site, fpc, status='ok'):
+    return {'site': site, 'woody_green': fpc, 'non_woody_green': 100.0 - fpc, 'bare_npv': 0.0, 'shadow': 0.0,
+            'branch_trunk': 0.0, 'nonnull': np.int64(2256), 'status': status}
+
+
+def testResultsAreWrittenInBatches(tmp_path):
+    path = str(tmp_path / 'results.sqlite')
+    store = results_store.ResultsStore(path, modelHash='abc', batchSize=2)
+
+    store.append(chipResult('a.tif', 10.0), year=2015)
+    assert (store.written, len(store.rows)) == (0, 1)
+    assert len(results_store.queryStore(path)) == 0
+
+    store.append(chipResult('b.tif', 20.0), year=2016)
+    store.append(chipResult('c.tif', 30.0), year=2016)
+    assert (store.written, len(store.rows)) == (2, 1)
+    assert len(results_store.queryStore(path)) == 2
+
+    store.close()
+    assert store.written == 3
+    assert len(results_store.queryStore(path)) == 3
+
+
+def testQueryBySiteAndYear(tmp_path):
+    path = str(tmp_path / 'results.sqlite')
+    store = results_store.ResultsStore(path, modelHash='abc')
+    store.append(chipResult('a.tif', 10.0), year=2015)
+    store.append(chipResult('b.tif', 20.0), year=2016)
+    store.append(chipResult('c.tif', 30.0))
+    store.close()
+
+    df = results_store.queryStore(path, year=2016)
+    assert list(df['site']) == ['b.tif']
+    assert df['fpc'].iloc[0] == pytest.approx(20.0)
+    assert df['nonnull'].iloc[0] == 2256
+
+    df = results_store.queryStore(path, site='c.tif')
+    # a chip without a year keeps the integer type of the column
+    assert str(df['year'].dtype) == 'Int64'
+    assert pd.isna(df['year'].iloc[0])
+
+
+def testNanIsStoredAsNull():
+    assert results_store.storeValue(float('nan')) is None
+    assert results_store.storeValue(np.float64('nan')) is None
+    assert results_store.storeValue(np.int64(3)) == 3
+    assert type(results_store.storeValue(np.int64(3))) is int
+    assert results_store.storeValue('ok') == 'ok'
+
+
+def testAcquisitionYear(tmp_path):
+    import rasterio
+    from rasterio.transform import from_origin
+
+    path = str(tmp_path / 'chip.tif')
+    with rasterio.open(path, 'w', driver='GTiff', width=4, height=4, count=1, dtype='uint8', crs='EPSG:28352',
+                       transform=from_origin(700000, 8600000, 0.15, 0.15)) as dst:
+        dst.write(np.ones((1, 4, 4), dtype=np.uint8))
+        dst.update_tags(TIFFTAG_DATETIME='2012:07:21 10:30:00')
+
+    # the metadata of the image chip is read before its name
+    assert results_store.acquisitionYear(path) == 2012
+    assert results_store.acquisitionYear(str(tmp_path / 'site_42_2018_rgb.tif')) == 2018
+    assert results_store.acquisitionYear(str(tmp_path / 'site_12345.tif')) is None
+
+
+def testMergingTwiceDoesNotDuplicateRows(tmp_path):
+    shards = []
+    for shard, sites in enumerate([['a.tif', 'b.tif'], ['c.tif']]):
+        shards.append(str(tmp_path / ('results.shard-%d-of-2.sqlite' % shard)))
+        store = results_store.ResultsStore(shards[-1], modelHash='abc')
+        for site in sites:
+            store.append(chipResult(site, 10.0), year=2015)
+        store.close()
+
+    merged = str(tmp_path / 'results.sqlite')
+    assert results_store.mergeStores(merged, shards) == 3
+    assert results_store.mergeStores(merged, shards) == 3
+
+    assert list(results_store.queryStore(merged)['site']) == ['a.tif', 'b.tif', 'c.tif']
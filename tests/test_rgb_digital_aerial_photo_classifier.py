@@ -0,0 +1,103 @@
+"""
+behaviour of the colour cache and the class counts of rgb_digital_aerial_photo_classifier.py
+"""
+import numpy as np
+import pytest
+
+pytest.importorskip('rios')
+
+import rgb_digital_aerial_photo_classifier as classifier
+
+
+class CountingForest(object):
+    """
+    stands in for the random forest, the class is the red value % 5 + 1 and
+    the number of colours classified is counted
+    """
+    def __init__(self):
+        self.classified = 0
+
+    def predict(self, rgb):
+        self.classified += rgb.shape[0]
+        return (rgb[:, 0].astype(np.int64) % 5 + 1).astype(np.uint8)
+
+
+def keysOf(red):
+    return classifier.packRGB(np.asarray(red, dtype=np.uint8), np.zeros(len(red), np.uint8), np.zeros(len(red), np.uint8))
+
+
+def testCachePredictsTheForestClasses():
+    cache = classifier.ColourCache()
+    keys = keysOf([7, 7, 9, 200, 9])
+
+    np.testing.assert_array_equal(cache.predict(keys, CountingForest()), [3, 3, 5, 1, 5])
+    np.testing.assert_array_equal(cache.predict(keys, CountingForest()), [3, 3, 5, 1, 5])
+
+
+def testHitRateIsWeightedByPixels():
+    cache = classifier.ColourCache()
+    forest = CountingForest()
+
+    cache.predict(keysOf([1, 1, 1, 2]), forest)
+    assert (cache.hits, cache.misses) == (0, 4)
+
+    # three pixels of a cached colour and one new colour
+    cache.predict(keysOf([1, 1, 1, 3]), forest)
+    assert (cache.hits, cache.misses, cache.pixels) == (3, 5, 8)
+    assert cache.hitRate() == pytest.approx(3 / 8)
+
+    # each unique colour is only classified once
+    assert forest.classified == 3
+
+
+def testLaterPalettesAreCachedToo():
+    cache = classifier.ColourCache()
+    forest = CountingForest()
+    first = keysOf(range(0, 100))
+    second = keysOf(range(100, 256))
+
+    cache.predict(first, forest)
+    cache.predict(second, forest)
+    assert cache.size == 256
+
+    # nothing is evicted, so every colour of both palettes is found again
+    hits = cache.hits
+    cache.predict(np.concatenate([first, second]), forest)
+    assert cache.hits - hits == 256
+    assert forest.classified == 256
+
+
+
+def testClassFractionsOfTheNonNullPixels():
+    fractions = classifier.classFractions(np.array([10, 30, 10, 0, 0, 0]))
+
+    assert fractions['nonnull'] == 40
+    assert fractions['woody_green'] == pytest.approx(75.0)
+    assert fractions['non_woody_green'] == pytest.approx(25.0)
+    assert fractions['shadow'] == 0
+
+
+def testClassFractionsOfAnEmptyChipAreNan():
+    fractions = classifier.classFractions(np.zeros(classifier.NUM_CLASSES + 1))
+
+    assert fractions['nonnull'] == 0
+    assert np.isnan(fractions['woody_green'])
+
+
+def testCountsMatchTheClassifiedImage(chipdir, picklefile, tmp_path):
+    import rasterio
+
+    directory, imglist, names = chipdir
+    model = classifier.loadModel(picklefile)
+
+    counts, outfile = classifier.classify_chip(directory + names[0], model, str(tmp_path / 'class.tif'), True)
+    countsOnly, noOutfile = classifier.classify_chip(directory + names[0], model, str(tmp_path / 'unused.tif'), False)
+
+    with rasterio.open(outfile) as dataset:
+        written = np.bincount(dataset.read(1).ravel(), minlength=classifier.NUM_CLASSES + 1)
+
+    np.testing.assert_array_equal(counts, written)
+    np.testing.assert_array_equal(countsOnly, written)
+    assert noOutfile is None
+    # the top row of the chip is null
+    assert counts[0] == 48
@@ -0,0 +1,79 @@
+"""
+behaviour of the window sizing and --resume of rgb_mosaic_classifier.py
+"""
+import shutil
+
+import numpy as np
+import pytest
+
+pytest.importorskip('rios')
+
+import rasterio
+from rasterio.transform import from_origin
+
+import rgb_mosaic_classifier as mosaicClassifier
+
+
+@pytest.fixture
+def mosaic(tmp_path):
+    """
+    a tiled 8 bit rgb mosaic of 3 x 2 blocks of 128 pixels with a null border
+    """
+    rng = np.random.RandomState(1)
+    image = rng.randint(1, 256, size=(3, 300, 400)).astype(np.uint8)
+    image[:, :, :5] = 0
+
+    path = str(tmp_path / 'mosaic.tif')
+    with rasterio.open(path, 'w', driver='GTiff', width=400, height=300, count=3, dtype='uint8', tiled=True, blockxsize=128,
+                       blockysize=128, crs='EPSG:28352', transform=from_origin(700000, 8600000, 0.15, 0.15)) as dst:
+        dst.write(image)
+
+    return path
+
+
+def testWindowsLeaveRoomForTheClassifierOfEachWorker():
+    rows, cols = mosaicClassifier.windowShape(10000, 10000, (256, 256), 4, 4096, workerMemory=0, bytesPerPixel=100)
+    budgetRows, budgetCols = mosaicClassifier.windowShape(10000, 10000, (256, 256), 4, 4096, workerMemory=800, bytesPerPixel=100)
+
+    # four workers of 800 MB leave 896 MB for the windows
+    assert budgetRows * budgetCols < rows * cols
+    assert 4 * budgetRows * budgetCols * 100 <= 896 * 1024 * 1024
+
+
+def testBudgetTooSmallForTheWorkersIsRejected():
+    with pytest.raises(ValueError):
+        mosaicClassifier.windowShape(10000, 10000, (256, 256), 8, 1024, workerMemory=200, bytesPerPixel=100)
+
+
+def testResumeReportsTheCountsOfTheWholeMosaic(mosaic, picklefile, tmp_path):
+    full = str(tmp_path / 'full.tif')
+    fullCounts = mosaicClassifier.classifyMosaic(mosaic, full, picklefile)
+
+    # a run that stopped after the first three windows of 128 x 128 pixels
+    resumed = str(tmp_path / 'resumed.tif')
+    shutil.copy(full, resumed)
+    windows = mosaicClassifier.mosaicWindows(400, 300, 128, 128)
+    with rasterio.open(resumed, 'r+') as dst:
+        for window in windows[3:]:
+            dst.write(np.zeros((1, int(window.height), int(window.width)), dtype=np.uint8), window=window)
+    with rasterio.open(full) as src:
+        pending = [(index, np.bincount(src.read(1, window=window).ravel(), minlength=6)) for index, window in enumerate(windows[:3])]
+    with open(resumed + '.done', 'w') as f:
+        f.write('# 128 128\n' + mosaicClassifier.progressLines(pending))
+
+    counts = mosaicClassifier.classifyMosaic(mosaic, resumed, picklefile, resume=True)
+
+    np.testing.assert_array_equal(counts, fullCounts)
+    with rasterio.open(full) as a, rasterio.open(resumed) as b:
+        np.testing.assert_array_equal(a.read(), b.read())
+
+
+def testResumeWithoutWindowCountsReportsNoFractions(mosaic, picklefile, tmp_path):
+    outfile = str(tmp_path / 'class.tif')
+    mosaicClassifier.classifyMosaic(mosaic, outfile, picklefile)
+
+    # a progress file written before the class counts were recorded
+    with open(outfile + '.done', 'w') as f:
+        f.write('# 128 128\n0\n1\n')
+
+    assert mosaicClassifier.classifyMosaic(mosaic, outfile, picklefile, resume=True) is None
@@ -53,8 +53,44 @@ SOFTWARE.
 
 ###############################################################################################
 
+Parameters:
+-----------
+
+training : csv, parquet or feather file
+            training data containing the "class", "b1", "b2" and "b3" columns. The parquet and feather files written by
+            "points_stats_multiImage_class.py" are loaded directly.
+
+picklefile : serilised pickle file
+            name of the serilised random forest classifer written by this script.
+
+sweep : csv file (optional)
+            instead of training the single classifier, sweep the number of trees (--trees), maximum depth (--depths) and minimum 
+            samples per leaf (--leaves). Each candidate is scored by cross validation (--folds) and refitted on all of the training 
+            data to measure its prediction throughput (pixels per second on a single core) and the size of its pickle file. All of 
+            the candidates are written to the sweep csv with the candidates on the Pareto front (no other candidate is at least as 
+            accurate, as fast and as small) flagged. Only the measurements of each candidate are kept, the classifiers on the Pareto 
+            front are fitted again with the same random state (--seed, or the random_state column of the sweep csv) and saved as 
+            picklefile_n<trees>_d<depth>_l<leaves>.p.
+
+update : serilised pickle file (optional)
+            instead of training the classifier from scratch, add --add-trees trees to this classifier (warm_start) fitted on the new 
+            labelled points (--new) together with a random --old-fraction of the original training data (--training). The new and 
+            old classifiers are then compared over all 16.7 million rgb colours. The new classifier is only written to picklefile 
+            (and the lookup table to --lutfile) when the class of at least one colour changes, so the downstream outputs are only 
+            regenerated when the predictions change. The colours that changed class are reported in cubes of --bin-size rgb values,
+            written to --changes, so the results of the affected colours can be invalidated selectively. The lineage of the 
+            classifier (parent classifier, training data, trees added and changed colours, with the lineage of the parent) is written 
+            to picklefile.lineage.json. The picklefile has to be a different file from the classifier being updated.
 
 """
+import os
+import json
+import hashlib
+import datetime
+import time
+import argparse
+import itertools
+import sklearn
 from sklearn.ensemble import RandomForestClassifier
 from numpy import genfromtxt, savetxt
 import pandas as pd
@@ -62,7 +98,7 @@ import numpy as np
 from random import sample
 import matplotlib.pyplot as plt
 import csv
-from sklearn.model_selection import train_test_split
+from sklearn.model_selection import train_test_split, cross_val_score
 from sklearn.metrics import explained_variance_score
 from sklearn import metrics
 from sklearn.metrics import mean_squared_error
@@ -72,16 +108,355 @@ pd.options.mode.chained_assignment = None  # default='warn'
 plt.rcParams['figure.figsize'] = (2, 2)
 
 
+def getCmdargs():
+    """
+    Get command line arguments
+    """
+    p = argparse.ArgumentParser()
+
+    p.add_argument("--training", default="comb_rgb_training_data_n17012.csv", help="Input training data, csv, parquet or feather (default is %(default)s)")
+
+    p.add_argument("--picklefile", default="rfc_cpickle_20200615.p", help="Output pickle file (default is %(default)s)")
+
+    p.add_argument("--sweep", default=None, help="Output csv of the model selection sweep, the single classifier is not trained (default is %(default)s)")
+
+    p.add_argument("--trees", type=int, nargs="+", default=[25, 50, 100, 200], help="Number of trees swept (default is %(default)s)")
+
+    p.add_argument("--depths", nargs="+", default=["8", "12", "16", "None"], help="Maximum tree depths swept, None is unlimited (default is %(default)s)")
+
+    p.add_argument("--leaves", type=int, nargs="+", default=[1, 5, 20], help="Minimum samples per leaf swept (default is %(default)s)")
+
+    p.add_argument("--folds", type=int, default=5, help="Number of cross validation folds (default is %(default)s)")
+
+    p.add_argument("--npixels", type=int, default=2 ** 20, help="Number of random rgb pixels used to time the predictions (default is %(default)s)")
+
+    p.add_argument("--update", default=None, help="Input pickle file of the classifier to add trees to, instead of training from scratch (default is %(default)s)")
+
+    p.add_argument("--new", default=None, help="New labelled points used with --update, csv, parquet or feather (default is %(default)s)")
+
+    p.add_argument("--add-trees", dest="addtrees", type=int, default=50, help="Number of trees added with --update (default is %(default)s)")
+
+    p.add_argument("--old-fraction", dest="oldfraction", type=float, default=0.2, help="Fraction of the original training data resampled with the new points (default is %(default)s)")
+
+    p.add_argument("--bin-size", dest="binsize", type=int, default=32, help="Width of the rgb cubes the changed colours are reported in (default is %(default)s)")
+
+    p.add_argument("--changes", default=None, help="Output csv of the rgb cubes that changed class (default is the pickle file name with _changed_rgb.csv)")
+
+    p.add_argument("--lutfile", default=None, help="Output rgb lookup table of the updated classifier, only written when the predictions change (default is %(default)s)")
+
+    p.add_argument("--force", action="store_true", default=False, help="Write the updated classifier even if no prediction changes")
+
+    p.add_argument("--seed", type=int, default=None, help="Random seed for the resampling and the added trees (default is %(default)s)")
+
+    cmdargs = p.parse_args()
+
+    cmdargs.depths = [None if depth.lower() == 'none' else int(depth) for depth in cmdargs.depths]
+
+    if cmdargs.update is not None and cmdargs.new is None:
+        p.error("--update needs the new labelled points (--new)")
+
+    # the parent classifier and its lineage are kept, so the updated classifier needs its own name
+    if cmdargs.update is not None and os.path.abspath(cmdargs.picklefile) == os.path.abspath(cmdargs.update):
+        p.error("--picklefile must not be the classifier given to --update")
+
+    return cmdargs
+
+
+def loadTrainingData(training):
+    """
+    read the training data in the format given by the file extension
+    """
+    extension = os.path.splitext(training)[1].lower()
+
+    if extension == '.parquet':
+        df = pd.read_parquet(training)
+    elif extension == '.feather':
+        df = pd.read_feather(training)
+    else:
+        df = pd.read_csv(training, header=0)
+
+    # drop the points that fell outside the imagery or on no data
+    return df.dropna(subset=['class', 'b1', 'b2', 'b3'])
+
+
+def predictionThroughput(rf, npixels=2 ** 20):
+    """
+    time the prediction of random 8 bit rgb pixels on a single core
+    and return the number of pixels classified per second
+    """
+    pixels = np.random.randint(0, 256, size=(npixels, 3)).astype(np.float32)
+
+    nJobs = rf.n_jobs
+    rf.n_jobs = 1
+    try:
+        start = time.time()
+        rf.predict(pixels)
+        elapsed = time.time() - start
+    finally:
+        rf.n_jobs = nJobs
+
+    return npixels / max(elapsed, 1e-9)
+
+
+def paretoFront(sweep):
+    """
+    flag the candidates that no other candidate beats on accuracy, 
+    prediction throughput and model size at the same time
+    """
+    accuracy = sweep['accuracy'].values
+    speed = sweep['pixels_per_second'].values
+    size = sweep['model_bytes'].values
+
+    front = np.ones(len(sweep), dtype=bool)
+    for i in range(len(sweep)):
+        atLeast = (accuracy >= accuracy[i]) & (speed >= speed[i]) & (size <= size[i])
+        better = (accuracy > accuracy[i]) | (speed > speed[i]) | (size < size[i])
+        front[i] = not np.any(atLeast & better)
+
+    return front
+
+
+def sweepForest(X, y, trees, depths, leaves, folds=5, npixels=2 ** 20, seed=None):
+    """
+    cross validate, time and measure the size of a random forest for each combination
+    of the number of trees, maximum depth and minimum samples per leaf. Only the
+    measurements are kept, every forest is fitted with the same random state so
+    refitForest gives back the forest that was measured
+    """
+    if seed is None:
+        seed = np.random.randint(2 ** 31 - 1)
+
+    records = []
+
+    for nTrees, depth, leaf in itertools.product(trees, depths, leaves):
+        # the folds are run in parallel, each forest is fitted on a single core
+        rf = RandomForestClassifier(n_estimators=nTrees, max_depth=depth, min_samples_leaf=leaf, n_jobs=1, random_state=seed)
+        scores = cross_val_score(rf, X, y, cv=folds, n_jobs=-1)
+
+        rf = RandomForestClassifier(n_estimators=nTrees, max_depth=depth, min_samples_leaf=leaf, n_jobs=-1, random_state=seed)
+        rf.fit(X, y)
+
+        # an unlimited depth is recorded as None rather than left missing
+        record = {'n_estimators': nTrees, 'max_depth': 'None' if depth is None else depth, 'min_samples_leaf': leaf,
+                  'accuracy': scores.mean(), 'accuracy_std': scores.std(),
+                  'pixels_per_second': predictionThroughput(rf, npixels),
+                  'model_bytes': len(pickle.dumps(rf, protocol=2))}
+        records.append(record)
+
+        print ('trees', nTrees, 'depth', depth, 'leaf', leaf, 'accuracy', round(record['accuracy'], 4),
+               'pixels/sec', int(record['pixels_per_second']), 'bytes', record['model_bytes'])
+
+    sweep = pd.DataFrame.from_records(records, columns=['n_estimators', 'max_depth', 'min_samples_leaf', 'accuracy', 
+                                                        'accuracy_std', 'pixels_per_second', 'model_bytes'])
+    sweep['pareto'] = paretoFront(sweep)
+    sweep['random_state'] = seed
+
+    return sweep
+
+
+def refitForest(X, y, row):
+    """
+    fit the random forest of a row of the sweep again
+    """
+    depth = None if row['max_depth'] == 'None' else int(row['max_depth'])
+    rf = RandomForestClassifier(n_estimators=int(row['n_estimators']), max_depth=depth, min_samples_leaf=int(row['min_samples_leaf']),
+                                n_jobs=-1, random_state=int(row['random_state']))
+
+    return rf.fit(X, y)
+
+
+# total number of 24 bit rgb colours, packed as red << 16 | green << 8 | blue as in build_rgb_lookup_table.py
+NUM_RGB = 256 ** 3
+
+
+def fileHash(path, blocksize=2 ** 20):
+    """
+    sha256 of the contents of a file
+    """
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(blocksize), b''):
+            digest.update(block)
+
+    return digest.hexdigest()
+
+
+def updateForest(rf, new, old, addTrees=50, oldFraction=0.2, seed=None):
+    """
+    add trees to the random forest with warm_start, fitted on the new points
+    together with a random share of the original training data. The existing
+    trees are kept unchanged
+    """
+    resampled = old.sample(frac=oldFraction, random_state=seed)
+    train = pd.concat([new, resampled], ignore_index=True)
+
+    X = train[['b1', 'b2', 'b3']].values.astype(np.float32)
+    y = train['class'].values
+
+    # the new trees have to give their votes for the same classes as the existing trees
+    if not np.array_equal(np.unique(y), rf.classes_):
+        raise ValueError("the update data has the classes %s but the classifier has %s" % (np.unique(y), rf.classes_))
+
+    rf.set_params(warm_start=True, n_estimators=rf.n_estimators + addTrees, random_state=seed)
+    rf.fit(X, y)
+    rf.set_params(warm_start=False)
+
+    return rf, len(resampled)
+
+
+def compareForests(oldRf, newRf, binsize=32, chunk=2 ** 20):
+    """
+    classify every rgb colour with both classifiers and count the colours that
+    change class in each rgb cube of binsize values. Returns the new predictions
+    for every colour (the lookup table of the new classifier), the number of
+    changed colours and a table of the cubes with changed colours
+    """
+    nbins = 256 // binsize
+    numClasses = int(max(oldRf.classes_.max(), newRf.classes_.max())) + 1
+
+    lut = np.zeros(NUM_RGB, dtype=np.uint8)
+    transitions = np.zeros(nbins ** 3 * numClasses * numClasses, dtype=np.int64)
+
+    for start in range(0, NUM_RGB, chunk):
+        keys = np.arange(start, min(start + chunk, NUM_RGB), dtype=np.uint32)
+        rgb = np.vstack([(keys >> 16) & 255, (keys >> 8) & 255, keys & 255]).T
+
+        oldClass = oldRf.predict(rgb.astype(np.float32)).astype(np.int64)
+        newClass = newRf.predict(rgb.astype(np.float32)).astype(np.int64)
+        lut[start:start + keys.shape[0]] = newClass
+
+        changed = oldClass != newClass
+        if changed.any():
+            cube = ((rgb[changed] // binsize) * np.array([nbins * nbins, nbins, 1])).sum(axis=1)
+            transitions += np.bincount((cube * numClasses + oldClass[changed]) * numClasses + newClass[changed],
+                                       minlength=transitions.shape[0])
+
+    transitions = transitions.reshape(nbins ** 3, numClasses, numClasses)
+    changedCubes = np.flatnonzero(transitions.sum(axis=(1, 2)))
+
+    records = []
+    for cube in changedCubes:
+        counts = transitions[cube]
+        fromClass, toClass = np.unravel_index(np.argmax(counts), counts.shape)
+        red, green, blue = (cube // (nbins * nbins), (cube // nbins) % nbins, cube % nbins)
+        records.append({'red_min': red * binsize, 'red_max': red * binsize + binsize - 1,
+                        'green_min': green * binsize, 'green_max': green * binsize + binsize - 1,
+                        'blue_min': blue * binsize, 'blue_max': blue * binsize + binsize - 1,
+                        'changed_colours': int(counts.sum()), 'changed_fraction': counts.sum() / binsize ** 3,
+                        'main_from_class': int(fromClass), 'main_to_class': int(toClass)})
+
+    changes = pd.DataFrame.from_records(records, columns=['red_min', 'red_max', 'green_min', 'green_max', 'blue_min', 'blue_max',
+                                                         'changed_colours', 'changed_fraction', 'main_from_class', 'main_to_class'])
+
+    return lut, int(transitions.sum()), changes
+
+
+def writeLineage(lineagefile, record):
+    """
+    write the lineage of the classifier next to its pickle file
+    """
+    tmpfile = lineagefile + '.tmp'
+    with open(tmpfile, 'w') as f:
+        json.dump(record, f, indent=2)
+    os.replace(tmpfile, lineagefile)
+
+
+def incrementalUpdate(cmdargs):
+    """
+    add trees fitted on the new points to an existing classifier, compare the
+    predictions of the two classifiers over every rgb colour and only write the
+    updated classifier, lookup table and lineage when a prediction changes
+    """
+    with open(cmdargs.update, 'rb') as f:
+        oldRf = pickle.load(f)
+    with open(cmdargs.update, 'rb') as f:
+        rf = pickle.load(f)
+
+    # the parent is hashed and its lineage read before anything is written
+    parentHash = fileHash(cmdargs.update)
+    parentLineage = None
+    if os.path.exists(cmdargs.update + '.lineage.json'):
+        with open(cmdargs.update + '.lineage.json') as f:
+            parentLineage = json.load(f)
+
+    new = loadTrainingData(cmdargs.new)
+    old = loadTrainingData(cmdargs.training)
+    treesBefore = rf.n_estimators
+
+    start = time.time()
+    rf, numResampled = updateForest(rf, new, old, cmdargs.addtrees, cmdargs.oldfraction, cmdargs.seed)
+    print ('%d trees added to %d, fitted on %d new and %d resampled points in %.1f seconds' %
+           (cmdargs.addtrees, treesBefore, len(new), numResampled, time.time() - start))
+
+    start = time.time()
+    lut, numChanged, changes = compareForests(oldRf, rf, cmdargs.binsize)
+    print ('%d of %d rgb colours (%.4f%%) changed class in %d rgb cubes of %d values, compared in %.1f seconds' %
+           (numChanged, NUM_RGB, 100 * numChanged / NUM_RGB, len(changes), cmdargs.binsize, time.time() - start))
+
+    changesfile = cmdargs.changes or os.path.splitext(cmdargs.picklefile)[0] + '_changed_rgb.csv'
+    changes.to_csv(changesfile, index=False)
+    print (changesfile + ' complete')
+
+    if numChanged == 0 and not cmdargs.force:
+        print ('no prediction changed, ' + cmdargs.picklefile + ' is not written and the downstream outputs do not need to be regenerated')
+        return
+
+    with open(cmdargs.picklefile, 'wb') as f:
+        pickle.dump(rf, f, protocol=2)
+
+    if cmdargs.lutfile is not None:
+        np.save(cmdargs.lutfile, lut)
+        print (cmdargs.lutfile + ' complete')
+
+    # the lineage of the parent is kept so the whole history of the classifier can be followed
+    writeLineage(cmdargs.picklefile + '.lineage.json',
+                 {'model': os.path.basename(cmdargs.picklefile), 'model_sha256': fileHash(cmdargs.picklefile),
+                  'created': datetime.datetime.now().isoformat(timespec='seconds'), 'method': 'warm_start',
+                  'parent': os.path.basename(cmdargs.update), 'parent_sha256': parentHash,
+                  'n_estimators_before': treesBefore, 'n_estimators_after': rf.n_estimators, 'seed': cmdargs.seed,
+                  'training': [{'file': os.path.basename(cmdargs.new), 'sha256': fileHash(cmdargs.new), 'points': len(new), 'role': 'new'},
+                               {'file': os.path.basename(cmdargs.training), 'sha256': fileHash(cmdargs.training), 'points': numResampled,
+                                'role': 'resampled', 'fraction': cmdargs.oldfraction}],
+                  'changed_colours': numChanged, 'changed_cubes': len(changes), 'bin_size': cmdargs.binsize,
+                  'changes': os.path.basename(changesfile), 'lookup_table': cmdargs.lutfile,
+                  'sklearn_version': sklearn.__version__, 'parent_lineage': parentLineage})
+
+    print (cmdargs.picklefile + ' complete, regenerate the outputs of the colours in ' + changesfile)
+
+
 def main():
-    
-    # read in the csv file containing the training data, which should be stored with this script.   
-    df = pd.read_csv('comb_rgb_training_data_n17012.csv', header=0)
+
+    cmdargs = getCmdargs()
+
+    if cmdargs.update is not None:
+        incrementalUpdate(cmdargs)
+        return
+
+    # read in the file containing the training data, which should be stored with this script.
+    df = loadTrainingData(cmdargs.training)
     
     # check all the classes are present
     print(df['class'].unique())
     
     train = df[['class', 'b1', 'b2', 'b3']] 
 
+    if cmdargs.sweep is not None:
+        X = train[['b1', 'b2', 'b3']].values.astype(np.float32)
+        sweep = sweepForest(X, train['class'].values, cmdargs.trees, cmdargs.depths, cmdargs.leaves, cmdargs.folds,
+                            cmdargs.npixels, cmdargs.seed)
+        sweep.to_csv(cmdargs.sweep, index=False)
+
+        # only the classifiers on the Pareto front are fitted again and saved out
+        stem = os.path.splitext(cmdargs.picklefile)[0]
+        for i in np.flatnonzero(sweep['pareto'].values):
+            row = sweep.iloc[i]
+            name = '%s_n%d_d%s_l%d.p' % (stem, row['n_estimators'], row['max_depth'], row['min_samples_leaf'])
+            with open(name, 'wb') as f:
+                pickle.dump(refitForest(X, train['class'].values, row), f, protocol=2)
+
+        print (sweep[sweep['pareto']].sort_values('accuracy', ascending=False))
+        return
+
     class_names = train['class'].unique()
     
     # select out the predictor variables    
@@ -161,7 +536,7 @@ def main():
     """uncomment the code below and change the cpickle file name to save out the random forest classifer"""
    
     # save out model to a cPickle file 
-    with open('rfc_cpickle_20200615.p', 'wb') as f:
+    with open(cmdargs.picklefile, 'wb') as f:
         pickle.dump(rfc, f,protocol=2)
 
 if __name__=="__main__":
@@ -0,0 +1,312 @@
+#!/usr/bin/env python
+
+"""
+This code estimates the woody FPC and the other class fractions of every plot in a mosaic in a single pass over the mosaic, rather
+than clipping an image chip for each plot. The plot polygons are rasterised once into a plot ID image (uint32, 0 outside the plots)
+on the same grid and with the same blocks as the mosaic. The mosaic and the plot ID image are then read together block by block with
+rios, each block is classified with the random forest classifer from "rgb_digital_aerial_photo_classifier.py" and the pixels of each
+class in each plot are counted with a single bincount of plot_id * 6 + class. The counts of all of the blocks give a plot x class
+table, from which the fraction of the non-null pixels of each plot in each class is calculated.
+
+Each pixel of the plot ID image holds a single plot, so where plots overlap the overlapping pixels are counted only in the plot
+rasterised last (the later plot in the vector file) and the fractions of the earlier plot are calculated without them. The plots
+that overlap are checked when they are rasterised and a warning listing them is printed, clip image chips for these plots with
+"multi_clip_tool_rasterio.py" when every plot must include all of its pixels.
+
+The five classes represent cover for;
+
+Class               Pixel value            Description
+------------------------------------------------------------------------------------------
+Woody green:          1                    Green leaf for all woody vegetation
+Non-woody green:      2                    Green leaf from all non-woody vegetation
+Bare/npv vegetation:  3                    Bare ground and senescent vegetation (woody and non-woody)
+Shadow:               4                    Shadow
+Branch/trunk:         5                    Branches and trunks of woody vegetation
+------------------------------------------------------------------------------------------
+
+###############################################################################################
+
+MIT License
+
+Copyright (c) 2020 Grant Staben
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+
+###############################################################################################
+
+Parameters:
+-----------
+
+reffile : raster image file .tif
+            8 bit digital aerial photography mosaic.
+
+vector : GeoPackage or shapefile
+            single file containing all of the plot polygons.
+
+idfield : str
+            field in the vector file that identifies each plot.
+
+csv : csv file
+            name of the csv file containing the fpc and class fractions of each plot.
+
+zonefile : raster image file .tif (optional)
+            name of the plot ID image, by default the mosaic name with the suffix _plot_id.tif. With --reuse-zones an existing
+            plot ID image is used rather than rasterising the plots again.
+
+outfile : raster image file .tif (optional)
+            name of the classified image, only the plots are classified and the classified image is not written when not given.
+
+picklefile : serilised pickle file
+            serilised random forest classifer.
+
+lut : numpy file .npy (optional)
+            precomputed rgb lookup table produced by build_rgb_lookup_table.py, used instead of the pickle file.
+
+forest : numpy file .npz (optional)
+            random forest exported by flat_forest.py, used instead of the pickle file so scikit-learn is not needed.
+
+colour-cache : flag (optional)
+            use the colour cache, only the unique colours not already classified are passed to the random forest.
+
+"""
+
+from __future__ import print_function, division
+
+import sys
+import os
+import json
+import time
+import argparse
+import numpy as np
+import pandas as pd
+import rasterio
+from rasterio.features import rasterize
+from rasterio.windows import Window
+from shapely.geometry import box, shape
+from shapely.strtree import STRtree
+from rios import applier
+import rgb_digital_aerial_photo_classifier as classifier
+import multi_clip_tool_rasterio as clipper
+
+# number of values in the classified image, the null pixels (0) and the five classes
+NUM_VALUES = classifier.NUM_CLASSES + 1
+
+# block size of the plot ID image when the mosaic is not tiled
+ZONE_BLOCKSIZE = 256
+
+
+def getCmdargs():
+    """
+    Get command line arguments
+    """
+    p = argparse.ArgumentParser()
+
+    p.add_argument("--reffile", help="Input 8bit digital aerial photography mosaic")
+
+    p.add_argument("-v", "--vector", help="GeoPackage or shapefile containing all of the plot polygons")
+
+    p.add_argument("-f", "--idfield", default="id", help="field in the vector file identifying each plot (default is %(default)s)")
+
+    p.add_argument("-c", "--csv", help="output csv file of the plot fractions")
+
+    p.add_argument("--zonefile", default=None, help="plot ID image (default is the mosaic name with _plot_id.tif)")
+
+    p.add_argument("--reuse-zones", dest="reusezones", action="store_true", default=False, help="use an existing plot ID image rather than rasterising the plots again")
+
+    p.add_argument("--outfile", default=None, help="Name of the output classified image, not written by default")
+
+    p.add_argument("--picklefile", default="rfc_cpickle_20200615.p", help="Input pickle file (default is %(default)s)")
+
+    p.add_argument("--lut", default=None, help="Input rgb lookup table used instead of the pickle file (default is %(default)s)")
+
+    p.add_argument("--forest", default=None, help="Input forest exported by flat_forest.py, used instead of the pickle file (default is %(default)s)")
+
+    p.add_argument("--colour-cache", dest="colourcache", action="store_true", default=False, help="Cache the class of each rgb colour so only the colours not already classified are passed to the random forest")
+
+    cmdargs = p.parse_args()
+
+    if cmdargs.reffile is None or cmdargs.vector is None or cmdargs.csv is None:
+        p.print_help()
+        sys.exit()
+
+    return cmdargs
+
+
+def rasterisePlots(reffile, vector, idfield, zonefile):
+    """
+    burn the plots into a uint32 plot ID image on the grid of the mosaic, plot i
+    in the returned list of plot ids has the value i + 1. The image is written one
+    block at a time so the memory used does not depend on the size of the mosaic
+    """
+    plots = clipper.readPlots(vector, idfield)
+
+    with rasterio.open(reffile) as data:
+        matches = clipper.imagePlots(data, plots, idfield, {})
+        profile = data.profile.copy()
+        blockRows, blockCols = data.block_shapes[0]
+        transform = data.transform
+        width = data.width
+        height = data.height
+
+    # the plot ID image uses the blocks of the mosaic so rios reads matching blocks from both
+    if not profile.get('tiled', False) or blockRows % 16 != 0 or blockCols % 16 != 0:
+        blockRows, blockCols = (ZONE_BLOCKSIZE, ZONE_BLOCKSIZE)
+
+    profile.update(driver='GTiff', count=1, dtype='uint32', nodata=0, tiled=True, blockxsize=blockCols, blockysize=blockRows,
+                   compress='deflate', BIGTIFF='IF_SAFER')
+    for key in ['photometric', 'interleave']:
+        profile.pop(key, None)
+
+    plotIds = [plotId for plotId, coords in matches]
+    geometries = [shape(coords[0]) for plotId, coords in matches]
+    tree = STRtree(geometries)
+
+    overlaps = overlappingPlots(tree, geometries)
+    if len(overlaps) > 0:
+        print ('Warning: %d pairs of plots overlap, the overlapping pixels are only counted in the later plot: %s' %
+               (len(overlaps), ', '.join('%s/%s' % (plotIds[first], plotIds[second]) for first, second in overlaps)))
+
+    with rasterio.open(zonefile, 'w', **profile) as dst:
+        for row in range(0, height, blockRows):
+            for col in range(0, width, blockCols):
+                window = Window(col, row, min(blockCols, width - col), min(blockRows, height - row))
+                windowTransform = rasterio.windows.transform(window, transform)
+
+                # only the plots that overlap the block are burnt into it
+                hits = clipper.queryPlots(tree, geometries, box(*rasterio.windows.bounds(window, transform)))
+                if len(hits) == 0:
+                    continue
+
+                zones = rasterize([(geometries[index], index + 1) for index in hits], out_shape=(int(window.height), int(window.width)),
+                                  transform=windowTransform, fill=0, dtype='uint32')
+                dst.write(zones, 1, window=window)
+
+        # the plot ids are kept with the image so it can be reused
+        dst.update_tags(plot_ids=json.dumps([str(plotId) for plotId in plotIds]))
+
+    return plotIds
+
+
+def overlappingPlots(tree, geometries):
+    """
+    the index of each pair of plots that share an area, a pixel
+    in both plots is only counted in the plot with the larger index
+    """
+    pairs = []
+    for index, geometry in enumerate(geometries):
+        for other in clipper.queryPlots(tree, geometries, geometry):
+            if other > index and geometry.intersection(geometries[other]).area > 0:
+                pairs.append((index, other))
+
+    return pairs
+
+
+def readPlotIds(zonefile):
+    """
+    the plot ids stored in a plot ID image written by rasterisePlots
+    """
+    with rasterio.open(zonefile) as dataset:
+        return json.loads(dataset.tags()['plot_ids'])
+
+
+def doZonal(info, inputs, outputs, otherargs):
+    """
+    classify a block of the mosaic and count the pixels of each class in each plot
+    """
+    zones = inputs.zones[0].astype(np.int64)
+    image = inputs.image
+
+    # the pixels outside the plots are not classified unless the classified image is written
+    if not otherargs.writeRaster:
+        image = np.where(zones[np.newaxis] == 0, otherargs.refnull, image).astype(image.dtype)
+
+    hgtBlock = classifier.classifyBlock(image, otherargs)
+
+    otherargs.zoneCounts += np.bincount((zones * NUM_VALUES + hgtBlock[0]).ravel(), minlength=otherargs.zoneCounts.shape[0])
+
+    if otherargs.writeRaster:
+        outputs.hgt = hgtBlock
+
+
+def zonalFractions(reffile, zonefile, plotIds, model, outfile=None):
+    """
+    classify the mosaic block by block and return a table of the pixel counts
+    and class fractions of each plot
+    """
+    controls = applier.ApplierControls()
+    infiles = applier.FilenameAssociations()
+    outfiles = applier.FilenameAssociations()
+
+    infiles.image = reffile
+    infiles.zones = zonefile
+    controls.setReferenceImage(infiles.image)
+
+    if outfile is not None:
+        outfiles.hgt = outfile
+
+    # row i of the counts holds plot i, row 0 the pixels outside the plots
+    model.writeRaster = outfile is not None
+    model.zoneCounts = np.zeros((len(plotIds) + 1) * NUM_VALUES, dtype=np.int64)
+
+    applier.apply(doZonal, infiles, outfiles, model, controls=controls)
+
+    counts = model.zoneCounts.reshape(len(plotIds) + 1, NUM_VALUES)[1:]
+
+    rows = []
+    for plotId, plotCounts in zip(plotIds, counts):
+        result = {'site': plotId, 'pixels': int(plotCounts.sum())}
+        result.update(classifier.classFractions(plotCounts))
+        rows.append(result)
+
+    table = pd.DataFrame(rows).rename(columns={'woody_green': 'fpc'})
+
+    return table[['site', 'fpc'] + classifier.CLASS_NAMES[1:] + ['nonnull', 'pixels']]
+
+
+def main():
+    """
+    Main routine
+
+    """
+    cmdargs = getCmdargs()
+
+    zonefile = cmdargs.zonefile
+    if zonefile is None:
+        zonefile = os.path.splitext(cmdargs.reffile)[0] + '_plot_id.tif'
+
+    start = time.time()
+    if cmdargs.reusezones and os.path.exists(zonefile):
+        plotIds = readPlotIds(zonefile)
+    else:
+        plotIds = rasterisePlots(cmdargs.reffile, cmdargs.vector, cmdargs.idfield, zonefile)
+        print ('%d plots rasterised to %s in %.1f seconds' % (len(plotIds), zonefile, time.time() - start))
+
+    model = classifier.loadModel(cmdargs.picklefile, cmdargs.lut, cmdargs.colourcache, cmdargs.forest)
+
+    start = time.time()
+    table = zonalFractions(cmdargs.reffile, zonefile, plotIds, model, cmdargs.outfile)
+    print ('%d plots classified in %.1f seconds' % (len(table), time.time() - start))
+
+    table.to_csv(cmdargs.csv, index=False)
+
+    print (cmdargs.csv + ' complete')
+
+
+if __name__ == "__main__":
+    main()